@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Benchmarks ChangeManager.check_all_uploads over a synthetic uploads tree.
+
+The tree holds N attachments of mixed jpg, png and webp, at typical camera
+and screengrab resolutions, each with the sizes WordPress would have made
+at its default quality. Their metadata is served from a wp_postmeta table in
+SQLite, through DBHandle's own queries, in place of MariaDB.
+
+Run from the repository root, with Pillow installed:
+
+    PYTHONPATH=ss_img_shrinker python3 benchmarks/bench_optimiser.py \
+        -n 20 --engine pillow -o bench.json
+
+Forks are only counted in the coordinating process, so are exact only with
+a single worker.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from PIL import Image, ImageDraw
+
+import common_funcs as cmn
+from db_wrapper import DBHandle
+from optimiser import ChangeManager
+from scaler import ImgScaler, ResolutionsList
+
+# Cycled through in turn, as (extension, width, height).
+SOURCE_SHAPES = [
+    ("jpg", 4000, 3000),
+    ("png", 1920, 1080),
+    ("webp", 2560, 1440),
+    ("jpg", 3024, 4032),
+    ("png", 1080, 424),
+    ("webp", 1024, 694),
+]
+# What WordPress saves sizes at, by default.
+WP_QUALITY = 82
+
+
+class SqliteCursor:
+    """Adapts DBHandle's "%s" placeholders to SQLite's "?"."""
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    def execute(self, query: str, params=()):
+        self.cursor.execute(query.replace("%s", "?"), params)
+
+    def executemany(self, query: str, seq_of_params):
+        self.cursor.executemany(query.replace("%s", "?"), seq_of_params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteDBHandle(DBHandle):
+    """Stands in for MariaDB, with a wp_postmeta table in SQLite."""
+    def __init__(self, path: str):
+        super().__init__({})
+        self.path = path
+
+    def connect(self):
+        self.cnxn = sqlite3.connect(self.path)
+        self.cursor = SqliteCursor(self.cnxn.cursor())
+
+    def retrying(self, operation):
+        """A local file is never lost, nor idle too long."""
+        return operation()
+
+
+def wp_sizes(w: int, h: int) -> Dict[str, Tuple[int, int]]:
+    """The sizes WordPress makes of a w x h upload, by label."""
+    scaler = ImgScaler(w, h)
+    sizes = {}
+    if w > 768:
+        sizes["medium_large"] = scaler.fix_width(768)
+    for label, box in [("medium", 300), ("large", 1024),
+                       ("1536x1536", 1536), ("2048x2048", 2048)]:
+        dims = ResolutionsList()
+        scaler.add_scaled_size_bounded_by(dims, box, box)
+        if dims:
+            sizes[label] = dims[0]
+    thumb = scaler.get_thumbnail(150, 150)
+    if thumb:
+        sizes["thumbnail"] = thumb
+    return sizes
+
+
+def synthetic_img(extension: str, w: int, h: int, seed: int) -> Image.Image:
+    """
+    Photos are smooth gradients under sensor noise. Screengrabs, our pngs,
+    are flat panels of a few colours.
+    """
+    if extension == "png":
+        img = Image.new("RGB", (w, h), (240, 240, 240))
+        draw = ImageDraw.Draw(img)
+        for i in range(12):
+            x = (seed * 97 + i * 151) % w
+            y = (seed * 53 + i * 89) % h
+            draw.rectangle([x, y, x + w // 5, y + h // 9],
+                           fill=(i * 20 % 256, 90, 200 - i * 15))
+            draw.text((x + 4, y + 4), "synthetic {}".format(i), fill=0)
+        return img
+    gradient = Image.linear_gradient("L").resize((w, h))
+    noise = Image.effect_noise((w, h), 24 + seed % 16)
+    return Image.merge("RGB", (
+        gradient, Image.blend(gradient.rotate(90).resize((w, h)), noise, 0.4),
+        noise))
+
+
+def save_img(img: Image.Image, path: str):
+    if path.endswith(".png"):
+        img.save(path)
+    else:
+        img.save(path, quality=WP_QUALITY)
+
+
+def make_uploads(root: str, n: int) -> List[Tuple[str, dict]]:
+    """:return: the _wp_attached_file and metadata of each attachment."""
+    attachments = []
+    for i in range(n):
+        extension, w, h = SOURCE_SHAPES[i % len(SOURCE_SHAPES)]
+        subfolder = "{}/{:02}".format(2015 + i // 24, i % 12 + 1)
+        os.makedirs(os.path.join(root, subfolder), exist_ok=True)
+        stem = "upload{}".format(i)
+        rel_path = "{}/{}.{}".format(subfolder, stem, extension)
+        img = synthetic_img(extension, w, h, i)
+        save_img(img, os.path.join(root, rel_path))
+        metadata = {
+            "width": w, "height": h, "file": rel_path,
+            "filesize": os.path.getsize(os.path.join(root, rel_path)),
+            "sizes": {}}
+        for label, (sw, sh) in wp_sizes(w, h).items():
+            file_nm = stem + cmn.get_name_decor(sw, sh, extension)
+            if label == "thumbnail":
+                w1, h1 = ImgScaler(w, h).get_uncropped_thumb(sw, sh)
+                left, top = (w1 - sw) // 2, (h1 - sh) // 2
+                resized = img.resize((w1, h1)).crop(
+                    (left, top, left + sw, top + sh))
+            else:
+                resized = img.resize((sw, sh))
+            save_img(resized, os.path.join(root, subfolder, file_nm))
+            metadata["sizes"][label] = {
+                "file": file_nm, "width": sw, "height": sh,
+                "mime-type": "image/" + extension.replace("jpg", "jpeg"),
+                "filesize": os.path.getsize(
+                    os.path.join(root, subfolder, file_nm))}
+        attachments.append((rel_path, metadata))
+    return attachments
+
+
+def make_postmeta(path: str, attachments: List[Tuple[str, dict]]):
+    cnxn = sqlite3.connect(path)
+    with cnxn:
+        cnxn.execute(
+            "CREATE TABLE wp_postmeta (meta_id INTEGER PRIMARY KEY, "
+            "post_id INTEGER, meta_key TEXT, meta_value TEXT)")
+        for post_id, (rel_path, metadata) in enumerate(attachments, 1):
+            cnxn.execute(
+                "INSERT INTO wp_postmeta (post_id, meta_key, meta_value) "
+                "VALUES (?, '_wp_attached_file', ?)", (post_id, rel_path))
+            cnxn.execute(
+                "INSERT INTO wp_postmeta (post_id, meta_key, meta_value) "
+                "VALUES (?, '_wp_attachment_metadata', ?)",
+                (post_id, cmn.php_serialize_from_dict(metadata)))
+    cnxn.close()
+
+
+def tree_bytes(root: str) -> Tuple[int, int]:
+    """:return: 2-tuple of the count and total size of images under root."""
+    count, total = 0, 0
+    for folder, _, files in os.walk(root):
+        for f in files:
+            count += 1
+            total += os.path.getsize(os.path.join(folder, f))
+    return count, total
+
+
+def run_benchmark(work_dir: str, n: int, engine: str, workers: int,
+                  single_decode: bool, async_converts: int = 0) -> dict:
+    uploads = os.path.join(work_dir, "uploads") + "/"
+    os.makedirs(uploads)
+    attachments = make_uploads(uploads, n)
+    make_postmeta(os.path.join(work_dir, "wp.sqlite3"), attachments)
+    conf_path = os.path.join(work_dir, "config.json")
+    with open(conf_path, "w") as f:
+        json.dump({"sql": {}, "wp_server": {
+            "wp_uploads": uploads,
+            "png_q": 32,
+            "webp_mp_to_max_q": {"0": 70, "1": 60, "2": 50},
+            "jpg_mp_to_max_q": {"0": 70, "1": 60, "2": 50},
+            "workers": workers,
+            "async_converts": async_converts,
+            "single_decode": single_decode,
+            "engine": engine,
+            "state_db": os.path.join(work_dir, "state.sqlite3"),
+        }}, f)
+
+    optimiser = ChangeManager(conf_path)
+    optimiser.db = SqliteDBHandle(os.path.join(work_dir, "wp.sqlite3"))
+    images, bytes_before = tree_bytes(uploads)
+    forks_before = sum(cmn.SHELL_CMDS.values())
+    with optimiser, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        optimiser.check_all_uploads()
+        total_secs = time.perf_counter() - start
+    _, bytes_after = tree_bytes(uploads)
+    forks = sum(cmn.SHELL_CMDS.values()) - forks_before
+    summary = optimiser.metrics.summary()
+    return {
+        "params": {"attachments": n, "engine": engine, "workers": workers,
+                   "async_converts": async_converts,
+                   "single_decode": single_decode},
+        "phase_secs": summary["phase_secs"],
+        "counters": summary["counters"],
+        "total_secs": total_secs,
+        "images": images,
+        "images_per_sec": images / total_secs,
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "bytes_saved_per_sec": (bytes_before - bytes_after) / total_secs,
+        "forks_per_image": forks / images,
+    }
+
+
+def main(args_list: List[str]):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--attachments", type=int, default=12)
+    parser.add_argument("--engine", default="magick")
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-a", "--async-converts", type=int, default=0)
+    parser.add_argument("--single-decode", action="store_true")
+    parser.add_argument(
+        "--work-dir", help="Where to build the tree, which is then kept. "
+                           "Defaults to a temporary directory.")
+    parser.add_argument(
+        "-o", "--output", help="JSON file to write results to, as well as "
+                               "printing them.")
+    args = parser.parse_args(args_list)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_optimiser_")
+    try:
+        results = run_benchmark(work_dir, args.attachments, args.engine,
+                                args.workers, args.single_decode,
+                                args.async_converts)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmarks planning every size of a library, one ImgScaler at a time against
+plan_batch over arrays of them all, checking their results are identical.
+
+Sources are random, up to 9000 pixels a side. Run from the repository root,
+with numpy installed:
+
+    PYTHONPATH=ss_img_shrinker python3 benchmarks/bench_scaler.py \
+        -n 100000 -o bench_scaler.json
+"""
+import argparse
+import json
+import sys
+import time
+from typing import List
+
+import numpy as np
+
+from scaler import ImgScaler, plan_batch
+
+
+def scalar_plans(ws: List[int], hs: List[int]) -> list:
+    plans = []
+    for w, h in zip(ws, hs):
+        scaler = ImgScaler(w, h)
+        sizes, thmb = scaler.get_widths_and_heights()
+        plans.append((sizes, thmb, thmb and scaler.get_uncropped_thumb(*thmb)))
+    return plans
+
+
+def batch_plans(ws: List[int], hs: List[int]) -> list:
+    """plan_batch's results, unpacked as scalar_plans's, to compare."""
+    sizes = plan_batch(ws, hs)
+    unpacked = {label: list(zip(s.w.tolist(), s.h.tolist(), s.valid.tolist()))
+                for label, s in sizes.items()}
+    plans = []
+    for i in range(len(ws)):
+        made = {label: (w, h) for label, dims in unpacked.items()
+                for w, h, valid in [dims[i]] if valid}
+        thmb = made.pop("thumbnail", None)
+        uncropped = made.pop("thumbnail_uncropped", None)
+        plans.append((sorted(made.values()), thmb, uncropped))
+    return plans
+
+
+def run_benchmark(n: int, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    ws = rng.integers(1, 9000, n).tolist()
+    hs = rng.integers(1, 9000, n).tolist()
+    start = time.perf_counter()
+    scalar = scalar_plans(ws, hs)
+    scalar_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    plan_batch(ws, hs)
+    batch_secs = time.perf_counter() - start
+    return {
+        "params": {"sources": n, "seed": seed},
+        "scalar_secs": scalar_secs,
+        "batch_secs": batch_secs,
+        "speedup": scalar_secs / batch_secs,
+        "identical": batch_plans(ws, hs) == scalar,
+    }
+
+
+def main(args_list: List[str]):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--sources", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "-o", "--output", help="JSON file to write results to, as well as "
+                               "printing them.")
+    args = parser.parse_args(args_list)
+    results = run_benchmark(args.sources, args.seed)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,203 @@
+"""
+Tells a daemon which directories of uploads changed, as they change, by
+inotify, rather than it finding out by polling the whole tree.
+
+inotify is not recursive; every directory needs its own watch, added as it
+is created. Anything written into a new directory before its watch is added
+goes unseen, which is the race that put us off inotify. So a directory is
+listed once it is watched, reported as changed whether or not we saw
+anything written to it, and the daemon still scans the whole tree, though
+rarely, to reconcile whatever else slipped through, such as events dropped
+when the kernel's queue overflows.
+
+Uses libc by ctypes, so needs Linux, but no other dependency.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from typing import Callable, Dict, Optional, Set
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# Files finished with, including those renamed into place, as we and
+# WordPress do, and directories created, to watch in turn.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR | \
+             IN_DONT_FOLLOW
+# Of struct inotify_event: wd, mask, cookie and len, then len bytes of name.
+EVENT_HEADER = struct.Struct("iIII")
+READ_BYTES = 64 * 1024
+DEFAULT_SETTLE_SECS = 10
+DEFAULT_RECONCILE_SECS = 3600
+
+
+class ChangeFeedException(Exception):
+    pass
+
+
+class InotifyFeed:
+    def __init__(self, root_dir: str, is_upload: Callable[[str], bool],
+                 settle_secs: float = DEFAULT_SETTLE_SECS,
+                 reconcile_secs: float = DEFAULT_RECONCILE_SECS):
+        """
+        :param root_dir: the uploads directory, ending in a separator.
+        :param is_upload: whether a file name, written, could be an upload.
+        :param settle_secs: how long a change waits for others after it,
+            as WordPress writes an upload's sizes one at a time.
+        :param reconcile_secs: how often the daemon should scan everything.
+        """
+        self.root_dir = root_dir
+        self.is_upload = is_upload
+        self.settle_secs = settle_secs
+        self.reconcile_secs = reconcile_secs
+        self.fd = -1
+        self.libc = None
+        # Relative paths of the directories watched, by watch descriptor.
+        self.watched: Dict[int, str] = {}
+        self.changed: Set[str] = set()
+        self.overflowed = False
+
+    @classmethod
+    def from_config(cls, root_dir: str, is_upload: Callable[[str], bool],
+                    config: Optional[dict]):
+        """:param config: the optional "inotify" key of "wp_server"."""
+        if config is None:
+            return None
+        return cls(root_dir, is_upload,
+                   config.get("settle_secs", DEFAULT_SETTLE_SECS),
+                   config.get("reconcile_secs", DEFAULT_RECONCILE_SECS))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """Watches every directory under root_dir."""
+        libc_name = ctypes.util.find_library("c")
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            inotify_init1 = self.libc.inotify_init1
+        except (OSError, AttributeError, TypeError) as e:
+            raise ChangeFeedException(
+                "\"inotify\" requires Linux's inotify, in libc.") from e
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise ChangeFeedException("inotify_init1 failed: {}".format(
+                os.strerror(ctypes.get_errno())))
+        self.watch_tree("")
+        # Nothing has changed as far as we know; the daemon scans first.
+        self.changed.clear()
+
+    def watch_tree(self, subfolder: str):
+        """
+        Watches the directory at subfolder, then those under it, each noted
+        as changed, since it may have been written to before it was watched.
+        """
+        pending = [subfolder]
+        while pending:
+            subfolder = pending.pop()
+            folder = os.path.join(self.root_dir, subfolder)
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise ChangeFeedException(
+                    "Can't watch \"{}\": {}{}".format(
+                        folder, os.strerror(err),
+                        ", raise fs.inotify.max_user_watches"
+                        if err == errno.ENOSPC else ""))
+            self.watched[wd] = subfolder
+            self.changed.add(subfolder)
+            try:
+                with os.scandir(folder) as entries:
+                    pending += [os.path.join(subfolder, entry.name)
+                                for entry in entries
+                                if entry.is_dir(follow_symlinks=False)]
+            except FileNotFoundError:
+                pass
+
+    def handle(self, buffer: bytes):
+        """Notes the directories changed by the inotify events in buffer."""
+        i = 0
+        while i < len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, i)
+            i += EVENT_HEADER.size
+            name = os.fsdecode(buffer[i:i + length].rstrip(b"\0"))
+            i += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            subfolder = self.watched.get(wd)
+            if subfolder is None:
+                continue
+            if mask & IN_IGNORED:
+                # Its directory went, or was moved away.
+                del self.watched[wd]
+            elif mask & IN_ISDIR:
+                try:
+                    self.watch_tree(os.path.join(subfolder, name))
+                except ChangeFeedException as e:
+                    # Left to the daemon's scans, as are events dropped.
+                    print(e)
+                    self.overflowed = True
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and \
+                    self.is_upload(name):
+                self.changed.add(subfolder)
+
+    def read(self, timeout: float) -> bool:
+        """
+        Handles whatever events arrive within timeout seconds.
+
+        :return: whether any did.
+        """
+        readable, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not readable:
+            return False
+        try:
+            self.handle(os.read(self.fd, READ_BYTES))
+        except BlockingIOError:
+            return False
+        return True
+
+    def changed_dirs(self, timeout: float) -> Optional[Set[str]]:
+        """
+        Waits up to timeout seconds for a change, then for changes to stop
+        for settle_secs.
+
+        :return: the relative paths of the directories changed, or None if
+            events were lost, so that only a full scan will find them.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.changed and not self.overflowed and \
+                self.read(deadline - time.monotonic()):
+            pass
+        if self.changed:
+            while self.read(self.settle_secs):
+                pass
+        changed, self.changed = self.changed, set()
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.watched = {}
@@ -1,10 +1,22 @@
+import asyncio
+import grp
+import hashlib
+import os
+import pwd
+import struct
 import subprocess
-from typing import List, Dict, Any
+from collections import Counter
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, BinaryIO, Iterator, Tuple
 
-from phpserialize import phpobject, unserialize, serialize
+import php_meta
+
+# Processes forked by run_shell_cmd, by program, for this process.
+SHELL_CMDS = Counter()
 
 
 def run_shell_cmd(cmd: List[str]) -> str:
+    SHELL_CMDS[cmd[0]] += 1
     result = subprocess.run(cmd, capture_output=True)
     result_text = None
     if result.returncode == 0:
@@ -12,19 +24,156 @@ def run_shell_cmd(cmd: List[str]) -> str:
     return result_text
 
 
+async def run_shell_cmd_async(cmd: List[str]) -> Optional[str]:
+    """
+    As run_shell_cmd, but awaiting the process. If cancelled, the process is
+    killed, and reaped, before the cancellation carries on.
+    """
+    SHELL_CMDS[cmd[0]] += 1
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    result_text = None
+    if proc.returncode == 0:
+        result_text = stdout.decode()
+    return result_text
+
+
 def get_file_size(file_name: str) -> int:
-    return int(run_shell_cmd(['stat', '-c' '%s', file_name]))
+    return os.stat(file_name).st_size
+
+
+def get_file_hash(file_name: str) -> str:
+    """The hex sha1 of a file's content."""
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        # As stat would, for an id without a name.
+        return str(uid)
+
+
+@lru_cache(maxsize=None)
+def _group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return str(gid)
 
 
 def get_file_owner(file_name: str) -> str:
-    return run_shell_cmd(['stat', '-c' '%U', file_name]).strip()
+    return _user_name(os.stat(file_name).st_uid)
 
 
 def get_file_group(file_name: str) -> str:
-    return run_shell_cmd(['stat', '-c' '%G', file_name]).strip()
+    return _group_name(os.stat(file_name).st_gid)
+
+
+def _png_wxh(f: BinaryIO) -> Optional[List[int]]:
+    header = f.read(24)
+    if len(header) < 24 or header[12:16] != b"IHDR":
+        return None
+    return list(struct.unpack(">II", header[16:24]))
+
+
+def _webp_wxh(f: BinaryIO) -> Optional[List[int]]:
+    header = f.read(30)
+    if len(header) < 30 or header[8:12] != b"WEBP":
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8 ":
+        # Lossy: after the 3 byte frame tag and 3 byte start code.
+        w, h = struct.unpack("<HH", header[26:30])
+        return [w & 0x3fff, h & 0x3fff]
+    if chunk == b"VP8L":
+        # Lossless: 14 bits each of width - 1 and height - 1.
+        bits = struct.unpack("<I", header[21:25])[0]
+        return [(bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1]
+    if chunk == b"VP8X":
+        # Extended: 24 bits each of canvas width - 1 and height - 1.
+        return [int.from_bytes(header[24:27], "little") + 1,
+                int.from_bytes(header[27:30], "little") + 1]
+    return None
+
+
+# Start of frame markers, which carry the dimensions. C4, C8 and CC are not.
+_JPEG_SOFS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def jpeg_segments(f: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the marker and payload length of each segment of a JPEG, up to
+    its first scan, leaving f at the start of that payload.
+    """
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return
+        marker = byte[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            # Standalone, no length follows.
+            continue
+        if marker in (0xd9, 0xda):
+            return
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return
+        length = struct.unpack(">H", length_bytes)[0]
+        payload_at = f.tell()
+        yield marker, length - 2
+        f.seek(payload_at + length - 2)
+
+
+def _jpeg_wxh(f: BinaryIO) -> Optional[List[int]]:
+    for marker, _ in jpeg_segments(f):
+        if marker in _JPEG_SOFS:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            h, w = struct.unpack(">HH", sof[1:5])
+            return [w, h]
+    return None
+
+
+def read_img_header_wxh(file_name: str) -> Optional[List[int]]:
+    """
+    The width and height, as stored, of a PNG, JPEG or WebP, read from its
+    header alone. None for anything else, or anything we can't make sense of.
+    """
+    with open(file_name, "rb") as f:
+        magic = f.read(12)
+        f.seek(0)
+        if magic.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _png_wxh(f)
+        if magic.startswith(b"\xff\xd8"):
+            return _jpeg_wxh(f)
+        if magic.startswith(b"RIFF") and magic[8:12] == b"WEBP":
+            return _webp_wxh(f)
+    return None
 
 
 def get_img_wxh(file_name: str) -> List[int]:
+    wxh = read_img_header_wxh(file_name)
+    if wxh is not None:
+        return wxh
     result_text = run_shell_cmd(['identify', '-ping', '-format', '"%wx%h"', file_name])
     return list(map(int, result_text.strip("\"").split("x")))
 
@@ -54,23 +203,12 @@ def get_name_decor(w: int, h: int, ext: str):
 
 
 def php_unserialize_to_dict(serialized: str) -> dict:
-    byte_dict = unserialize(bytes(serialized, 'utf-8'), object_hook=phpobject)
-    return decode_dict(byte_dict)
-
-
-def decode_dict(byte_dict):
-    py_dict = {}
-    for k, v in byte_dict.items():
-        if isinstance(v, bytes):
-            v = v.decode()
-        elif isinstance(v, dict):
-            v = decode_dict(v)
-        py_dict[k.decode()] = v
-    return py_dict
+    """Unserializes every key, unlike php_meta.loads by default."""
+    return php_meta.loads(serialized, keys=None)
 
 
 def php_serialize_from_dict(src_dict: dict) -> str:
-    return serialize(src_dict).decode()
+    return php_meta.dumps(src_dict)
 
 
 
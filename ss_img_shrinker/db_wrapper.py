@@ -1,52 +1,210 @@
-from typing import List, Tuple, Any, Dict, Optional, Callable
+import time
+from typing import List, Tuple, Any, Dict, Optional, Callable, TypeVar
 
 import mysql.connector
+import mysql.connector.pooling
 
 import common_funcs as cmn
+import php_meta
+
+# Most paths to put in one "IN (...)" clause.
+IN_BATCH_SIZE = 500
+# Most metadata updates to commit in one transaction.
+COMMIT_EVERY = 100
+UPDATE_METADATA = "UPDATE wp_postmeta SET meta_value = %s WHERE meta_id = %s"
+POOL_SIZE = 1
+# Times to retry a query or update, after reconnecting, on losing the server.
+RETRIES = 3
+RETRY_DELAY_SECS = 1
+# A connection idle this long is checked before use, since the server drops
+# those idle beyond its wait_timeout.
+HEALTH_CHECK_SECS = 60
+# What losing the connection raises, as against an error in the query.
+LOST_CONNECTION_ERRORS = (mysql.connector.errors.OperationalError,
+                          mysql.connector.errors.InterfaceError)
+
+T = TypeVar("T")
 
 
 class DBHandle:
-    def __init__(self, config: dict):
+    def __init__(self, config: dict,
+                 pool: Optional[
+                     mysql.connector.pooling.MySQLConnectionPool] = None):
+        """
+        :param config: the "sql" key of the config, of which "pool_size"
+            and "retries" are optional.
+        :param pool: to share with another DBHandle, rather than create.
+        """
         self.cnxn = None
         self.cursor = None
         self.config = config
+        self.pool = pool
+        self.retries = config.get("retries", RETRIES)
+        self.last_used = time.monotonic()
 
     def connect(self):
-        self.cnxn = mysql.connector.connect(
-            host=self.config["host"],
-            user=self.config["user"],
-            password=self.config["password"],
-            database=self.config["database"],
-        )
+        if self.pool is None:
+            self.pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_size=self.config.get("pool_size", POOL_SIZE),
+                host=self.config["host"],
+                user=self.config["user"],
+                password=self.config["password"],
+                database=self.config["database"],
+            )
+        # Reconnects it, should it have been dropped while in the pool.
+        self.cnxn = self.pool.get_connection()
         self.cursor = self.cnxn.cursor()
+        self.last_used = time.monotonic()
+
+    def reconnect(self):
+        """Returns our connection to the pool, however broken, for another."""
+        try:
+            self.disconnect()
+        except mysql.connector.Error:
+            pass
+        self.cnxn = None
+        self.cursor = None
+        self.connect()
+
+    def retrying(self, operation: Callable[[], T]) -> T:
+        """
+        Runs operation, which must be idempotent, checking our connection
+        first if it has been idle. Should the connection be lost, it is
+        retried on a new one, up to "retries" times, waiting longer each
+        time. Failing to get that new one, as while the server restarts,
+        uses up a retry likewise. Having no connection, as when the last
+        call gave up, we get one first.
+        """
+        lost = False
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(RETRY_DELAY_SECS * 2 ** (attempt - 1))
+            try:
+                if lost or self.cnxn is None or \
+                        time.monotonic() - self.last_used > \
+                        HEALTH_CHECK_SECS and not self.cnxn.is_connected():
+                    self.reconnect()
+                    lost = False
+            except mysql.connector.Error:
+                if attempt == self.retries:
+                    raise
+                lost = True
+                continue
+            try:
+                result = operation()
+            except LOST_CONNECTION_ERRORS:
+                if attempt == self.retries:
+                    raise
+                lost = True
+                continue
+            self.last_used = time.monotonic()
+            return result
 
     def query_all_media(self) -> Dict[str, int]:
         """Return a map of filenames to post ids."""
-        self.cursor.execute(
-            "SELECT meta_value, post_id FROM wp_postmeta WHERE meta_key = '_wp_attached_file'")
-        results = self.cursor.fetchall()
+        results = self.retrying(lambda: self.fetch_all(
+            "SELECT meta_value, post_id FROM wp_postmeta WHERE meta_key = '_wp_attached_file'"))
         original_filenames = {x[0]: x[1] for x in results}
         return original_filenames
 
     def query_media_metadata(self) -> List[Tuple[int, Dict]]:
         """Returns a list of 2-tuples of the meta_id and meta_value."""
-        self.cursor.execute(
-            "SELECT meta_id, meta_value FROM wp_postmeta WHERE meta_key = '_wp_attachment_metadata'")
-        results = self.cursor.fetchall()
+        results = self.retrying(lambda: self.fetch_all(
+            "SELECT meta_id, meta_value FROM wp_postmeta WHERE meta_key = '_wp_attachment_metadata'"))
         metadata = [(x[0], cmn.php_unserialize_to_dict(x[1])) for x in results]
         return metadata
 
+    def query_media_metadata_for(
+            self, rel_paths: List[str],
+            batch_size: int = IN_BATCH_SIZE) -> List[Tuple[int, Dict]]:
+        """
+        As query_media_metadata, but only for the attachments whose
+        _wp_attached_file is one of rel_paths. Paths which aren't attached
+        files, such as the sizes made from them, simply match nothing.
+        """
+        return [(meta_id, cmn.php_unserialize_to_dict(meta_value))
+                for meta_id, meta_value in self.fetch_media_metadata_for(
+                    rel_paths, batch_size)]
+
+    def fetch_media_metadata_for(
+            self, rel_paths: List[str],
+            batch_size: int = IN_BATCH_SIZE) -> List[Tuple[int, str]]:
+        """As query_media_metadata_for, but leaving meta_value serialized."""
+        rows = []
+        for i in range(0, len(rel_paths), batch_size):
+            batch = rel_paths[i:i + batch_size]
+            rows += [(x[0], x[1]) for x in self.retrying(
+                lambda: self.fetch_all(
+                    "SELECT md.meta_id, md.meta_value FROM wp_postmeta af "
+                    "JOIN wp_postmeta md ON md.post_id = af.post_id "
+                    "AND md.meta_key = '_wp_attachment_metadata' "
+                    "WHERE af.meta_key = '_wp_attached_file' "
+                    "AND af.meta_value IN ({})".format(
+                        ", ".join(["%s"] * len(batch))), batch))]
+        return rows
+
     def update_metadata(self, post_meta_id, metadata: dict):
         serialized = cmn.php_serialize_from_dict(metadata)
-        self.cursor.execute(
-            "UPDATE wp_postmeta SET meta_value = '{}' WHERE meta_id = {}".format(
-                serialized, post_meta_id
-            ))
+        self.retrying(lambda: self.cursor.execute(
+            UPDATE_METADATA, (serialized, post_meta_id)))
+
+    def update_metadata_batch(
+            self, updates: List[Tuple[int, dict]],
+            commit_every: int = COMMIT_EVERY):
+        """
+        Writes many metadata, committing every commit_every of them, rather
+        than holding one transaction open for them all.
+
+        :param updates: 2-tuples of meta_id and its new metadata.
+        """
+        self.update_serialized_batch(
+            [(post_meta_id, cmn.php_serialize_from_dict(metadata))
+             for post_meta_id, metadata in updates], commit_every)
+
+    def update_filesizes_batch(
+            self, updates: List[Tuple[int, php_meta.PhpMetadata]],
+            commit_every: int = COMMIT_EVERY):
+        """
+        As update_metadata_batch, for metadata read by php_meta.loads whose
+        filesizes alone have changed, which are patched into what was read.
+        """
+        self.update_serialized_batch(
+            [(post_meta_id, php_meta.patch_filesizes(metadata))
+             for post_meta_id, metadata in updates], commit_every)
+
+    def update_serialized_batch(
+            self, updates: List[Tuple[int, str]],
+            commit_every: int = COMMIT_EVERY):
+        """
+        :param updates: 2-tuples of meta_id and its serialized metadata.
+            Should the connection be lost, the batch being written is
+            written again, those committed before it are not.
+        """
+        for i in range(0, len(updates), commit_every):
+            batch = [(serialized, post_meta_id)
+                     for post_meta_id, serialized in updates[
+                         i:i + commit_every]]
+            self.retrying(lambda: self.execute_many_and_commit(
+                UPDATE_METADATA, batch))
+
+    def fetch_all(self, *execute_args) -> List[tuple]:
+        self.cursor.execute(*execute_args)
+        return self.cursor.fetchall()
+
+    def execute_many_and_commit(self, query: str, seq_of_params: List[tuple]):
+        self.cursor.executemany(query, seq_of_params)
+        self.cnxn.commit()
 
     def disconnect(self):
-        if self.cursor:
-            self.cursor.close()
-        if self.cnxn:
-            self.cnxn.close()
+        """
+        Returns our connection to the pool even if closing the cursor
+        raises, as it does with a result unread, lest the pool run out.
+        """
+        try:
+            if self.cursor:
+                self.cursor.close()
+        finally:
+            if self.cnxn:
+                self.cnxn.close()
 
 
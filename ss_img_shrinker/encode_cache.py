@@ -0,0 +1,135 @@
+"""
+Encodes already known not to save space, so that we needn't decode an image
+only to discard the larger result again.
+
+Each is keyed on the engine, the command and its f-string vars, and the
+content hashes of the source and destination, as we leave them. Its value is
+the size the encode made. While those hashes are unchanged, as after a
+restore or an rsync which only touched mtimes, the encode is skipped.
+
+A variant is kept or not by comparison with its sibling, so it is also keyed
+on the sibling's content hash, and on its own destination's absence, if it
+wasn't kept.
+
+A quality search is cached likewise, its value being the quality found. It
+is keyed on the content hash of the original as we leave it, so that the
+original we re-encoded at that quality is never searched again, which would
+find a lower quality still.
+"""
+import hashlib
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import common_funcs as cmn
+
+# f-string vars which name files, rather than parameterise the encode.
+FILE_VARS = ("src_img", "dest_img")
+
+
+class EncodeCache:
+    """
+    One attachment's view of the cache. Lookups go through the store, but
+    the entries to record are only returned, on each encode's dict, for the
+    coordinating process to write.
+    """
+    def __init__(self, engine_name: str,
+                 size_of: Callable[[str], Optional[int]]):
+        """
+        :param size_of: looks up the size recorded for a key, if any.
+        """
+        self.engine_name = engine_name
+        self.size_of = size_of
+        self.hashes: Dict[str, str] = {}
+        self.pending: List[
+            Tuple[dict, str, dict, str, str, int, Optional[str]]] = []
+        self.searches: List[Tuple[dict, dict, str, int, str, int]] = []
+
+    def hash_of(self, path: str) -> Optional[str]:
+        """:return: the content hash of path, or None if there is none."""
+        if path not in self.hashes:
+            if not os.path.exists(path):
+                return None
+            self.hashes[path] = cmn.get_file_hash(path)
+        return self.hashes[path]
+
+    def replaced(self, path: str):
+        """Forgets the hash of a file we have just replaced."""
+        self.hashes.pop(path, None)
+
+    def key(self, command: str, f_str_vars: dict, src_img: str,
+            dest_img: str, sibling: Optional[str] = None) -> str:
+        params = {k: v for k, v in f_str_vars.items() if k not in FILE_VARS}
+        hashes = [self.hash_of(src_img), self.hash_of(dest_img)]
+        if sibling is not None:
+            hashes.append(self.hash_of(sibling))
+        return hashlib.sha1(json.dumps(
+            [self.engine_name, command, params] + hashes,
+            sort_keys=True).encode()).hexdigest()
+
+    def lookup(self, command: str, f_str_vars: dict,
+               sibling: Optional[str] = None) -> Optional[int]:
+        """
+        :param sibling: of a variant, which it is compared with.
+        :return: the size this encode made before, if it didn't help.
+        """
+        return self.size_of(self.key(
+            command, f_str_vars, f_str_vars["src_img"],
+            f_str_vars["dest_img"], sibling))
+
+    def note(self, encode: dict, command: str, f_str_vars: dict,
+             dest_img: str, size: int, sibling: Optional[str] = None):
+        """
+        Notes an encode, whether made or skipped, to key on the files once
+        all of the attachment's encodes are done. Whether the destination
+        was replaced or not, it is now no larger than this encode makes.
+        A variant is likewise no smaller than its sibling, or is already
+        made.
+        """
+        self.pending.append(
+            (encode, command, f_str_vars, f_str_vars["src_img"], dest_img,
+             size, sibling))
+
+    def search_key(self, settings: dict, command: str, max_q: int,
+                   src_img: str) -> str:
+        return hashlib.sha1(json.dumps(
+            [self.engine_name, "q_search", command, settings, max_q,
+             self.hash_of(src_img)], sort_keys=True).encode()).hexdigest()
+
+    def lookup_q(self, settings: dict, command: str,
+                 f_str_vars: dict) -> Optional[int]:
+        """
+        :param settings: of the search, which decide the quality it finds.
+        :return: the quality a search found before, up to the "q" of
+            f_str_vars, for its "src_img" as it now is.
+        """
+        return self.size_of(self.search_key(
+            settings, command, f_str_vars["q"], f_str_vars["src_img"]))
+
+    def note_q(self, report: dict, settings: dict, command: str,
+               f_str_vars: dict, q: int):
+        """
+        Notes a quality search, whether made or looked up, to key on the
+        original once all of the attachment's encodes are done.
+        """
+        self.searches.append((report, settings, command, f_str_vars["q"],
+                              f_str_vars["src_img"], q))
+
+    def settle(self):
+        """
+        Keys each noted encode on its files as we leave them, so that sizes
+        made before the original was re-encoded stand for it afterwards, and
+        sets it on the encode's dict as "cache", a 2-tuple of key and size.
+        Each search is likewise keyed, with the quality it found.
+        """
+        for encode, command, f_str_vars, src_img, dest_img, size, sibling \
+                in self.pending:
+            if sibling is not None or os.path.exists(dest_img):
+                encode["cache"] = (self.key(
+                    command, f_str_vars, src_img, dest_img, sibling), size)
+        for report, settings, command, max_q, src_img, q in self.searches:
+            if os.path.exists(src_img):
+                report["cache"] = (
+                    self.search_key(settings, command, max_q, src_img), q)
+        self.pending = []
+        self.searches = []
@@ -0,0 +1,240 @@
+"""
+The engines which turn our convert commands into images.
+
+ImageMagick's convert is the default. The commands remain the single
+description of what we do to an image, so an in-process engine interprets
+the handful of convert operators they use, rather than having commands of
+its own.
+
+Each engine can also render asynchronously, for the "async_converts"
+orchestrator: convert as a child process awaited by the event loop, Pillow
+in the loop's default thread pool.
+"""
+import asyncio
+from typing import List, Tuple, Dict, Optional
+
+import common_funcs as cmn
+
+try:
+    from PIL import Image, ImageFilter
+except ImportError:
+    Image = None
+    ImageFilter = None
+
+
+class EngineException(Exception):
+    pass
+
+
+def _operators_of(command: str) -> str:
+    """
+    The operators of one of our convert commands, those between "convert"
+    and the "{src_img} {dest_img}" which end them all.
+    """
+    tokens = command.split()
+    return " ".join(tokens[1:tokens.index("{src_img}")])
+
+
+class MagickEngine:
+    """Shells out to ImageMagick, once per call."""
+    name = "magick"
+
+    def __init__(self, limits: Optional[Dict[str, str]] = None):
+        """
+        :param limits: ImageMagick resources, such as "memory", "map" and
+            "thread", to limit each convert to.
+        """
+        self.limits = limits or {}
+
+    def limited(self, split_cmd: List[str]) -> List[str]:
+        """split_cmd with a -limit for each of our limits after "convert"."""
+        limit_args = []
+        for resource, value in self.limits.items():
+            limit_args += ["-limit", resource, str(value)]
+        return split_cmd[:1] + limit_args + split_cmd[1:]
+
+    @staticmethod
+    def check(result: Optional[str], split_cmd: List[str]) -> None:
+        """
+        Raises if convert failed, as it may have written nothing, or only
+        part of an image.
+
+        :param result: of run_shell_cmd, None for a non-zero exit status.
+        """
+        if result is None:
+            raise EngineException("convert failed: {}".format(
+                " ".join(split_cmd)))
+
+    def render(self, f_str_vars: dict, command: str) -> None:
+        split_cmd = self.limited(
+            cmn.split_fstring_not_args(f_str_vars, command))
+        self.check(cmn.run_shell_cmd(split_cmd), split_cmd)
+
+    def render_many(
+            self, src_img: str, outputs: List[Tuple[dict, str]]) -> None:
+        split_cmd = self.many_cmd(src_img, outputs)
+        self.check(cmn.run_shell_cmd(split_cmd), split_cmd)
+
+    async def render_async(self, f_str_vars: dict, command: str) -> None:
+        split_cmd = self.limited(
+            cmn.split_fstring_not_args(f_str_vars, command))
+        self.check(await cmn.run_shell_cmd_async(split_cmd), split_cmd)
+
+    async def render_many_async(
+            self, src_img: str, outputs: List[Tuple[dict, str]]) -> None:
+        split_cmd = self.many_cmd(src_img, outputs)
+        self.check(await cmn.run_shell_cmd_async(split_cmd), split_cmd)
+
+    def many_cmd(self, src_img: str,
+                 outputs: List[Tuple[dict, str]]) -> List[str]:
+        """
+        A single convert applies each set of operators to a +clone of the
+        source, in its own parentheses, and writes it to its "dest_img".
+        """
+        split_cmd = ["convert", src_img, "-respect-parentheses"]
+        for f_str_vars, command in outputs:
+            split_cmd += ["(", "+clone"]
+            split_cmd += cmn.split_fstring_not_args(
+                f_str_vars, _operators_of(command))
+            split_cmd += ["-write", f_str_vars["dest_img"], "+delete", ")"]
+        split_cmd.append("null:")
+        return self.limited(split_cmd)
+
+
+def _parse_wxh(geometry: str) -> Tuple[int, int]:
+    w, h = geometry.split("x")
+    return int(w), int(h)
+
+
+class PillowEngine:
+    """
+    Runs our convert commands in-process, with Pillow.
+
+    Only those operators our commands use are understood, with the same
+    meaning as in convert: -resize fits within the box keeping aspect,
+    -extent crops about the -gravity center, -colors quantises to a palette.
+    """
+    name = "pillow"
+    # Operators which take an argument.
+    WITH_ARG = {"-resize", "-quality", "-interlace", "-gaussian-blur",
+                "-colors", "-define", "-gravity", "-extent"}
+
+    def __init__(self):
+        if Image is None:
+            raise EngineException(
+                "The \"pillow\" engine requires Pillow to be installed.")
+
+    def render(self, f_str_vars: dict, command: str) -> None:
+        split_cmd = cmn.split_fstring_not_args(f_str_vars, command)
+        src_img, dest_img = split_cmd[-2:]
+        with Image.open(src_img) as img:
+            img.load()
+            self.apply(img, split_cmd[1:-2], dest_img)
+
+    def render_many(
+            self, src_img: str, outputs: List[Tuple[dict, str]]) -> None:
+        """Each output is made from the one decode of the source."""
+        with Image.open(src_img) as img:
+            img.load()
+            for f_str_vars, command in outputs:
+                self.apply(img, cmn.split_fstring_not_args(
+                    f_str_vars, _operators_of(command)),
+                    f_str_vars["dest_img"])
+
+    async def render_async(self, f_str_vars: dict, command: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.render, f_str_vars, command)
+
+    async def render_many_async(
+            self, src_img: str, outputs: List[Tuple[dict, str]]) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.render_many, src_img, outputs)
+
+    def apply(self, img, operators: List[str], dest_img: str) -> None:
+        """
+        Applies operators, in order, to a copy of img and saves it.
+        Settings, such as -quality, only take effect on saving.
+        """
+        save_params: Dict = {}
+        gravity = "center"
+        strip = False
+        operators = iter(operators)
+        for op in operators:
+            arg = next(operators) if op in self.WITH_ARG else None
+            if op == "-strip":
+                strip = True
+            elif op == "-resize":
+                img = self.resize_to_fit(img, *_parse_wxh(arg))
+            elif op == "-quality":
+                save_params["quality"] = int(arg.rstrip("%"))
+            elif op == "-interlace":
+                save_params["progressive"] = arg.lower() != "none"
+            elif op == "-gaussian-blur":
+                img = img.filter(ImageFilter.GaussianBlur(float(arg)))
+            elif op == "-colors":
+                img = self.quantize(img, int(arg))
+            elif op == "-define":
+                key, value = arg.split("=")
+                if key != "webp:method":
+                    raise EngineException("Unsupported -define " + arg)
+                save_params["method"] = int(value)
+            elif op == "-gravity":
+                gravity = arg.lower()
+            elif op == "-extent":
+                if gravity != "center":
+                    raise EngineException("Unsupported -gravity " + gravity)
+                img = self.centre_crop(img, *_parse_wxh(arg))
+            else:
+                raise EngineException("Unsupported operator " + op)
+        if not strip:
+            for key in ("exif", "icc_profile"):
+                if key in img.info:
+                    save_params[key] = img.info[key]
+        fmt = Image.registered_extensions().get(
+            "." + dest_img.split(".")[-1].lower())
+        if fmt == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+        img.save(dest_img, fmt, **save_params)
+
+    @staticmethod
+    def resize_to_fit(img, w: int, h: int):
+        """As convert's -resize WxH, the largest size within the box."""
+        scale = min(w / img.width, h / img.height)
+        size = (max(1, int(img.width * scale + 0.5)),
+                max(1, int(img.height * scale + 0.5)))
+        if img.mode == "P":
+            img = img.convert("RGBA")
+        return img.resize(size, Image.LANCZOS)
+
+    @staticmethod
+    def quantize(img, colors: int):
+        if img.mode in ("RGBA", "LA", "P"):
+            # Only the octree quantiser keeps an alpha channel.
+            return img.convert("RGBA").quantize(
+                colors, method=Image.FASTOCTREE)
+        return img.convert("RGB").quantize(colors)
+
+    @staticmethod
+    def centre_crop(img, w: int, h: int):
+        left = (img.width - w) // 2
+        top = (img.height - h) // 2
+        return img.crop((left, top, left + w, top + h))
+
+
+ENGINES = {
+    MagickEngine.name: MagickEngine,
+    PillowEngine.name: PillowEngine,
+}
+
+
+def get_engine(name: str, magick_limits: Optional[Dict[str, str]] = None):
+    """
+    :param name: "magick" or "pillow", from the "engine" config key.
+    :param magick_limits: resource limits, only for the "magick" engine.
+    """
+    if name not in ENGINES:
+        raise EngineException("Unknown engine \"{}\", expected one of: {}".format(
+            name, ", ".join(ENGINES)))
+    if name == MagickEngine.name:
+        return MagickEngine(magick_limits)
+    return ENGINES[name]()
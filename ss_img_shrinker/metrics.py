@@ -0,0 +1,176 @@
+"""
+Timers and counters for a run of the optimiser, by phase.
+
+Each run appends one JSON line summarising it, optionally preceded by a line
+per encode, and can rewrite a Prometheus textfile collector file, for
+node_exporter, of gauges from the last run.
+"""
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+PHASES = ["scan", "db_query", "unserialize", "imaging", "write_back"]
+PROM_PREFIX = "ss_img_shrinker"
+
+
+class Metrics:
+    def __init__(self, jsonl_path: Optional[str] = None,
+                 prom_path: Optional[str] = None, per_encode: bool = False):
+        """
+        :param jsonl_path: file to append JSON lines to, if any.
+        :param prom_path: Prometheus textfile to rewrite each run, if any.
+        :param per_encode: also write a JSON line for every encode.
+        """
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.per_encode = per_encode
+        self.phase_secs: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.encodes: List[dict] = []
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]):
+        """:param config: the optional "metrics" key of "wp_server"."""
+        config = config or {}
+        return cls(config.get("jsonl"), config.get("prometheus"),
+                   config.get("per_encode", False))
+
+    @contextmanager
+    def timer(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_secs[phase] += time.perf_counter() - start
+
+    def timed_iter(self, phase: str, iterable):
+        """
+        Yields from iterable, timing only how long each item takes to come,
+        not whatever is done with it.
+        """
+        iterator = iter(iterable)
+        done = object()
+        while True:
+            with self.timer(phase):
+                item = next(iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def count(self, name: str, n: float = 1):
+        self.counters[name] += n
+
+    def record_encodes(self, encodes: List[dict]):
+        """
+        :param encodes: as made by _magick_on_img, each with "engine_secs",
+            "bytes_in", "bytes_out" and "accepted", unless skipped as
+            "cached" or by precheck. Those precheck "audited" count as
+            false skips if accepted. A "q_search" is the number of trial
+            encodes a quality search made, unless it was "cached". A
+            "variant" is counted apart, its bytes being those saved serving
+            it in place of its sibling.
+        """
+        for encode in encodes:
+            if "q_search" in encode:
+                if encode.get("cached"):
+                    self.count("q_searches_cached")
+                    continue
+                self.count("q_searches")
+                self.count("q_search_trials", encode["q_search"])
+                self.count("q_search_secs", encode["engine_secs"])
+                continue
+            if encode.get("variant"):
+                self.count("variants")
+                self.count("engine_secs", encode["engine_secs"])
+                if encode["accepted"]:
+                    self.count("variants_kept")
+                    self.count("variant_bytes_saved",
+                               encode["bytes_in"] - encode["bytes_out"])
+                continue
+            if encode.get("cached"):
+                self.count("encodes_cached")
+                continue
+            if encode.get("skipped"):
+                self.count("precheck_skipped")
+                continue
+            if encode.get("audited"):
+                self.count("precheck_audited")
+                if encode["accepted"]:
+                    self.count("precheck_false_skips")
+            self.count("encodes")
+            self.count("encodes_accepted" if encode["accepted"]
+                       else "encodes_rejected")
+            self.count("engine_secs", encode["engine_secs"])
+            self.count("bytes_in", encode["bytes_in"])
+            self.count("bytes_out", encode["bytes_out"])
+            if encode["accepted"]:
+                self.count("bytes_saved",
+                           encode["bytes_in"] - encode["bytes_out"])
+        if self.per_encode:
+            self.encodes += encodes
+
+    def rates(self) -> Dict[str, float]:
+        """
+        The fraction of encodes precheck skipped, and of those it predicted
+        but audited, the fraction which did save space.
+        """
+        rates = {}
+        skipped = self.counters.get("precheck_skipped", 0)
+        if skipped or self.counters.get("precheck_audited"):
+            rates["precheck_skip_rate"] = skipped / (
+                skipped + self.counters.get("encodes", 0))
+        if self.counters.get("precheck_audited"):
+            rates["precheck_false_skip_rate"] = \
+                self.counters.get("precheck_false_skips", 0) / \
+                self.counters["precheck_audited"]
+        return rates
+
+    def summary(self) -> dict:
+        return {
+            "event": "run",
+            "ts": time.time(),
+            "phase_secs": {p: self.phase_secs.get(p, 0.0) for p in PHASES},
+            "counters": dict(self.counters),
+            "rates": self.rates(),
+        }
+
+    def emit(self):
+        """Writes this run's metrics wherever configured."""
+        summary = self.summary()
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a") as f:
+                for encode in self.encodes:
+                    f.write(json.dumps(dict(encode, event="encode")) + "\n")
+                f.write(json.dumps(summary) + "\n")
+        if self.prom_path:
+            self.write_prometheus(summary)
+
+    def write_prometheus(self, summary: dict):
+        """
+        Written to a temporary file then renamed, so node_exporter never
+        reads one half written.
+        """
+        lines = [
+            "# HELP {}_phase_seconds Seconds spent in each phase of the "
+            "last run.".format(PROM_PREFIX),
+            "# TYPE {}_phase_seconds gauge".format(PROM_PREFIX),
+        ]
+        for phase, secs in summary["phase_secs"].items():
+            lines.append('{}_phase_seconds{{phase="{}"}} {}'.format(
+                PROM_PREFIX, phase, secs))
+        for name, value in sorted(
+                list(summary["counters"].items()) +
+                list(summary["rates"].items())):
+            lines.append("# TYPE {}_{} gauge".format(PROM_PREFIX, name))
+            lines.append("{}_{} {}".format(PROM_PREFIX, name, value))
+        lines.append("# TYPE {}_last_run_timestamp_seconds gauge".format(
+            PROM_PREFIX))
+        lines.append("{}_last_run_timestamp_seconds {}".format(
+            PROM_PREFIX, summary["ts"]))
+        tmp_path = self.prom_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
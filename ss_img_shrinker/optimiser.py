@@ -7,65 +7,438 @@ requires ImageMagick-devel, is yet another dependency and obfuscates
 the command lines used to prototype/learn the operations performed.
 """
 import argparse
-import csv
+import asyncio
+import copy
+import errno
 import json
 import os
+import signal
+import stat
 import sys
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
 from pathlib import Path
-from typing import List, Tuple, Any, Dict, Optional, Callable
+from typing import List, Tuple, Any, Dict, Optional, Callable, Iterable, \
+    Iterator
 
 # print(sys.path)
 
 import common_funcs as cmn
-from db_wrapper import DBHandle
+import php_meta
+from change_feed import InotifyFeed
+from db_wrapper import DBHandle, COMMIT_EVERY
+from encode_cache import EncodeCache
+from engines import MagickEngine, get_engine
+from metrics import Metrics
+from precheck import Precheck
+from quality_search import QualitySearch
+from scheduler import JobScheduler, magick_limits
 from scaler import ImgScaler
+from state_store import StateStore, ResidentStateStore, FileState, DirState, \
+    NV_STATE_PATH
 
-NV_RECORD_PATH = "latest_mods.csv"
+IMG_EXTENSIONS = ["png", "webp", "jpg", "jpeg"]
+# Formats we can write variants in, and the originals they accompany.
+VARIANTS = ["webp", "avif"]
+VARIANT_SOURCES = ["png", "jpg", "jpeg"]
+# A directory changed more recently than this may still be being written to,
+# by WordPress making its sizes, so we list it again next time.
+DIR_SETTLE_SECS = 300
+# Longest to go without writing back, however few attachments are done.
+CHECKPOINT_SECS = 60
+# Jobs queued for each worker, beyond which we stop reading ahead.
+IN_FLIGHT_PER_WORKER = 2
+# How often a daemon looks for uploads to shrink.
+POLL_SECS = 300
 
 
 class CompressorException(Exception):
     pass
 
 
-def _magick_on_img(f_str_vars: dict, command: str) -> Optional[int]:
+def _staging_name(final_destination: str) -> str:
+    """
+    Creates a uniquely named, empty, staging file beside the final
+    destination. Being on the same filesystem it can replace it atomically.
+    Its name ends in that of the destination, so keeps its extension.
+
+    If we may not write there, as the uploads belong to another user, it is
+    made in the temp directory instead, for _replace to move with sudo.
+    """
+    suffix = "_" + os.path.basename(final_destination)
+    try:
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=".staged_", suffix=suffix,
+            dir=os.path.dirname(final_destination))
+    except PermissionError:
+        fd, tmp_name = tempfile.mkstemp(prefix=".staged_", suffix=suffix)
+    os.close(fd)
+    return tmp_name
+
+
+def _sudo(cmd: List[str]) -> None:
+    if cmn.run_shell_cmd(["sudo"] + cmd) is None:
+        raise CompressorException("Failed to sudo {}".format(" ".join(cmd)))
+
+
+def _replace(tmp_name: str, final_destination: str,
+             existing: os.stat_result, magicked: os.stat_result) -> None:
+    """
+    Renames tmp_name, of stat magicked, over final_destination, giving it
+    the ownership and permissions of existing. Where we may not, not being
+    root and the uploads belonging to another user, sudo does so instead,
+    file by file. --sudo avoids that by running everything as root.
+    """
+    os.chmod(tmp_name, stat.S_IMODE(existing.st_mode))
+    try:
+        if (magicked.st_uid, magicked.st_gid) != \
+                (existing.st_uid, existing.st_gid):
+            os.chown(tmp_name, existing.st_uid, existing.st_gid)
+        os.replace(tmp_name, final_destination)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EACCES, errno.EXDEV):
+            raise
+        _sudo(["mv", tmp_name, final_destination])
+        _sudo(["chown", "{}:{}".format(existing.st_uid, existing.st_gid),
+               final_destination])
+
+
+def _discard(tmp_name: str) -> None:
+    """Removes a staging file, unless it was already kept or removed."""
+    try:
+        os.remove(tmp_name)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_variant(variant: str) -> None:
+    """Removes a variant left by an earlier run, with sudo if need be."""
+    try:
+        os.remove(variant)
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        _sudo(["rm", "-f", variant])
+
+
+def _keep_if_smaller(tmp_name: str, final_destination: str,
+                     encode: Optional[dict] = None,
+                     sibling: Optional[str] = None) -> Optional[int]:
+    """
+    Renames the staged file over its final destination, if that saves space,
+    returning its size. It takes the ownership and permissions of the file
+    it replaces. Otherwise the staged file is removed, as is an empty one,
+    which no encode should have made, and, for a variant, any older one.
+
+    :param encode: optional dict to note the sizes compared, and the verdict.
+    :param sibling: for a variant, in another format, the file it would be
+        served in place of, which it must be smaller than, and whose
+        ownership and permissions it takes. Its own destination needn't
+        exist yet.
+    """
+    existing = os.stat(sibling or final_destination)
+    magicked = os.stat(tmp_name)
+    if encode is not None:
+        encode["bytes_in"] = existing.st_size
+        encode["bytes_out"] = magicked.st_size
+        encode["accepted"] = 0 < magicked.st_size < existing.st_size
+    if 0 < magicked.st_size < existing.st_size:
+        _replace(tmp_name, final_destination, existing, magicked)
+        return magicked.st_size
+    os.remove(tmp_name)
+    if sibling:
+        # Served in place of its sibling, it mustn't outlive its rejection.
+        _remove_variant(final_destination)
+    return None
+
+
+def _skip_cached(f_str_vars: dict, command: str, engine,
+                 encodes: Optional[List[dict]],
+                 cache: Optional[EncodeCache],
+                 sibling: Optional[str] = None) -> bool:
+    """
+    :return: True if the cache knows this encode won't save space, or, for
+        a variant, that it lost to its sibling or was made already.
+    """
+    if cache is None:
+        return False
+    cached_size = cache.lookup(command, f_str_vars, sibling)
+    if cached_size is None:
+        return False
+    encode = {"file": os.path.basename(f_str_vars["dest_img"]),
+              "engine": engine.name, "cached": True}
+    cache.note(encode, command, f_str_vars, f_str_vars["dest_img"],
+               cached_size, sibling)
+    if encodes is not None:
+        encodes.append(encode)
+    return True
+
+
+def _precheck(f_str_vars: dict, engine, encodes: Optional[List[dict]],
+              precheck: Optional[Precheck]) -> Tuple[bool, Optional[str]]:
+    """
+    :return: 2-tuple of whether to skip the encode, and why it was predicted
+        not to save space, if it was, even though audited.
+    """
+    if precheck is None:
+        return False, None
+    predicted = precheck.predict_no_saving(f_str_vars)
+    if predicted is None or precheck.audit():
+        return False, predicted
+    if encodes is not None:
+        encodes.append({"file": os.path.basename(f_str_vars["dest_img"]),
+                        "engine": engine.name, "skipped": predicted})
+    return True, predicted
+
+
+def _note_made(encode: dict, command: str, f_str_vars: dict,
+               final_destination: str, cache: Optional[EncodeCache],
+               sibling: Optional[str] = None):
+    if cache is None:
+        return
+    if encode["accepted"]:
+        cache.replaced(final_destination)
+    cache.note(encode, command, f_str_vars, final_destination,
+               encode["bytes_out"], sibling)
+
+
+def _stage(f_str_vars: dict, command: str, engine,
+           encodes: Optional[List[dict]], cache: Optional[EncodeCache],
+           precheck: Optional[Precheck], sibling: Optional[str] = None) -> \
+        Optional[Tuple[str, Optional[str]]]:
+    """
+    Unless the cache, or precheck, skips the encode, points its "dest_img"
+    at a new staging file. Precheck doesn't apply to variants, of a sibling,
+    whose destinations it knows nothing of.
+
+    :return: 2-tuple of the final destination and why precheck predicted
+        no saving, if it did, else None if skipped.
+    """
+    predicted = None
+    if _skip_cached(f_str_vars, command, engine, encodes, cache, sibling):
+        return None
+    if sibling is None:
+        skip, predicted = _precheck(f_str_vars, engine, encodes, precheck)
+        if skip:
+            return None
+    final_destination = f_str_vars["dest_img"]
+    f_str_vars["dest_img"] = _staging_name(final_destination)
+    return final_destination, predicted
+
+
+def _unstage(f_str_vars: dict, command: str,
+             staged: Tuple[str, Optional[str]], engine, engine_secs: float,
+             encodes: Optional[List[dict]], cache: Optional[EncodeCache],
+             sibling: Optional[str] = None) -> Optional[int]:
+    """
+    Keeps the staged encode, as _keep_if_smaller, noting it in encodes and
+    the cache.
+    """
+    final_destination, predicted = staged
+    encode = {"file": os.path.basename(final_destination),
+              "engine": engine.name, "engine_secs": engine_secs}
+    if predicted:
+        encode["audited"] = predicted
+    if sibling:
+        encode["variant"] = True
+    new_size = _keep_if_smaller(
+        f_str_vars["dest_img"], final_destination, encode, sibling)
+    _note_made(encode, command, f_str_vars, final_destination, cache,
+               sibling)
+    if encodes is not None:
+        encodes.append(encode)
+    return new_size
+
+
+def _magick_on_img(
+        f_str_vars: dict, command: str, engine=MagickEngine(),
+        encodes: Optional[List[dict]] = None,
+        cache: Optional[EncodeCache] = None,
+        precheck: Optional[Precheck] = None,
+        sibling: Optional[str] = None) -> Optional[int]:
     """
     Supplied command uses f-string (py 3.6) with lookups from the supplied
     dict. Only the command is split, dict values are not.
 
     We run to a staging tmp file and only if the result saves space
     do we copy it over the original and return True.
+
+    :param encodes: optional list to append a dict of this encode's
+        "engine_secs", "bytes_in", "bytes_out" and "accepted" to.
+    :param cache: optional EncodeCache, to skip an encode it knows won't
+        save space, and to note this one for it.
+    :param precheck: optional Precheck, to skip an encode it predicts won't
+        save space, unless auditing that prediction.
+    :param sibling: makes this encode a variant of sibling, as for
+        _keep_if_smaller. Precheck doesn't apply to variants.
     """
-    final_destination = f_str_vars["dest_img"]
-    tmp_name = "/tmp/staged_" + os.path.basename(final_destination)
-    f_str_vars["dest_img"] = tmp_name
-    split_cmd = cmn.split_fstring_not_args(f_str_vars, command)
-    cmn.run_shell_cmd(split_cmd)
-    existing_size = cmn.get_file_size(final_destination)
-    magicked_size = cmn.get_file_size(tmp_name)
-    if magicked_size < existing_size:
-        owner = cmn.get_file_owner(final_destination)
-        group = cmn.get_file_group(final_destination)
-        cmn.run_shell_cmd(["sudo", "mv", tmp_name, final_destination])
-        cmn.run_shell_cmd(["sudo", "chown", "{}:{}".format(owner, group), final_destination])
-        return magicked_size
-    cmn.run_shell_cmd(["rm", tmp_name])
-    return None
+    staged = _stage(f_str_vars, command, engine, encodes, cache, precheck,
+                    sibling)
+    if staged is None:
+        return None
+    try:
+        start = time.perf_counter()
+        engine.render(f_str_vars, command)
+        return _unstage(f_str_vars, command, staged, engine,
+                        time.perf_counter() - start, encodes, cache, sibling)
+    finally:
+        _discard(f_str_vars["dest_img"])
+
+
+def _magick_on_imgs(
+        src_img: str, outputs: List[Tuple[dict, str]],
+        engine=MagickEngine(),
+        encodes: Optional[List[dict]] = None,
+        cache: Optional[EncodeCache] = None,
+        precheck: Optional[Precheck] = None,
+        siblings: Optional[List[Optional[str]]] = None) -> \
+        List[Optional[int]]:
+    """
+    As _magick_on_img, but decoding src_img only once for every output.
+
+    Each output is a 2-tuple of its f-string vars, including its "dest_img",
+    and the command whose operators make it.
+
+    :param encodes: as for _magick_on_img, with one dict per output, which
+        share the engine's time equally.
+    :param cache: as for _magick_on_img. If it knows every output, src_img
+        isn't decoded at all.
+    :param precheck: as for _magick_on_img, likewise.
+    :param siblings: of each output, as for _magick_on_img, or None for
+        those which aren't variants.
+    :return: the new size of each output, in order, or None where that
+        didn't save space.
+    """
+    siblings = siblings or [None] * len(outputs)
+    staged = [_stage(f_str_vars, command, engine, encodes, cache, precheck,
+                     sibling)
+              for (f_str_vars, command), sibling in zip(outputs, siblings)]
+    to_make = [i for i, s in enumerate(staged) if s is not None]
+    new_sizes = [None] * len(outputs)
+    if not to_make:
+        return new_sizes
+    try:
+        start = time.perf_counter()
+        engine.render_many(src_img, [outputs[i] for i in to_make])
+        engine_secs = (time.perf_counter() - start) / len(to_make)
+        for i in to_make:
+            new_sizes[i] = _unstage(outputs[i][0], outputs[i][1], staged[i],
+                                    engine, engine_secs, encodes, cache,
+                                    siblings[i])
+    finally:
+        for i in to_make:
+            _discard(outputs[i][0]["dest_img"])
+    return new_sizes
 
 
-def _get_recorded_mtimes() -> Dict[str, float]:
-    inode_last_mtimes = {}
-    if os.path.exists(NV_RECORD_PATH):
-        with open(NV_RECORD_PATH, "r", newline='') as lmcv:
-            for row in csv.reader(lmcv):
-                inode_last_mtimes[row[0]] = float(row[1])
-    return inode_last_mtimes
+async def _magick_on_img_async(
+        f_str_vars: dict, command: str, slots: asyncio.Semaphore,
+        engine=MagickEngine(), encodes: Optional[List[dict]] = None,
+        cache: Optional[EncodeCache] = None,
+        precheck: Optional[Precheck] = None,
+        sibling: Optional[str] = None) -> Optional[int]:
+    """
+    As _magick_on_img, but rendering asynchronously, once one of slots is
+    free.
+    """
+    staged = _stage(f_str_vars, command, engine, encodes, cache, precheck,
+                    sibling)
+    if staged is None:
+        return None
+    try:
+        async with slots:
+            start = time.perf_counter()
+            await engine.render_async(f_str_vars, command)
+            engine_secs = time.perf_counter() - start
+        return _unstage(f_str_vars, command, staged, engine, engine_secs,
+                        encodes, cache, sibling)
+    finally:
+        _discard(f_str_vars["dest_img"])
 
 
-def _save_recorded_mtimes(recorded_mtimes: Dict[str, float]) -> None:
-    with open(NV_RECORD_PATH, "w", newline='') as lmcv:
-        ad_writer = csv.writer(lmcv)
-        for fl_nm, last_m in recorded_mtimes.items():
-            ad_writer.writerow([fl_nm, last_m])
+async def _magick_on_imgs_async(
+        src_img: str, outputs: List[Tuple[dict, str]],
+        slots: asyncio.Semaphore, engine=MagickEngine(),
+        encodes: Optional[List[dict]] = None,
+        cache: Optional[EncodeCache] = None,
+        precheck: Optional[Precheck] = None,
+        siblings: Optional[List[Optional[str]]] = None) -> \
+        List[Optional[int]]:
+    """
+    As _magick_on_imgs, but rendering asynchronously, once one of slots is
+    free.
+    """
+    siblings = siblings or [None] * len(outputs)
+    staged = [_stage(f_str_vars, command, engine, encodes, cache, precheck,
+                     sibling)
+              for (f_str_vars, command), sibling in zip(outputs, siblings)]
+    to_make = [i for i, s in enumerate(staged) if s is not None]
+    new_sizes = [None] * len(outputs)
+    if not to_make:
+        return new_sizes
+    try:
+        async with slots:
+            start = time.perf_counter()
+            await engine.render_many_async(
+                src_img, [outputs[i] for i in to_make])
+            engine_secs = (time.perf_counter() - start) / len(to_make)
+        for i in to_make:
+            new_sizes[i] = _unstage(outputs[i][0], outputs[i][1], staged[i],
+                                    engine, engine_secs, encodes, cache,
+                                    siblings[i])
+    finally:
+        for i in to_make:
+            _discard(outputs[i][0]["dest_img"])
+    return new_sizes
+
+
+def _is_variant(file_nm: str) -> bool:
+    """Whether file_nm is named as a variant, its sibling's name extended."""
+    parts = file_nm.split(".")
+    return len(parts) > 2 and parts[-1] in VARIANTS and \
+        parts[-2].lower() in VARIANT_SOURCES
+
+
+def _is_upload(file_nm: str) -> bool:
+    """
+    Whether file_nm could be an upload, or one of its sizes, rather than a
+    variant or one of our hidden staging files.
+    """
+    return file_nm.split(".")[-1] in IMG_EXTENSIONS and \
+        not _is_variant(file_nm) and not file_nm.startswith(".")
+
+
+def _list_dir(folder: str) -> Tuple[List[str], Dict[str, float]]:
+    """
+    :return: 2-tuple of the names of folder's subdirectories, and a map of
+        the names of the uploads in it to their mtimes.
+    """
+    subdirs = []
+    mtimes = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif _is_upload(entry.name):
+                mtimes[entry.name] = entry.stat().st_mtime
+    return subdirs, mtimes
+
+
+def _result_of(job: Tuple[str, str, dict], result: Callable[[], Any]):
+    """
+    :return: what result returns, for job, else None, logging why it
+        failed, so that one bad upload doesn't stop the rest being shrunk.
+    """
+    try:
+        return result()
+    except Exception:
+        print("Failed to shrink {}:".format(os.path.join(job[0], job[1])))
+        traceback.print_exc()
+        return None
 
 
 def _get_disk_sizes(metadata):
@@ -76,12 +449,81 @@ def _get_disk_sizes(metadata):
     return disk_sizes
 
 
+class DirsInProgress:
+    """
+    Directories listed, whose state is only recorded once every job in them
+    has been written back. Were it recorded sooner, and the run cut short,
+    the next would skip listing it and miss the jobs left undone.
+    """
+    def __init__(self):
+        self.outstanding: Dict[str, List] = {}
+        self.settled: List[DirState] = []
+        # Files listed which aren't attachments, to record as seen.
+        self.unattached: List[FileState] = []
+
+    def listed(self, subfolder: str, dir_state: Optional[DirState],
+               n_jobs: int):
+        """:param dir_state: None unless the directory has settled."""
+        if n_jobs:
+            self.outstanding[subfolder] = [dir_state, n_jobs]
+        elif dir_state is not None:
+            self.settled.append(dir_state)
+
+    def done(self, subfolder: str):
+        """Notes a job from the directory finished with."""
+        progress = self.outstanding[subfolder]
+        progress[1] -= 1
+        if not progress[1]:
+            del self.outstanding[subfolder]
+            if progress[0] is not None:
+                self.settled.append(progress[0])
+
+    def take_settled(self) -> List[DirState]:
+        """:return: those done with since last taken, to record."""
+        settled, self.settled = self.settled, []
+        return settled
+
+    def take_unattached(self) -> List[FileState]:
+        """:return: those found since last taken, to record."""
+        unattached, self.unattached = self.unattached, []
+        return unattached
+
+
 class ChangeManager:
-    def __init__(self, conf_location: str):
+    def __init__(self, conf_location: str, workers: Optional[int] = None,
+                 async_converts: Optional[int] = None, daemon: bool = False):
+        """
+        :param daemon: to stay resident, keeping what we have recorded in
+            memory between each time run_daemon polls.
+        """
         config = self.validate_config(conf_location)
         self.config = config["wp_server"]
         self.root_dir = self.config["wp_uploads"]
+        self.workers = workers or self.config.get("workers", 1)
+        self.async_converts = async_converts or self.config.get(
+            "async_converts", 0)
+        self.commit_every = self.config.get("commit_every", COMMIT_EVERY)
+        self.checkpoint_secs = self.config.get(
+            "checkpoint_secs", CHECKPOINT_SECS)
+        self.schedule = self.config.get("schedule", {})
+        self.engine = get_engine(
+            self.config.get("engine", "magick"), self.magick_limits())
         self.db = DBHandle(config["sql"])
+        self.max_encodes = self.config.get("encode_cache", 0)
+        self.state_path = self.config.get("state_db", NV_STATE_PATH)
+        self.poll_secs = self.config.get("poll_secs", POLL_SECS)
+        self.state = (ResidentStateStore if daemon else StateStore)(
+            self.state_path, max_encodes=self.max_encodes)
+        self.metrics = Metrics.from_config(self.config.get("metrics"))
+        self.precheck = Precheck.from_config(self.config.get("precheck"))
+        self.quality_search = QualitySearch.from_config(
+            self.config.get("quality_search"))
+        self.variants = self.config.get("variants", [])
+        for variant in self.variants:
+            if variant not in VARIANTS:
+                raise CompressorException(
+                    "Unknown variant \"{}\", expected any of: {}".format(
+                        variant, ", ".join(VARIANTS)))
         self.scaling_cmds = {
             "jpg": "convert -strip -resize {w}x{h} -quality {q}%"
                    " -interlace Plane -gaussian-blur 0.05 "
@@ -89,7 +531,9 @@ class ChangeManager:
             "png": "convert -strip -resize {w}x{h} -colors {q}"
                    " {src_img} {dest_img}",
             "webp": "convert -strip -resize {w}x{h} -define webp:method=6 "
-                    "-quality {q} {src_img} {dest_img}"
+                    "-quality {q} {src_img} {dest_img}",
+            "avif": "convert -strip -resize {w}x{h} -quality {q} "
+                    "{src_img} {dest_img}"
         }
         self.scaling_cmds["jpeg"] = self.scaling_cmds["jpg"]
         self.noresize_cmds = {k: v.replace(" -resize {w}x{h}", "")
@@ -111,112 +555,754 @@ class ChangeManager:
                         Path(conf_location).resolve()))
         return config
 
+    def __getstate__(self):
+        """
+        Workers in the pool receive a copy of us, but never the database
+        connection; that stays with the coordinating process.
+        """
+        state = self.__dict__.copy()
+        state["db"] = None
+        state["state"] = None
+        state["metrics"] = None
+        return state
+
     def __enter__(self):
         self.db.connect()
+        self.state.connect()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.state.close()
         self.db.disconnect()
 
-    def check_all_uploads(self):
+    def check_all_uploads(self, listings: Optional[Iterable[tuple]] = None):
         """
-        :param img_name: absolute or relative path of source image
-        :param conf_file: path to config json with keys "ssh" and "api".
-        :return:
+        Shrinks every original upload, and its downscales, which changed
+        since we last looked. The imaging, and the hashing of what it leaves,
+        may be spread over a pool of workers but the database and our record
+        of mtimes are only ever updated here, by the coordinating process.
+
+        Each stage streams into the next, so the first uploads are shrunk
+        while the scan continues. Results are checkpointed, written back,
+        every "commit_every" attachments or "checkpoint_secs" seconds, and
+        whatever finished when we are interrupted, so a run killed partway
+        through only redoes what it hadn't yet checkpointed. An attachment
+        which fails is logged and recorded as "failed", to be skipped until
+        it changes, rather than stopping the run, then every run after it,
+        at the same place.
+
+        :param listings: as yielded by scan_imgs, of only the directories
+            known to have changed, such as by scan_dirs, rather than scanning
+            them all.
         """
-        current_img_mtimes = self.stat_all_imgs()
-        recorded_mtimes = _get_recorded_mtimes()
-        # Capture detected changes in subdirectories, prior to query.
-        imgs_facts = self.sequester_data_by_rel_file_paths()
-        # This is still a point in time. But at least anything seen on
-        # our FS scan is more likely to be there than had we done the
-        # file scan later. Our output will update the FS anyway.
-        f_str_vars = {
-            "q": None,
-            "src_img": None,
-            "dest_img": None
-        }
-        any_change = False
+        dirs = DirsInProgress()
+        if listings is None:
+            listings = self.scan_imgs(self.state.get_dirs())
+        listings = self.metrics.timed_iter("scan", listings)
+        examined = []
+        updates = []
+        cached = []
+        n_examined = 0
+        checkpointed_at = time.monotonic()
 
-        for subfolder, mtimes in current_img_mtimes.items():
-            for file_nm, cur_m in mtimes.items():
+        try:
+            for job, result in self.run_jobs(
+                    self.match_jobs(listings, dirs)):
+                subfolder, file_nm, img_facts = job
                 rel_path_to_file = os.path.join(subfolder, file_nm)
-                img_facts = imgs_facts.get(rel_path_to_file)
-                last_m = recorded_mtimes.get(rel_path_to_file)
-                if not img_facts or not(last_m is None or last_m < cur_m):
-                    # If it isn't a named file, it's a resize, our output.
-                    # To proceed we shouldn't have recorded an mtime, or it
-                    # is behind that observed.
-                    continue
-                extension = rel_path_to_file.split(".")[-1]
-                megapix = img_facts["megapix"]
-                metadata = img_facts["metadata"]
-
-                f_str_vars["src_img"] = os.path.join(
-                    self.root_dir, rel_path_to_file)
-                f_str_vars["q"] = self.get_q(extension, megapix)
-
-                disk_sizes_0 = _get_disk_sizes(metadata)
-
-                latest_mtime: float = self.try_improve_downscales(
-                    extension, f_str_vars, metadata, subfolder)
-
-                f_str_vars["dest_img"] = f_str_vars["src_img"]
-                new_sz = _magick_on_img(
-                    f_str_vars, self.noresize_cmds[extension])
-                if new_sz is not None:
-                    latest_mtime = max(latest_mtime, os.stat(
-                        f_str_vars["src_img"]).st_mtime)
-                    metadata["filesize"] = new_sz
+                if result is None:
+                    self.metrics.count("attachments_failed")
+                    result = copy.deepcopy(img_facts["metadata"]), 0, [], \
+                        self.failed_states(rel_path_to_file)
+                metadata, latest_mtime, encodes, states = result
+                self.metrics.record_encodes(encodes)
+                cached += [e["cache"] for e in encodes if "cache" in e]
+                examined += states
+                n_examined += 1
+                dirs.done(subfolder)
+                # Sizes replaced by a run killed before it wrote them back.
+                self.reconcile_filesizes(metadata, subfolder)
                 if latest_mtime > 0:
+                    self.metrics.count("attachments_shrunk")
+                    disk_sizes_0 = _get_disk_sizes(img_facts["metadata"])
                     disk_sizes_1 = _get_disk_sizes(metadata)
-                    recorded_mtimes[rel_path_to_file] = latest_mtime
-                    any_change = True
-                    self.db.update_metadata(img_facts["id"], metadata)
                     # A print, potentially for logging.
                     print("Shrank {}kb to {}kb, re-scaling {}".format(
                         round(sum(disk_sizes_0.values()) / 1024),
                         round(sum(disk_sizes_1.values()) / 1024),
                         file_nm))
+                if metadata != img_facts["metadata"]:
+                    updates.append((img_facts["id"], metadata))
+                if n_examined >= self.commit_every or \
+                        time.monotonic() - checkpointed_at >= \
+                        self.checkpoint_secs:
+                    self.write_back(
+                        dirs.take_unattached() + examined, updates, cached,
+                        dirs.take_settled())
+                    examined, updates, cached = [], [], []
+                    n_examined = 0
+                    checkpointed_at = time.monotonic()
+        finally:
+            self.write_back(dirs.take_unattached() + examined, updates,
+                            cached, dirs.take_settled())
+        self.metrics.emit()
 
-        if any_change:
-            self.db.cnxn.commit()
-            _save_recorded_mtimes(recorded_mtimes)
+    def run_daemon(self):
+        """
+        Runs check_all_uploads every "poll_secs", until stopped. Staying
+        resident, we connect to the database, read the config and what we
+        have recorded only once, rather than every time. Each time gets its
+        own metrics. Stopping, as by SIGTERM, mid-run writes back whatever
+        has finished, as it does for a single run; between runs there is
+        nothing unwritten. A run that fails is logged and the next run
+        goes ahead as usual. Configuring "inotify" follows its changes
+        instead of polling.
+        """
+        feed = InotifyFeed.from_config(
+            self.root_dir, _is_upload, self.config.get("inotify"))
+        if feed is not None:
+            with feed:
+                self.follow_feed(feed)
+        while True:
+            started = time.monotonic()
+            self.metrics = Metrics.from_config(self.config.get("metrics"))
+            _survive(self.check_all_uploads)
+            time.sleep(max(0.0, self.poll_secs -
+                           (time.monotonic() - started)))
 
-    def try_improve_downscales(
+    def follow_feed(self, feed: InotifyFeed):
+        """
+        As run_daemon, but checking only the directories that feed reports
+        changed, as soon as they settle. Everything is checked at first,
+        then every "reconcile_secs", or as soon as feed loses track, for
+        whatever it didn't see. Should a check fail, everything is checked
+        again after "poll_secs", for whatever that left unchecked.
+        """
+        reconcile_at = time.monotonic()
+        while True:
+            if time.monotonic() >= reconcile_at:
+                self.metrics = Metrics.from_config(self.config.get("metrics"))
+                checked = _survive(self.check_all_uploads)
+                reconcile_at = time.monotonic() + (
+                    feed.reconcile_secs if checked else self.poll_secs)
+            changed = feed.changed_dirs(reconcile_at - time.monotonic())
+            if changed is None:
+                reconcile_at = time.monotonic()
+            elif changed:
+                self.metrics = Metrics.from_config(self.config.get("metrics"))
+                if not _survive(lambda: self.check_all_uploads(
+                        self.scan_dirs(sorted(changed)))):
+                    reconcile_at = min(reconcile_at,
+                                       time.monotonic() + self.poll_secs)
+
+    def reconcile_filesizes(self, metadata: dict, subfolder: str):
+        """
+        Corrects any "filesize" in metadata which disagrees with the file it
+        describes, as when a run is killed between replacing files and
+        writing back their metadata. Those without a "filesize", from before
+        WordPress 6.0, are left alone.
+        """
+        sizes = [(metadata, os.path.basename(metadata["file"]))]
+        sizes += [(resize, resize["file"])
+                  for resize in metadata["sizes"].values()]
+        for size, file_nm in sizes:
+            if "filesize" not in size:
+                continue
+            try:
+                on_disk = os.stat(
+                    os.path.join(self.root_dir, subfolder, file_nm)).st_size
+            except FileNotFoundError:
+                continue
+            if size["filesize"] != on_disk:
+                size["filesize"] = on_disk
+
+    def match_jobs(self, listings: Iterable[tuple],
+                   dirs: DirsInProgress) -> Iterator[Tuple[str, str, dict]]:
+        """
+        Yields a job for each original upload, in each directory listed,
+        which changed since we recorded it, with the facts of it from the
+        database. Only the metadata of those changed is fetched. Those
+        which aren't attachments, such as sizes we didn't make, are noted
+        in dirs, to be recorded and not looked up again until they change,
+        once DIR_SETTLE_SECS old. Until then, WordPress may yet be adding
+        the attachment.
+
+        :param listings: as yielded by scan_imgs.
+        :param dirs: told of each directory, and how many jobs it yields,
+            before they are yielded.
+        """
+        for subfolder, mtimes, dir_state in listings:
+            rel_paths = [os.path.join(subfolder, file_nm) for file_nm in mtimes]
+            recorded_mtimes = self.state.get_mtimes_for(rel_paths)
+            # To proceed we shouldn't have recorded an mtime, or it is
+            # behind that observed.
+            changed = [
+                rel_path for rel_path, cur_m in zip(rel_paths, mtimes.values())
+                if recorded_mtimes.get(rel_path) is None or
+                recorded_mtimes[rel_path] < cur_m]
+            imgs_facts = self.sequester_data_by_rel_file_paths(changed) \
+                if changed else {}
+            # If it isn't a named file, it's a resize, our output.
+            jobs = [
+                (subfolder, os.path.basename(rel_path), imgs_facts[rel_path])
+                for rel_path in changed if rel_path in imgs_facts]
+            observed = dict(zip(rel_paths, mtimes.values()))
+            settled_by = time.time() - DIR_SETTLE_SECS
+            dirs.unattached += [
+                FileState(rel_path, observed[rel_path], outcome="unattached")
+                for rel_path in changed if rel_path not in imgs_facts and
+                observed[rel_path] <= settled_by]
+            self.metrics.count("files_seen", len(mtimes))
+            self.metrics.count("files_changed", len(changed))
+            self.metrics.count("attachments", len(jobs))
+            dirs.listed(subfolder, dir_state, len(jobs))
+            yield from jobs
+
+    def write_back(self, examined: List[FileState],
+                   updates: List[Tuple[int, dict]],
+                   cached: List[Tuple[str, int]], settled: List[DirState]):
+        """
+        Updates the database with the new metadata, then records what we
+        examined. Should we die between the two, those attachments are only
+        examined again.
+        """
+        with self.metrics.timer("write_back"):
+            if updates:
+                self.db.update_filesizes_batch(updates, self.commit_every)
+            if examined or settled:
+                self.state.upsert(examined, settled, cached)
+
+    def state_of(self, rel_path_to_file: str, latest_mtime: float,
+                 outcome: str) -> FileState:
+        """
+        What we now know of an original upload, to skip it until it changes.
+        Its mtime is never earlier than that of any file we replaced for it.
+        """
+        abs_path = os.path.join(self.root_dir, rel_path_to_file)
+        st = os.stat(abs_path)
+        return FileState(
+            rel_path_to_file, max(latest_mtime, st.st_mtime), st.st_size,
+            st.st_ino, cmn.get_file_hash(abs_path), outcome)
+
+    def states_of(self, subfolder: str, file_nm: str, metadata: dict,
+                  latest_mtime: float, encodes: List[dict]) -> \
+            List[FileState]:
+        """
+        What we now know of an attachment, once shrunk, as shrink_attachment
+        returns it: of its original, its variants kept and its sizes.
+        """
+        return [self.state_of(os.path.join(subfolder, file_nm), latest_mtime,
+                              "shrunk" if latest_mtime > 0 else "kept")] + [
+            self.state_of(os.path.join(subfolder, e["file"]), 0, "variant")
+            for e in encodes if e.get("variant") and e["accepted"]] + \
+            self.size_states(subfolder, metadata)
+
+    def size_states(self, subfolder: str,
+                    metadata: dict) -> List[FileState]:
+        """
+        What we now know of an attachment's sizes, which aren't attachments
+        themselves, so that they aren't looked up as if they might be,
+        having been replaced, until they change again.
+        """
+        states = []
+        for file_nm in {resize["file"]
+                        for resize in metadata["sizes"].values()}:
+            rel_path = os.path.join(subfolder, file_nm)
+            try:
+                st = os.stat(os.path.join(self.root_dir, rel_path))
+            except FileNotFoundError:
+                continue
+            states.append(FileState(rel_path, st.st_mtime, st.st_size,
+                                    st.st_ino, outcome="size"))
+        return sorted(states)
+
+    def failed_states(self, rel_path_to_file: str) -> List[FileState]:
+        """
+        What we know of an original upload which failed to shrink, so that
+        it is skipped until it changes, unless it is gone.
+        """
+        try:
+            return [self.state_of(rel_path_to_file, 0, "failed")]
+        except FileNotFoundError:
+            return []
+
+    def run_jobs(self, jobs: Iterable[Tuple[str, str, dict]]):
+        """
+        Yields each job alongside its result from examine_attachment, or
+        None if it raised, as logged by _result_of, in order of completion. More than one worker spreads them over a pool
+        of processes, taking jobs only as there is room for them, so that
+        no more than IN_FLIGHT_PER_WORKER each are ever pending, and in the
+        order, and within the memory, of the "schedule" config.
+        Configuring "async_converts" runs them on an event loop instead.
+        """
+        if self.async_converts:
+            yield from self.run_jobs_async(jobs)
+            return
+        if self.workers <= 1:
+            for job in jobs:
+                with self.metrics.timer("imaging"):
+                    result = _result_of(
+                        job, lambda: self.examine_attachment(*job))
+                yield job, result
+            return
+        scheduler = self.scheduler(jobs, self.workers)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            while True:
+                for job in scheduler.admit():
+                    futures[executor.submit(
+                        self.examine_attachment, *job)] = job
+                if not futures:
+                    return
+                for job, result in self.completed(futures):
+                    scheduler.done(job)
+                    yield job, result
+
+    def completed(self, futures: Dict[Future, Tuple[str, str, dict]]):
+        """Waits for, then yields and forgets, any of the futures done."""
+        with self.metrics.timer("imaging"):
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            job = futures.pop(future)
+            yield job, _result_of(job, future.result)
+
+    def run_jobs_async(self, jobs: Iterable[Tuple[str, str, dict]]):
+        """
+        As run_jobs, but in this process, with up to "async_converts"
+        convert processes at a time awaited on an event loop. Jobs are taken
+        only as there is room for IN_FLIGHT_PER_WORKER per convert.
+
+        The loop only runs while we wait for a job to complete. Between
+        times, as we query the database and stat files for the next jobs,
+        and write back those done, the converts already started carry on.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        slots = asyncio.Semaphore(self.async_converts)
+        scheduler = self.scheduler(jobs, self.async_converts)
+        tasks = {}
+        try:
+            while True:
+                for job in scheduler.admit():
+                    tasks[loop.create_task(
+                        self.examine_attachment_async(*job, slots))] = job
+                if not tasks:
+                    return
+                for job, result in self.completed_tasks(loop, tasks):
+                    scheduler.done(job)
+                    yield job, result
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def completed_tasks(self, loop: asyncio.AbstractEventLoop,
+                        tasks: Dict[asyncio.Task, Tuple[str, str, dict]]):
+        """As completed, but running loop until any of tasks are done."""
+        with self.metrics.timer("imaging"):
+            done, _ = loop.run_until_complete(
+                asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED))
+        for task in done:
+            job = tasks.pop(task)
+            yield job, _result_of(job, task.result)
+
+    def scheduler(self, jobs: Iterable[Tuple[str, str, dict]],
+                  slots: int) -> JobScheduler:
+        """Of jobs, for slots running at once, IN_FLIGHT_PER_WORKER each."""
+        return JobScheduler.from_config(
+            jobs, slots * IN_FLIGHT_PER_WORKER, self.schedule)
+
+    def magick_limits(self) -> Optional[Dict[str, str]]:
+        """
+        Those configured, else each convert's share of the memory budget,
+        if there is one, and of the CPUs.
+        """
+        if "magick_limits" in self.schedule:
+            return self.schedule["magick_limits"]
+        if self.schedule.get("memory_mb"):
+            return magick_limits(self.schedule["memory_mb"],
+                                 self.async_converts or self.workers)
+        return None
+
+    def examine_attachment(
+            self, subfolder: str, file_nm: str, img_facts: dict) -> \
+            Tuple[dict, float, List[dict], List[FileState]]:
+        """
+        Shrinks one original upload and its downscales, as shrink_attachment,
+        then stats and hashes what that leaves, here in the worker, rather
+        than in the coordinating process, which need only record it.
+
+        :return: 4-tuple of shrink_attachment's, then, from states_of, what
+            we now know of its files.
+        """
+        metadata, latest_mtime, encodes = self.shrink_attachment(
+            subfolder, file_nm, img_facts)
+        return metadata, latest_mtime, encodes, self.states_of(
+            subfolder, file_nm, metadata, latest_mtime, encodes)
+
+    async def examine_attachment_async(
+            self, subfolder: str, file_nm: str, img_facts: dict,
+            slots: asyncio.Semaphore) -> \
+            Tuple[dict, float, List[dict], List[FileState]]:
+        """
+        As examine_attachment, but by shrink_attachment_async, hashing in a
+        thread, so that the event loop isn't held up meanwhile.
+        """
+        metadata, latest_mtime, encodes = await self.shrink_attachment_async(
+            subfolder, file_nm, img_facts, slots)
+        return metadata, latest_mtime, encodes, \
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.states_of, subfolder, file_nm, metadata,
+                latest_mtime, encodes)
+
+    def shrink_attachment(
+            self, subfolder: str, file_nm: str, img_facts: dict) -> \
+            Tuple[dict, float, List[dict]]:
+        """
+        Shrinks one original upload and its downscales.
+
+        Safe to run in a worker process; nothing here touches the database.
+
+        :return: 3-tuple of a copy of the metadata, with any new filesizes,
+            the latest mtime of any file replaced, else 0, and a dict for
+            each encode, as made by _magick_on_img.
+        """
+        extension, f_str_vars, metadata = self.attachment_vars(
+            subfolder, file_nm, img_facts)
+        encodes = []
+        with self.encode_cache() as cache:
+            self.search_q(extension, f_str_vars, encodes, cache)
+            if self.config.get("single_decode"):
+                return metadata, self.shrink_from_one_decode(
+                    extension, f_str_vars, metadata, subfolder, encodes,
+                    cache), encodes
+
+            latest_mtime: float = self.try_improve_downscales(
+                extension, f_str_vars, metadata, subfolder, encodes, cache)
+            plans = self.plan_all(extension, f_str_vars, metadata, subfolder)
+            _, full_vars, command = plans[-1]
+            new_sz = self.reencode_with_variants(
+                full_vars, command, self.plan_variants(plans, metadata),
+                encodes, cache)
+        if new_sz is not None:
+            latest_mtime = max(latest_mtime, os.stat(
+                f_str_vars["src_img"]).st_mtime)
+            metadata["filesize"] = new_sz
+        return metadata, latest_mtime, encodes
+
+    async def shrink_attachment_async(
+            self, subfolder: str, file_nm: str, img_facts: dict,
+            slots: asyncio.Semaphore) -> Tuple[dict, float, List[dict]]:
+        """
+        As shrink_attachment, but awaiting each convert in one of slots, so
+        that the downscales are made concurrently. The original is
+        re-encoded last, once nothing else is reading it, as for
+        reencode_with_variants.
+        """
+        extension, f_str_vars, metadata = self.attachment_vars(
+            subfolder, file_nm, img_facts)
+        encodes = []
+        with self.encode_cache() as cache:
+            if self.searches_q(extension) and \
+                    not self.reuse_q(extension, f_str_vars, encodes, cache):
+                async with slots:
+                    found = await asyncio.get_running_loop().run_in_executor(
+                        None, self.quality_search.timed_search,
+                        f_str_vars["src_img"], self.noresize_cmds[extension],
+                        self.engine, f_str_vars["q"])
+                self.found_q(extension, f_str_vars, encodes, cache, *found)
+            plans = self.plan_all(extension, f_str_vars, metadata, subfolder)
+            variants = self.plan_variants(plans, metadata)
+            abs_out_names = [out_vars["dest_img"] for _, out_vars, _ in plans]
+            if self.config.get("single_decode"):
+                new_fl_szs = await _magick_on_imgs_async(
+                    f_str_vars["src_img"],
+                    [(out_vars, command) for _, out_vars, command in plans] +
+                    [(out_vars, command) for out_vars, command, _ in variants],
+                    slots, self.engine, encodes, cache, self.precheck,
+                    [None] * len(plans) +
+                    [sibling for _, _, sibling in variants])
+            else:
+                new_fl_szs = list(await asyncio.gather(*[
+                    _magick_on_img_async(
+                        out_vars, command, slots, self.engine, encodes,
+                        cache, self.precheck)
+                    for _, out_vars, command in plans[:-1]]))
+                new_fl_szs.append(await self.reencode_with_variants_async(
+                    plans[-1][1], plans[-1][2], variants, slots, encodes,
+                    cache))
+        return metadata, self.apply_new_sizes(
+            plans, abs_out_names, new_fl_szs, metadata), encodes
+
+    def reencode_with_variants(
+            self, full_vars: dict, command: str,
+            variants: List[Tuple[dict, str, str]],
+            encodes: List[dict], cache: Optional[EncodeCache]) -> \
+            Optional[int]:
+        """
+        Re-encodes the original, as planned by plan_all, then makes the
+        variants, of it and its downscales, from that same decode of it. So
+        they come from the original as it was, but each is compared with
+        its sibling only once that is final.
+
+        :return: the new size of the original, if it was replaced.
+        """
+        if not variants:
+            return _magick_on_img(full_vars, command, self.engine, encodes,
+                                  cache, self.precheck)
+        return _magick_on_imgs(
+            full_vars["src_img"], [(full_vars, command)] +
+            [(out_vars, v_command) for out_vars, v_command, _ in variants],
+            self.engine, encodes, cache, self.precheck,
+            [None] + [sibling for _, _, sibling in variants])[0]
+
+    async def reencode_with_variants_async(
+            self, full_vars: dict, command: str,
+            variants: List[Tuple[dict, str, str]], slots: asyncio.Semaphore,
+            encodes: List[dict], cache: Optional[EncodeCache]) -> \
+            Optional[int]:
+        """As reencode_with_variants, awaiting the convert in one of slots."""
+        if not variants:
+            return await _magick_on_img_async(
+                full_vars, command, slots, self.engine, encodes, cache,
+                self.precheck)
+        return (await _magick_on_imgs_async(
+            full_vars["src_img"], [(full_vars, command)] +
+            [(out_vars, v_command) for out_vars, v_command, _ in variants],
+            slots, self.engine, encodes, cache, self.precheck,
+            [None] + [sibling for _, _, sibling in variants]))[0]
+
+    def attachment_vars(self, subfolder: str, file_nm: str,
+                        img_facts: dict) -> Tuple[str, dict, dict]:
+        """
+        :return: 3-tuple of the extension of the original, the f-string
+            vars common to all its encodes, and a copy of its metadata.
+        """
+        rel_path_to_file = os.path.join(subfolder, file_nm)
+        extension = rel_path_to_file.split(".")[-1]
+        f_str_vars = {
+            "q": self.get_q(extension, img_facts["megapix"]),
+            "src_img": os.path.join(self.root_dir, rel_path_to_file),
+            "dest_img": None
+        }
+        return extension, f_str_vars, copy.deepcopy(img_facts["metadata"])
+
+    def searches_q(self, extension: str) -> bool:
+        """Whether "quality_search" is configured, for this extension."""
+        return bool(self.quality_search) and \
+            extension.lower() in QualitySearch.EXTENSIONS
+
+    def search_q(self, extension: str, f_str_vars: dict,
+                 encodes: List[dict], cache: Optional[EncodeCache] = None):
+        """
+        Lowers the "q" in f_str_vars to the least meeting "quality_search",
+        if configured, reporting the search in encodes. The cache may know
+        it already, as it will of an original we re-encoded.
+        """
+        if not self.searches_q(extension) or \
+                self.reuse_q(extension, f_str_vars, encodes, cache):
+            return
+        self.found_q(extension, f_str_vars, encodes, cache,
+                     *self.quality_search.timed_search(
+                         f_str_vars["src_img"], self.noresize_cmds[extension],
+                         self.engine, f_str_vars["q"]))
+
+    def reuse_q(self, extension: str, f_str_vars: dict, encodes: List[dict],
+                cache: Optional[EncodeCache]) -> bool:
+        """
+        Takes the "q" of f_str_vars from the cache, without decoding
+        anything, if it has searched the original as it now is.
+
+        :return: whether it had.
+        """
+        if cache is None:
+            return False
+        q = cache.lookup_q(self.quality_search.settings,
+                           self.noresize_cmds[extension], f_str_vars)
+        if q is None:
+            return False
+        self.found_q(extension, f_str_vars, encodes, cache, q, {
+            "file": os.path.basename(f_str_vars["src_img"]),
+            "engine": self.engine.name, "q_search": 0, "cached": True,
+            "q": q, "max_q": f_str_vars["q"]})
+        return True
+
+    def found_q(self, extension: str, f_str_vars: dict, encodes: List[dict],
+                cache: Optional[EncodeCache], q: int, report: dict):
+        """Sets the "q" of f_str_vars, as reported, noting it in the cache."""
+        if cache is not None:
+            cache.note_q(report, self.quality_search.settings,
+                         self.noresize_cmds[extension], f_str_vars, q)
+        f_str_vars["q"] = q
+        encodes.append(report)
+
+    @contextmanager
+    def encode_cache(self):
+        """
+        Yields an EncodeCache for one attachment, if "encode_cache" is
+        configured, else None. Workers look it up in a read-only connection
+        of their own. Its entries are settled onto their encodes on leaving.
+        """
+        if not self.max_encodes:
+            yield None
+            return
+        state = self.state
+        if state is None:
+            state = StateStore(self.state_path)
+            state.connect(readonly=True)
+        try:
+            cache = EncodeCache(self.engine.name, state.get_encode_size)
+            yield cache
+            cache.settle()
+        finally:
+            if state is not self.state:
+                state.close()
+
+    def plan_downscales(
             self, extension: str, f_str_vars: dict, metadata: dict,
-            subfolder: str) -> float:
+            subfolder: str) -> List[Tuple[str, dict, str]]:
         """
-        Returns a dict of base file names to their sizes, if reduced.
+        :return: a 3-tuple for every label under "sizes", of the label,
+            its own copy of the f-string vars, and the command to make it.
         """
-        latest_mtime = 0
+        plans = []
         for label, resize in metadata["sizes"].items():
             # "full" is never a label under "sizes".
-            abs_out_name = os.path.join(
+            out_vars = dict(f_str_vars)
+            out_vars["w"] = resize["width"]
+            out_vars["h"] = resize["height"]
+            out_vars["dest_img"] = os.path.join(
                 self.root_dir, subfolder, resize["file"])
-            f_str_vars["w"] = resize["width"]
-            f_str_vars["h"] = resize["height"]
-            f_str_vars["dest_img"] = abs_out_name
             if label == "thumbnail":
                 scaler = ImgScaler(metadata["width"],
                                    metadata["height"])
                 w1, h1 = scaler.get_uncropped_thumb(resize["width"],
                                                     resize["height"])
-                f_str_vars["w1"] = w1
-                f_str_vars["h1"] = h1
-                new_fl_sz = _magick_on_img(
-                    f_str_vars, self.thumbnail_cmds[extension])
+                out_vars["w1"] = w1
+                out_vars["h1"] = h1
+                plans.append((label, out_vars, self.thumbnail_cmds[extension]))
             else:
-                new_fl_sz = _magick_on_img(
-                    f_str_vars, self.scaling_cmds[extension])
+                plans.append((label, out_vars, self.scaling_cmds[extension]))
+        return plans
+
+    def plan_all(
+            self, extension: str, f_str_vars: dict, metadata: dict,
+            subfolder: str) -> List[Tuple[str, dict, str]]:
+        """As plan_downscales, with a last plan, "full", of the original."""
+        plans = self.plan_downscales(
+            extension, f_str_vars, metadata, subfolder)
+        full_vars = dict(f_str_vars)
+        full_vars["dest_img"] = f_str_vars["src_img"]
+        plans.append(("full", full_vars, self.noresize_cmds[extension]))
+        return plans
+
+    def plan_variants(
+            self, plans: List[Tuple[str, dict, str]],
+            metadata: dict) -> List[Tuple[dict, str, str]]:
+        """
+        :param plans: as from plan_all, before any are staged.
+        :return: a 3-tuple for each of the "variants" of each file planned,
+            of its own f-string vars, the command to make it, and the file
+            it is a sibling of, whose name it extends.
+        """
+        variants = []
+        if not plans or \
+                plans[-1][1]["src_img"].split(".")[-1].lower() \
+                not in VARIANT_SOURCES:
+            return variants
+        megapix = metadata["width"] * metadata["height"] / 1_000_000
+        for variant in self.variants:
+            commands = {"thumbnail": self.thumbnail_cmds[variant],
+                        "full": self.noresize_cmds[variant]}
+            for label, out_vars, _ in plans:
+                variant_vars = dict(out_vars)
+                variant_vars["q"] = self.get_q(variant, megapix)
+                variant_vars["dest_img"] = out_vars["dest_img"] + "." + variant
+                variants.append((
+                    variant_vars,
+                    commands.get(label, self.scaling_cmds[variant]),
+                    out_vars["dest_img"]))
+        return variants
+
+    def try_improve_downscales(
+            self, extension: str, f_str_vars: dict, metadata: dict,
+            subfolder: str, encodes: Optional[List[dict]] = None,
+            cache: Optional[EncodeCache] = None) -> float:
+        """
+        Updates the filesize in metadata of each downscale we reduced.
+
+        :return: the latest mtime of any downscale replaced, else 0.
+        """
+        latest_mtime = 0
+        for label, out_vars, command in self.plan_downscales(
+                extension, f_str_vars, metadata, subfolder):
+            abs_out_name = out_vars["dest_img"]
+            new_fl_sz = _magick_on_img(
+                out_vars, command, self.engine, encodes, cache,
+                self.precheck)
             if new_fl_sz is not None:
                 metadata["sizes"][label]["filesize"] = new_fl_sz
                 latest_mtime = os.stat(abs_out_name).st_mtime
         return latest_mtime
 
-    def sequester_data_by_rel_file_paths(self) -> dict:
-        # These file names include only the path after "uploads".
-        metadata = self.db.query_media_metadata()
+    def shrink_from_one_decode(
+            self, extension: str, f_str_vars: dict, metadata: dict,
+            subfolder: str, encodes: Optional[List[dict]] = None,
+            cache: Optional[EncodeCache] = None) -> float:
+        """
+        As try_improve_downscales, but also re-encoding the original, and
+        making any variants, all from a single decode of it.
+
+        :return: the latest mtime of any file replaced, else 0.
+        """
+        plans = self.plan_all(extension, f_str_vars, metadata, subfolder)
+        variants = self.plan_variants(plans, metadata)
+        # Staging replaces each "dest_img", so we note them first.
+        abs_out_names = [out_vars["dest_img"] for _, out_vars, _ in plans]
+        new_fl_szs = _magick_on_imgs(
+            f_str_vars["src_img"],
+            [(out_vars, command) for _, out_vars, command in plans] +
+            [(out_vars, command) for out_vars, command, _ in variants],
+            self.engine, encodes, cache, self.precheck,
+            [None] * len(plans) + [sibling for _, _, sibling in variants])
+        return self.apply_new_sizes(
+            plans, abs_out_names, new_fl_szs, metadata)
+
+    @staticmethod
+    def apply_new_sizes(
+            plans: List[Tuple[str, dict, str]], abs_out_names: List[str],
+            new_fl_szs: List[Optional[int]], metadata: dict) -> float:
+        """
+        Updates the filesize in metadata of each planned output replaced.
+
+        :return: the latest mtime of any of them, else 0.
+        """
+        latest_mtime = 0
+        for (label, _, _), abs_out_name, new_fl_sz in zip(
+                plans, abs_out_names, new_fl_szs):
+            if new_fl_sz is None:
+                continue
+            if label == "full":
+                metadata["filesize"] = new_fl_sz
+            else:
+                metadata["sizes"][label]["filesize"] = new_fl_sz
+            latest_mtime = max(latest_mtime, os.stat(abs_out_name).st_mtime)
+        return latest_mtime
+
+    def sequester_data_by_rel_file_paths(self, rel_paths: List[str]) -> dict:
+        """
+        :param rel_paths: of the files, after "uploads", we want to know
+            about. Those which aren't attachments are absent from the result.
+        """
+        with self.metrics.timer("db_query"):
+            rows = self.db.fetch_media_metadata_for(rel_paths)
+        with self.metrics.timer("unserialize"):
+            metadata = [(meta_id, php_meta.loads(meta_value))
+                        for meta_id, meta_value in rows]
         img_facts = {}
         for media_meta in metadata:
             img_facts[media_meta[1]["file"]] = {
@@ -231,7 +1317,7 @@ class ChangeManager:
         if extension == "png":
             return self.config["png_q"]
         max_q = 10
-        if extension == "webp":
+        if extension in ("webp", "avif"):
             sorted_q = sorted(self.config["webp_mp_to_max_q"].items())
         else:
             sorted_q = sorted(self.config["jpg_mp_to_max_q"].items())
@@ -241,22 +1327,93 @@ class ChangeManager:
             max_q = q
         return max_q
 
-    def stat_all_imgs(self) -> Dict[str, Dict[str, float]]:
+    def scan_imgs(self, recorded_dirs: Dict[str, DirState]) -> \
+            Iterator[Tuple[str, Dict[str, float], Optional[DirState]]]:
         """
-        :return: relative directories mapping to maps of leaf file names
-            mapping to mtime floats
+        Stats the images in every directory whose own mtime differs from that
+        recorded. Those unchanged are not even listed; we only descend into
+        the subdirectories recorded for them, checking each one's mtime in
+        turn. This way a change anywhere is seen, not just at the root.
+
+        :param recorded_dirs: from the state store, by relative path.
+        :return: a 3-tuple for each directory as it is listed, of its
+            relative path, a map of its images' leaf file names to mtime
+            floats, and its state if now settled enough to record, else None.
         """
-        img_mtimes = {}
-        for folder, _, files in os.walk(self.root_dir):
-            if not files:
-                continue
+        settled_before = time.time() - DIR_SETTLE_SECS
+        pending = [self.root_dir]
+        while pending:
+            folder = pending.pop()
             subfolder = folder[len(self.root_dir):]
-            img_mtimes[subfolder] = {
-                f: os.stat(os.path.join(folder, f)).st_mtime
-                for f in files if f.split(".")[-1] in [
-                    "png", "webp", "jpg", "jpeg"]
-            }
-        return img_mtimes
+            try:
+                # Before listing, lest we record an mtime later than it.
+                dir_mtime = os.stat(folder).st_mtime
+            except FileNotFoundError:
+                continue
+            recorded = recorded_dirs.get(subfolder)
+            if recorded is not None and recorded.mtime == dir_mtime:
+                pending += [os.path.join(folder, d) for d in recorded.subdirs]
+                continue
+            subdirs, mtimes = _list_dir(folder)
+            dir_state = None
+            if dir_mtime < settled_before:
+                dir_state = DirState(subfolder, dir_mtime, sorted(subdirs))
+            pending += [os.path.join(folder, d) for d in subdirs]
+            yield subfolder, mtimes, dir_state
+
+    def scan_dirs(self, subfolders: Iterable[str]) -> \
+            Iterator[Tuple[str, Dict[str, float], Optional[DirState]]]:
+        """
+        As scan_imgs, but listing only subfolders, whatever their mtimes,
+        and not the directories under them.
+        """
+        settled_before = time.time() - DIR_SETTLE_SECS
+        for subfolder in subfolders:
+            folder = os.path.join(self.root_dir, subfolder)
+            try:
+                dir_mtime = os.stat(folder).st_mtime
+                subdirs, mtimes = _list_dir(folder)
+            except FileNotFoundError:
+                continue
+            dir_state = None
+            if dir_mtime < settled_before:
+                dir_state = DirState(subfolder, dir_mtime, sorted(subdirs))
+            yield subfolder, mtimes, dir_state
+
+
+def _escalate_once(args_list: List[str]):
+    """
+    Replaces this process with one run by sudo, once, at startup; rather
+    than running sudo for every file we replace.
+    """
+    if os.geteuid() != 0:
+        os.execvp("sudo", ["sudo", sys.executable,
+                           os.path.abspath(__file__)] + args_list)
+
+
+def _survive(check: Callable[[], None]) -> bool:
+    """
+    Runs check, one tick of a daemon, logging rather than raising any
+    failure, such as an upload deleted as we shrank it, so that the daemon
+    carries on. Only SystemExit and KeyboardInterrupt, not being Exceptions,
+    stop it. check_all_uploads has written back by the time we catch it.
+
+    :return: whether check succeeded.
+    """
+    try:
+        check()
+    except Exception:
+        traceback.print_exc()
+        return False
+    return True
+
+
+def _exit_on_sigterm(signum, frame):
+    """
+    As for Ctrl+C, unwinds, so that whatever has finished is written back
+    before systemd, or anything else, stops us.
+    """
+    raise SystemExit(128 + signum)
 
 
 def process_args(args_list: List[str]):
@@ -289,6 +1446,7 @@ Uses config.json:
       "2": 50,
       "4": 50
     },
+    "workers": 4
   }
 }
 
@@ -297,14 +1455,80 @@ Uses config.json:
 bounds, only key "0" is required. Images use the quality of the next key
 smaller than their MP.
 "jpg_mp_to_max_q": is the jpeg equivalent of "webp_mp_to_max_q".
+"workers": optional number of processes to shrink attachments in parallel,
+defaults to 1.
+"single_decode": optional, true to make every size, and re-encode the
+original, from one convert decoding the original only once.
+"engine": optional, "magick" (the default) to shell out to ImageMagick's
+convert, or "pillow" to run the same commands in-process with Pillow.
+"async_converts": optional, in place of "workers", how many converts to run
+at once from a single process, awaiting them on an event loop.
+"quality_search": optional, {"ssim": 0.95, "min_q": 30, "max_trials": 5,
+"tolerance": 2}. For jpg and webp, bisects for the lowest quality, up to
+that of the megapixel buckets, whose re-encode of the original keeps the
+target SSIM. Needs numpy and Pillow.
+"variants": optional, any of ["webp", "avif"]. Writes each size of a jpg or
+png upload, and the original, in these formats too, beside it, extending its
+name, as "f1-300x200.jpg.webp". Those not smaller than their sibling are
+discarded. The avif variants use the "webp_mp_to_max_q" qualities.
+"schedule": optional, {"memory_mb": 4096, "lookahead": 32, "magick_limits":
+{"memory": "1GiB", "map": "2GiB", "thread": "1"}}. Starts the largest of the
+next "lookahead" attachments first, within "memory_mb" of pixel cache, each
+megapixel costing 16MB. "magick_limits" defaults to each convert's share.
+"commit_every": optional, how many attachments' metadata to update in the
+database per transaction, defaulting to 100.
+"checkpoint_secs": optional, the longest to go without writing back what
+is done, defaulting to 60. SIGTERM also writes it back, before exiting.
+"poll_secs": optional, how often --daemon looks for uploads to shrink,
+defaulting to 300.
+"inotify": optional, {"settle_secs": 10, "reconcile_secs": 3600}. With
+--daemon, shrinks uploads as soon as inotify reports them written, and
+"settle_secs" pass without another, in place of polling. Everything is
+scanned every "reconcile_secs", for whatever inotify missed. Linux only.
+"state_db": optional path of the SQLite record of files examined, defaulting
+to "latest_mods.sqlite3". Any "latest_mods.csv" beside it is migrated.
+"encode_cache": optional, how many encodes known not to save space to keep
+in "state_db", keyed on content hashes, so they are skipped when only mtimes
+change. Defaults to 0, disabled.
+"precheck": optional, {"audit_rate": 0.05, "max_bpp": {extension: bits}}.
+Skips encodes predicted not to save space, by JPEG quantisation tables, PNG
+palette size and bits per pixel, encoding a fraction anyway as an audit.
+"metrics": optional, {"jsonl": path, "prometheus": path, "per_encode": bool}.
+Times each phase of a run, and counts encodes and bytes saved, appending a
+JSON line per run (and per encode) and/or rewriting a Prometheus textfile.
 """)
     parser.add_argument(
         "-c", "--config_file",
         help="Name of json file describing containing WordPress credentials.",
         default="config.json")
+    parser.add_argument(
+        "-w", "--workers", type=int,
+        help="Number of attachments to shrink in parallel, overriding "
+             "\"workers\" in the config.")
+    parser.add_argument(
+        "-a", "--async-converts", type=int,
+        help="Number of converts to await at once, from this one process, "
+             "overriding \"async_converts\" in the config.")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="Stay resident, shrinking uploads every \"poll_secs\", rather "
+             "than once, until stopped by SIGTERM.")
+    parser.add_argument(
+        "--sudo", action="store_true",
+        help="Re-run under sudo, unless already root, so that shrunk files "
+             "can be given back to their owners without running sudo for "
+             "each.")
     args = parser.parse_args(args_list)
-    with ChangeManager(args.config_file) as optimiser:
-        optimiser.check_all_uploads()
+    if args.sudo:
+        _escalate_once(args_list)
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    with ChangeManager(args.config_file, workers=args.workers,
+                       async_converts=args.async_converts,
+                       daemon=args.daemon) as optimiser:
+        if args.daemon:
+            optimiser.run_daemon()
+        else:
+            optimiser.check_all_uploads()
 
 
 def main(args_list: List[str]):
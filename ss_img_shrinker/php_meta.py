@@ -0,0 +1,270 @@
+"""
+Reads and writes WordPress's serialized "_wp_attachment_metadata" directly,
+as str, without phpserialize's detour through bytes.
+
+Only the top level keys we use are unserialized. The rest, such as
+"image_meta", which holds all of an original's EXIF, are merely skipped over
+and kept as they were serialized, to be written back byte for byte.
+
+PHP's string lengths count UTF-8 bytes, so parsing is over the encoded value.
+"""
+import math
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple, Union
+
+# The top level keys of attachment metadata that we read or write.
+METADATA_KEYS = ("file", "width", "height", "filesize", "sizes")
+
+Key = Union[int, str]
+
+
+class PhpObject(NamedTuple):
+    """
+    An object, such as a plugin may leave in "image_meta", of its class
+    name and its properties, to be written back as it was read.
+    """
+    name: str
+    properties: Dict[Key, Any]
+
+
+class PhpMetadata(dict):
+    """
+    Attachment metadata, holding only the keys unserialized. Those skipped
+    are unserialized on first being indexed, otherwise written back as read.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every top level key in the order read.
+        self.order = []
+        # Serialized values of the keys skipped.
+        self.raw: Dict[Key, bytes] = {}
+        # All of it, as read, for patch_filesizes.
+        self.source: Optional[str] = None
+
+    def __missing__(self, key: Key):
+        if key not in self.raw:
+            raise KeyError(key)
+        value = self[key] = _parse(self.raw[key], 0)[0]
+        return value
+
+
+def _int_until(data: bytes, i: int, end: bytes) -> Tuple[int, int]:
+    j = data.index(end, i)
+    return int(data[i:j]), j + 1
+
+
+def _parse(data: bytes, i: int) -> Tuple[Any, int]:
+    """:return: 2-tuple of the value serialized at i and the index after."""
+    kind = data[i:i + 1]
+    if kind == b"s":
+        length, start = _int_until(data, i + 2, b":")
+        end = start + 1 + length
+        return data[start + 1:end].decode(), end + 2
+    if kind == b"i":
+        return _int_until(data, i + 2, b";")
+    if kind in (b"a", b"O"):
+        if kind == b"O":
+            length, start = _int_until(data, i + 2, b":")
+            name = data[start + 1:start + 1 + length].decode()
+            i = start + length + 1
+        length, i = _int_until(data, i + 2, b":")
+        i += 1
+        array = {}
+        for _ in range(length):
+            key, i = _parse(data, i)
+            array[key], i = _parse(data, i)
+        if kind == b"O":
+            return PhpObject(name, array), i + 1
+        return array, i + 1
+    if kind == b"b":
+        return data[i + 2:i + 3] == b"1", i + 4
+    if kind == b"d":
+        j = data.index(b";", i + 2)
+        return float(data[i + 2:j].replace(b"INF", b"inf")), j + 1
+    if kind == b"N":
+        return None, i + 2
+    raise ValueError("Unsupported PHP serialized type {!r} at {}".format(
+        kind, i))
+
+
+def _skip(data: bytes, i: int) -> int:
+    """As _parse, but only returning the index after the value at i."""
+    kind = data[i:i + 1]
+    if kind == b"s":
+        length, start = _int_until(data, i + 2, b":")
+        return start + length + 3
+    if kind in (b"a", b"O"):
+        if kind == b"O":
+            # Skipping its class name, an object is an array of properties.
+            length, start = _int_until(data, i + 2, b":")
+            i = start + length + 1
+        length, i = _int_until(data, i + 2, b":")
+        i += 1
+        for _ in range(2 * length):
+            i = _skip(data, i)
+        return i + 1
+    if kind == b"N":
+        return i + 2
+    if kind in (b"i", b"b", b"d"):
+        return data.index(b";", i + 2) + 1
+    raise ValueError("Unsupported PHP serialized type {!r} at {}".format(
+        kind, i))
+
+
+def loads(serialized: str,
+          keys: Optional[Iterable[Key]] = METADATA_KEYS) -> PhpMetadata:
+    """
+    :param serialized: an array, as PHP serializes it.
+    :param keys: the top level keys to unserialize, skipping the rest, or
+        None to unserialize them all.
+    """
+    data = serialized.encode()
+    if data[:2] != b"a:":
+        raise ValueError("Serialized metadata isn't an array")
+    keys = None if keys is None else set(keys)
+    metadata = PhpMetadata()
+    metadata.source = serialized
+    length, i = _int_until(data, 2, b":")
+    i += 1
+    for _ in range(length):
+        key, i = _parse(data, i)
+        metadata.order.append(key)
+        if keys is None or key in keys:
+            metadata[key], i = _parse(data, i)
+        else:
+            end = _skip(data, i)
+            metadata.raw[key] = data[i:end]
+            i = end
+    return metadata
+
+
+def _dump(value: Any, out: list):
+    if isinstance(value, str):
+        encoded = value.encode()
+        out.append(b's:%d:"%s";' % (len(encoded), encoded))
+    elif isinstance(value, bool):
+        out.append(b"b:1;" if value else b"b:0;")
+    elif isinstance(value, int):
+        out.append(b"i:%d;" % value)
+    elif isinstance(value, float):
+        out.append(b"d:%s;" % _php_float(value))
+    elif value is None:
+        out.append(b"N;")
+    elif isinstance(value, PhpObject):
+        name = value.name.encode()
+        out.append(b'O:%d:"%s":%d:{' % (
+            len(name), name, len(value.properties)))
+        for k, v in value.properties.items():
+            _dump(k, out)
+            _dump(v, out)
+        out.append(b"}")
+    elif isinstance(value, (dict, list, tuple)):
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        out.append(b"a:%d:{" % len(value))
+        for k, v in items:
+            _dump(k, out)
+            _dump(v, out)
+        out.append(b"}")
+    else:
+        raise TypeError("Can't serialize {!r} for PHP".format(value))
+
+
+def _php_float(value: float) -> bytes:
+    if math.isnan(value):
+        return b"NAN"
+    if math.isinf(value):
+        return b"INF" if value > 0 else b"-INF"
+    if value.is_integer() and abs(value) < 1e15:
+        return b"%d" % value
+    return repr(value).encode()
+
+
+def dumps(metadata: dict) -> str:
+    """
+    Serializes metadata as PHP would, writing back the keys of PhpMetadata
+    that were skipped exactly as they were read.
+    """
+    out = []
+    order = getattr(metadata, "order", [])
+    raw = getattr(metadata, "raw", {})
+    written = 0
+    for key in order:
+        if key in metadata:
+            _dump(key, out)
+            _dump(metadata[key], out)
+        elif key in raw:
+            _dump(key, out)
+            out.append(raw[key])
+        else:
+            continue
+        written += 1
+    seen = set(order)
+    for key, value in metadata.items():
+        if key not in seen:
+            _dump(key, out)
+            _dump(value, out)
+            written += 1
+    return (b"a:%d:{" % written + b"".join(out) + b"}").decode()
+
+
+def _filesize_edits(data: bytes, i: int, size: dict, edits: list,
+                    sizes: Optional[dict] = None) -> int:
+    """
+    Appends to edits the (start, end, replacement) of the array at i, so
+    that its "filesize" is that of size, descending into its "sizes" if
+    given them.
+
+    :return: the index after the array.
+    """
+    start = i
+    length, i = _int_until(data, i + 2, b":")
+    i += 1
+    has_filesize = False
+    for _ in range(length):
+        key, i = _parse(data, i)
+        end = _skip(data, i)
+        if key == "filesize" and "filesize" in size:
+            has_filesize = True
+            filesize = b"i:%d;" % size["filesize"]
+            if data[i:end] != filesize:
+                edits.append((i, end, filesize))
+        elif key == "sizes" and sizes is not None:
+            n_sizes, j = _int_until(data, i + 2, b":")
+            if n_sizes != len(sizes):
+                raise KeyError("sizes")
+            j += 1
+            for _ in range(n_sizes):
+                label, j = _parse(data, j)
+                j = _filesize_edits(data, j, sizes[label], edits)
+        i = end
+    if "filesize" in size and not has_filesize:
+        edits.append((i, i, b's:8:"filesize";i:%d;' % size["filesize"]))
+        edits.append((start + 2, start + 2 + len(str(length)),
+                      b"%d" % (length + 1)))
+    return i + 1
+
+
+def patch_filesizes(metadata: PhpMetadata) -> str:
+    """
+    Serializes metadata by editing only the "filesize" of it, and of each of
+    its sizes, into the source it was read from, as the optimiser changes
+    nothing else. A "filesize" it lacked is added. Other changes are assumed
+    not to have been made, though if its sizes differ in number, or by
+    label, or it has no source, it is serialized whole by dumps instead.
+    """
+    if getattr(metadata, "source", None) is None:
+        return dumps(metadata)
+    data = metadata.source.encode()
+    edits = []
+    try:
+        _filesize_edits(data, 0, metadata, edits, metadata["sizes"])
+    except KeyError:
+        return dumps(metadata)
+    if not edits:
+        return metadata.source
+    patched = []
+    copied = 0
+    for start, end, replacement in sorted(edits):
+        patched += [data[copied:start], replacement]
+        copied = end
+    patched.append(data[copied:])
+    return b"".join(patched).decode()
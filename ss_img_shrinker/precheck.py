@@ -0,0 +1,142 @@
+"""
+A cheap guess, from its header and size alone, that an existing image is
+already smaller than anything we could encode in its place.
+
+A JPEG whose quantisation tables show it was saved at no more than our
+quality, or a PNG whose palette has no more colours than "png_q", is
+unlikely to shrink. Nor, optionally, is anything already below a number of
+bits per pixel. A fraction of those predicted are encoded anyway, as an
+audit, so that the rate of false predictions can be measured.
+"""
+import os
+import random
+import struct
+from typing import Dict, List, Optional
+
+import common_funcs as cmn
+
+# The luminance table of the IJG's libjpeg, at quality 50, which its
+# "-quality" scales. Order doesn't matter to us, so neither does zigzag.
+IJG_LUMINANCE = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+]
+DEFAULT_AUDIT_RATE = 0.05
+
+
+def _jpeg_luminance_table(file_name: str) -> Optional[List[int]]:
+    with open(file_name, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return None
+        for marker, length in cmn.jpeg_segments(f):
+            if marker != 0xdb:
+                continue
+            # One or more tables, each a byte of precision and id, then 64
+            # values, of 8 bits or 16.
+            payload = f.read(length)
+            i = 0
+            while i < len(payload):
+                precision, table_id = payload[i] >> 4, payload[i] & 0x0f
+                size = 128 if precision else 64
+                values = payload[i + 1:i + 1 + size]
+                if table_id == 0 and len(values) == size:
+                    if precision:
+                        return list(struct.unpack(">64H", values))
+                    return list(values)
+                i += 1 + size
+    return None
+
+
+def jpeg_quality(file_name: str) -> Optional[int]:
+    """
+    Estimates the "-quality" a JPEG was saved at, by how much its luminance
+    table is scaled from libjpeg's. Encoders other than libjpeg, with tables
+    of their own, are only approximated.
+    """
+    table = _jpeg_luminance_table(file_name)
+    if table is None:
+        return None
+    scale = sum(table) * 100 / sum(IJG_LUMINANCE)
+    if scale <= 100:
+        quality = (200 - scale) / 2
+    else:
+        quality = 5000 / scale
+    return max(1, min(100, round(quality)))
+
+
+def png_palette_size(file_name: str) -> Optional[int]:
+    """The number of colours in a PNG's palette, None if it has none."""
+    with open(file_name, "rb") as f:
+        header = f.read(33)
+        if len(header) < 33 or header[12:16] != b"IHDR" or header[25] != 3:
+            return None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            length, chunk_type = struct.unpack(">I4s", chunk)
+            if chunk_type == b"PLTE":
+                return length // 3
+            if chunk_type in (b"IDAT", b"IEND"):
+                return None
+            f.seek(length + 4, os.SEEK_CUR)
+
+
+def bits_per_pixel(file_name: str) -> Optional[float]:
+    wxh = cmn.read_img_header_wxh(file_name)
+    if not wxh or not wxh[0] or not wxh[1]:
+        return None
+    return os.path.getsize(file_name) * 8 / (wxh[0] * wxh[1])
+
+
+class Precheck:
+    def __init__(self, audit_rate: float = DEFAULT_AUDIT_RATE,
+                 max_bpp: Optional[Dict[str, float]] = None):
+        """
+        :param audit_rate: fraction of predicted encodes to make anyway.
+        :param max_bpp: map of extensions to the bits per pixel below which
+            an image of that type is predicted not to shrink.
+        """
+        self.audit_rate = audit_rate
+        self.max_bpp = max_bpp or {}
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]):
+        """:param config: the optional "precheck" key of "wp_server"."""
+        if config is None:
+            return None
+        return cls(config.get("audit_rate", DEFAULT_AUDIT_RATE),
+                   config.get("max_bpp"))
+
+    def predict_no_saving(self, f_str_vars: dict) -> Optional[str]:
+        """
+        :param f_str_vars: of the encode, whose "dest_img" is the existing
+            image it would replace.
+        :return: why the encode is unlikely to save space, else None.
+        """
+        dest_img = f_str_vars["dest_img"]
+        extension = dest_img.split(".")[-1].lower()
+        if extension in ("jpg", "jpeg"):
+            quality = jpeg_quality(dest_img)
+            if quality is not None and quality <= f_str_vars["q"]:
+                return "jpeg_quality"
+        elif extension == "png":
+            colours = png_palette_size(dest_img)
+            if colours is not None and colours <= f_str_vars["q"]:
+                return "png_palette"
+        max_bpp = self.max_bpp.get(extension)
+        if max_bpp is not None:
+            bpp = bits_per_pixel(dest_img)
+            if bpp is not None and bpp < max_bpp:
+                return "bpp"
+        return None
+
+    def audit(self) -> bool:
+        """:return: True if a predicted encode should be made anyway."""
+        return random.random() < self.audit_rate
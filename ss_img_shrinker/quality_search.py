@@ -0,0 +1,144 @@
+"""
+Finds, per attachment, the lowest quality whose encode still looks like the
+original, rather than taking it from the megapixel buckets of
+"jpg_mp_to_max_q" and "webp_mp_to_max_q", which remain its ceiling.
+
+Likeness is the mean SSIM of luminance, computed in-process over uniform
+windows. The original is decoded once, as the reference for every trial
+encode, and the search is a bisection, bounded in trials.
+"""
+import os
+import tempfile
+import time
+from typing import Optional, Tuple
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+    Image = None
+
+DEFAULT_SSIM = 0.95
+DEFAULT_MIN_Q = 30
+DEFAULT_MAX_TRIALS = 5
+DEFAULT_TOLERANCE = 2
+# Stabilise SSIM's ratios for 8 bit samples, as in Wang et al.
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_WINDOW = 7
+
+
+class QualitySearchException(Exception):
+    pass
+
+
+def _window_means(x, n: int):
+    """The mean of every n x n window of x, by summed area table."""
+    table = np.pad(x.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    return (table[n:, n:] - table[:-n, n:] - table[n:, :-n] +
+            table[:-n, :-n]) / (n * n)
+
+
+def ssim(a, b, window: int = SSIM_WINDOW) -> float:
+    """
+    Mean structural similarity of two luminance arrays of the same shape,
+    1.0 only if they are identical.
+    """
+    window = max(1, min(window, *a.shape))
+    mu_a = _window_means(a, window)
+    mu_b = _window_means(b, window)
+    var_a = _window_means(a * a, window) - mu_a ** 2
+    var_b = _window_means(b * b, window) - mu_b ** 2
+    cov = _window_means(a * b, window) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + SSIM_C1) * (2 * cov + SSIM_C2)) / \
+               ((mu_a ** 2 + mu_b ** 2 + SSIM_C1) * (var_a + var_b + SSIM_C2))
+    return float(ssim_map.mean())
+
+
+def luminance(file_name: str):
+    with Image.open(file_name) as img:
+        return np.asarray(img.convert("L"), dtype=np.float64)
+
+
+class QualitySearch:
+    # Only their "q" is a quality; png's is a number of colours.
+    EXTENSIONS = ("jpg", "jpeg", "webp")
+
+    def __init__(self, target: float = DEFAULT_SSIM,
+                 min_q: int = DEFAULT_MIN_Q,
+                 max_trials: int = DEFAULT_MAX_TRIALS,
+                 tolerance: int = DEFAULT_TOLERANCE):
+        """
+        :param target: the least SSIM, against the original, to accept.
+        :param min_q: the lowest quality to consider.
+        :param max_trials: the most encodes to try per attachment.
+        :param tolerance: stop once the quality is known to within this.
+        """
+        if np is None or Image is None:
+            raise QualitySearchException(
+                "\"quality_search\" requires numpy and Pillow to be "
+                "installed.")
+        self.target = target
+        self.min_q = min_q
+        self.max_trials = max_trials
+        self.tolerance = tolerance
+
+    @property
+    def settings(self) -> dict:
+        """Those which, besides the original and max_q, decide the quality."""
+        return {"ssim": self.target, "min_q": self.min_q,
+                "max_trials": self.max_trials, "tolerance": self.tolerance}
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]):
+        """:param config: the optional "quality_search" key of "wp_server"."""
+        if config is None:
+            return None
+        return cls(config.get("ssim", DEFAULT_SSIM),
+                   config.get("min_q", DEFAULT_MIN_Q),
+                   config.get("max_trials", DEFAULT_MAX_TRIALS),
+                   config.get("tolerance", DEFAULT_TOLERANCE))
+
+    def search(self, src_img: str, command: str, engine,
+               max_q: int) -> Tuple[int, int]:
+        """
+        Bisects for the lowest quality, up to max_q, at which command
+        re-encodes src_img with at least the target SSIM. Quality is assumed
+        to only ever improve likeness. max_q itself is never tried, since
+        it is used whether or not it meets the target.
+
+        :param command: re-encodes, without resizing, at "{q}".
+        :return: 2-tuple of the quality found and the encodes tried.
+        """
+        reference = luminance(src_img)
+        extension = src_img.split(".")[-1]
+        lo, hi = self.min_q - 1, max_q
+        trials = 0
+        with tempfile.TemporaryDirectory() as trial_dir:
+            trial_img = os.path.join(trial_dir, "trial." + extension)
+            while trials < self.max_trials and hi - lo > self.tolerance:
+                q = (lo + hi) // 2
+                engine.render({"q": q, "src_img": src_img,
+                               "dest_img": trial_img}, command)
+                trials += 1
+                trial = luminance(trial_img)
+                if trial.shape == reference.shape and \
+                        ssim(reference, trial) >= self.target:
+                    hi = q
+                else:
+                    lo = q
+        return hi, trials
+
+    def timed_search(self, src_img: str, command: str, engine,
+                     max_q: int) -> Tuple[int, dict]:
+        """
+        As search, also returning a dict reporting it, for Metrics, of its
+        "q_search" trials, their "engine_secs", and the "q" found.
+        """
+        start = time.perf_counter()
+        q, trials = self.search(src_img, command, engine, max_q)
+        return q, {"file": os.path.basename(src_img), "engine": engine.name,
+                   "q_search": trials,
+                   "engine_secs": time.perf_counter() - start,
+                   "q": q, "max_q": max_q}
@@ -1,7 +1,15 @@
 from decimal import Decimal, ROUND_HALF_UP
-from typing import List, Tuple, Any, Dict, Optional
+from typing import List, Tuple, Any, Dict, Optional, NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DimsList = List[Tuple[int, int]]
+MED_LARGE_W = 768
+# The sizes of WordPress v.5.3 on, beyond those of the media settings.
+EXTRA_BOXES = {"1536x1536": (1536, 1536), "2048x2048": (2048, 2048)}
 
 
 class ResolutionsList(list):
@@ -55,7 +63,6 @@ class ImgScaler:
         :return: 2-tuple of generated sizes and a separate thumbnail size, if
             applicable, because that is zoom cropped unlike the rest.
         """
-        MED_LARGE_W = 768
         w_hs = ResolutionsList()
         # 768 isn't optional!
         if self.src_w > MED_LARGE_W:
@@ -126,3 +133,74 @@ class ImgScaler:
     def fix_width(self, fixed_width: int) -> Tuple[int, int]:
         return fixed_width, ResolutionsList.round(
             float(self.src_h) * fixed_width / self.src_w)
+
+
+class BatchSizes(NamedTuple):
+    """One size, for every source of a batch; only where "valid" is made."""
+    w: Any
+    h: Any
+    valid: Any
+
+
+def round_half_up(a):
+    """
+    As ResolutionsList.round, over a numpy array of floats, exactly: no
+    float is nudged across a half by adding 0.5 to it. Its fraction, taken
+    from its floor, is exact, being within a factor of two of it.
+    """
+    magnitude = np.abs(a)
+    floor = np.floor(magnitude)
+    rounded = floor + (magnitude - floor >= 0.5)
+    return (np.sign(a) * rounded).astype(np.int64)
+
+
+def _bounded_by(src_w, src_h, max_w: int, max_h: int) -> BatchSizes:
+    """As ImgScaler.add_scaled_size_bounded_by, for every source at once."""
+    constraint = np.maximum(src_w / max_w, src_h / max_h)
+    return BatchSizes(round_half_up(src_w / constraint),
+                      round_half_up(src_h / constraint),
+                      (src_w > max_w) | (src_h > max_h))
+
+
+def plan_batch(src_ws, src_hs, med_w: int = 300, med_h: int = 300,
+               large_w: int = 1024, large_h: int = 1024,
+               thumb_w: int = 150, thumb_h: int = 150) -> \
+        Dict[str, BatchSizes]:
+    """
+    ImgScaler's sizes, for arrays of source widths and heights, at once.
+    Each is identical to those of ImgScaler, computed by the same float
+    operations, then rounded exactly as ResolutionsList.round.
+
+    :return: map of WordPress's labels for the sizes, and of
+        "thumbnail_uncropped", for get_uncropped_thumb of the thumbnail, to
+        each one's dimensions across the batch.
+    """
+    if np is None:
+        raise ImportError("plan_batch requires numpy to be installed.")
+    src_w = np.asarray(src_ws, dtype=np.float64)
+    src_h = np.asarray(src_hs, dtype=np.float64)
+    sizes = {
+        "medium_large": BatchSizes(
+            np.full(src_w.shape, MED_LARGE_W, dtype=np.int64),
+            round_half_up(src_h * MED_LARGE_W / src_w),
+            src_w > MED_LARGE_W),
+        "medium": _bounded_by(src_w, src_h, med_w, med_h),
+        "large": _bounded_by(src_w, src_h, large_w, large_h),
+    }
+    for label, (max_w, max_h) in EXTRA_BOXES.items():
+        sizes[label] = _bounded_by(src_w, src_h, max_w, max_h)
+    final_w = np.minimum(thumb_w, src_w)
+    final_h = np.minimum(thumb_h, src_h)
+    has_thumb = (src_w >= thumb_w) | (src_h >= thumb_h)
+    sizes["thumbnail"] = BatchSizes(final_w.astype(np.int64),
+                                    final_h.astype(np.int64), has_thumb)
+    # Sources at or within the thumbnail, on either side, aren't scaled.
+    constraint = np.minimum(src_w / final_w, src_h / final_h)
+    scaled = (src_w > final_w) & (src_h > final_h)
+    sizes["thumbnail_uncropped"] = BatchSizes(
+        np.where(scaled, round_half_up(src_w / constraint),
+                 src_w.astype(np.int64)),
+        np.where(scaled, round_half_up(src_h / constraint),
+                 src_h.astype(np.int64)),
+        has_thumb)
+    return sizes
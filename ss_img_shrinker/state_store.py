@@ -0,0 +1,222 @@
+"""
+Our record of every file we have examined, in SQLite.
+
+This replaced "latest_mods.csv", which held only an mtime per relative path
+and was rewritten whole on every run. That CSV is migrated automatically,
+the first time the store is opened beside it.
+"""
+import csv
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+NV_RECORD_PATH = "latest_mods.csv"
+NV_STATE_PATH = "latest_mods.sqlite3"
+# Within SQLite's default limit of 999 variables per statement.
+IN_BATCH_SIZE = 500
+
+
+class FileState(NamedTuple):
+    """What we last saw of a file, keyed on its path under "wp_uploads"."""
+    rel_path: str
+    mtime: float
+    size: Optional[int] = None
+    inode: Optional[int] = None
+    content_hash: Optional[str] = None
+    # "shrunk" if we replaced any of its files, "failed" if that raised,
+    # else "kept".
+    outcome: Optional[str] = None
+
+
+class DirState(NamedTuple):
+    """
+    A directory's own mtime and the names of its subdirectories at that
+    mtime. Until its mtime changes, neither can its list of entries.
+    """
+    rel_path: str
+    mtime: float
+    subdirs: List[str]
+
+
+def _read_csv_mtimes(csv_path: str) -> Dict[str, float]:
+    inode_last_mtimes = {}
+    if os.path.exists(csv_path):
+        with open(csv_path, "r", newline='') as lmcv:
+            for row in csv.reader(lmcv):
+                inode_last_mtimes[row[0]] = float(row[1])
+    return inode_last_mtimes
+
+
+class StateStore:
+    def __init__(self, path: str = NV_STATE_PATH,
+                 csv_path: Optional[str] = None, max_encodes: int = 0):
+        """
+        :param csv_path: of a legacy CSV record to migrate, by default
+            "latest_mods.csv" beside path.
+        :param max_encodes: how many cached encodes to keep, the least
+            recently used being evicted first.
+        """
+        self.path = path
+        self.csv_path = csv_path or os.path.join(
+            os.path.dirname(path), NV_RECORD_PATH)
+        self.max_encodes = max_encodes
+        self.cnxn = None
+
+    def connect(self, readonly: bool = False):
+        """
+        :param readonly: for workers, only to look up cached encodes, in a
+            store the coordinating process has already created.
+        """
+        if readonly:
+            self.cnxn = sqlite3.connect("{}?mode=ro".format(
+                Path(os.path.abspath(self.path)).as_uri()), uri=True)
+            return
+        self.cnxn = sqlite3.connect(self.path)
+        # A crash mid-write leaves the previous state intact.
+        self.cnxn.execute("PRAGMA journal_mode=WAL")
+        with self.cnxn:
+            self.cnxn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "rel_path TEXT PRIMARY KEY, mtime REAL NOT NULL, "
+                "size INTEGER, inode INTEGER, content_hash TEXT, outcome TEXT)")
+            self.cnxn.execute(
+                "CREATE TABLE IF NOT EXISTS dirs ("
+                "rel_path TEXT PRIMARY KEY, mtime REAL NOT NULL, "
+                "subdirs TEXT NOT NULL)")
+            self.cnxn.execute(
+                "CREATE TABLE IF NOT EXISTS encodes ("
+                "key TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "used REAL NOT NULL)")
+        self.migrate_csv()
+
+    def migrate_csv(self):
+        """
+        Imports the mtimes of a legacy CSV record, if there is one, which is
+        then renamed so that it is only ever imported once.
+        """
+        if not os.path.exists(self.csv_path):
+            return
+        mtimes = _read_csv_mtimes(self.csv_path)
+        with self.cnxn:
+            self.cnxn.executemany(
+                "INSERT OR IGNORE INTO files (rel_path, mtime) VALUES (?, ?)",
+                mtimes.items())
+        os.replace(self.csv_path, self.csv_path + ".migrated")
+
+    def get_mtimes(self) -> Dict[str, float]:
+        """:return: map of relative paths to the mtime we last recorded."""
+        return dict(self.cnxn.execute("SELECT rel_path, mtime FROM files"))
+
+    def get_mtimes_for(self, rel_paths: List[str],
+                       batch_size: int = IN_BATCH_SIZE) -> Dict[str, float]:
+        """As get_mtimes, but only of rel_paths, those we recorded."""
+        mtimes = {}
+        for i in range(0, len(rel_paths), batch_size):
+            batch = rel_paths[i:i + batch_size]
+            mtimes.update(self.cnxn.execute(
+                "SELECT rel_path, mtime FROM files WHERE rel_path IN ({})"
+                .format(", ".join(["?"] * len(batch))), batch))
+        return mtimes
+
+    def get(self, rel_path: str) -> Optional[FileState]:
+        row = self.cnxn.execute(
+            "SELECT rel_path, mtime, size, inode, content_hash, outcome "
+            "FROM files WHERE rel_path = ?", (rel_path,)).fetchone()
+        return FileState(*row) if row else None
+
+    def get_dirs(self) -> Dict[str, DirState]:
+        """:return: map of relative directory paths to what we recorded."""
+        return {rel_path: DirState(rel_path, mtime, json.loads(subdirs))
+                for rel_path, mtime, subdirs in self.cnxn.execute(
+                    "SELECT rel_path, mtime, subdirs FROM dirs")}
+
+    def get_encode_size(self, key: str) -> Optional[int]:
+        """:return: the size a cached encode made, if it is cached."""
+        row = self.cnxn.execute(
+            "SELECT size FROM encodes WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, states: Iterable[FileState],
+               dirs: Iterable[DirState] = (),
+               encodes: Iterable[Tuple[str, int]] = ()) -> None:
+        """
+        Records only the given files, and directories, all or none of them.
+        A directory is only worth recording alongside the files in it.
+
+        :param encodes: 2-tuples of the key and size of encodes to cache,
+            or whose use to refresh. Beyond max_encodes the least recently
+            used are evicted.
+        """
+        used = time.time()
+        with self.cnxn:
+            if self.max_encodes:
+                self.cnxn.executemany(
+                    "INSERT OR REPLACE INTO encodes (key, size, used) "
+                    "VALUES (?, ?, ?)",
+                    [(key, size, used) for key, size in encodes])
+                self.cnxn.execute(
+                    "DELETE FROM encodes WHERE key NOT IN ("
+                    "SELECT key FROM encodes ORDER BY used DESC LIMIT ?)",
+                    (self.max_encodes,))
+            self.cnxn.executemany(
+                "INSERT OR REPLACE INTO dirs (rel_path, mtime, subdirs) "
+                "VALUES (?, ?, ?)",
+                [(d.rel_path, d.mtime, json.dumps(d.subdirs)) for d in dirs])
+            self.cnxn.executemany(
+                "INSERT INTO files "
+                "(rel_path, mtime, size, inode, content_hash, outcome) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(rel_path) DO UPDATE SET "
+                "mtime = excluded.mtime, size = excluded.size, "
+                "inode = excluded.inode, content_hash = excluded.content_hash, "
+                "outcome = excluded.outcome", states)
+
+    def close(self):
+        if self.cnxn:
+            self.cnxn.close()
+            self.cnxn = None
+
+
+class ResidentStateStore(StateStore):
+    """
+    For a daemon, a StateStore which reads the mtimes and directories
+    recorded only once, then keeps them in memory, up to date with what it
+    records, rather than reading them again every time it polls. Everything
+    is still written through to SQLite, to survive it being stopped.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mtimes: Optional[Dict[str, float]] = None
+        self.dirs: Optional[Dict[str, DirState]] = None
+
+    def load(self):
+        if self.mtimes is None:
+            self.mtimes = super().get_mtimes()
+            self.dirs = super().get_dirs()
+
+    def get_mtimes(self) -> Dict[str, float]:
+        self.load()
+        return dict(self.mtimes)
+
+    def get_mtimes_for(self, rel_paths: List[str],
+                       batch_size: int = IN_BATCH_SIZE) -> Dict[str, float]:
+        self.load()
+        return {rel_path: self.mtimes[rel_path] for rel_path in rel_paths
+                if rel_path in self.mtimes}
+
+    def get_dirs(self) -> Dict[str, DirState]:
+        self.load()
+        return dict(self.dirs)
+
+    def upsert(self, states: Iterable[FileState],
+               dirs: Iterable[DirState] = (),
+               encodes: Iterable[Tuple[str, int]] = ()) -> None:
+        states = list(states)
+        dirs = list(dirs)
+        super().upsert(states, dirs, encodes)
+        if self.mtimes is not None:
+            self.mtimes.update((s.rel_path, s.mtime) for s in states)
+            self.dirs.update((d.rel_path, d) for d in dirs)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from change_feed import InotifyFeed, IN_Q_OVERFLOW, IN_CLOSE_WRITE, \
+    IN_CREATE, IN_ISDIR, EVENT_HEADER, ChangeFeedException
+
+
+def is_png(file_nm):
+    return file_nm.endswith(".png")
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    (tmp_path / "2022" / "08").mkdir(parents=True)
+    return tmp_path
+
+
+@pytest.fixture
+def feed(uploads):
+    with InotifyFeed(str(uploads) + "/", is_png, settle_secs=0.05,
+                     reconcile_secs=60) as feed:
+        yield feed
+
+
+def test_watches_whole_tree(feed):
+    assert sorted(feed.watched.values()) == ["", "2022", "2022/08"]
+    assert feed.changed_dirs(0.05) == set()
+
+
+def test_changed_dirs(feed, uploads):
+    (uploads / "2022" / "08" / "f1.png").write_bytes(b"png")
+    (uploads / "2022" / "f2.png").write_bytes(b"png")
+    (uploads / "notes.txt").write_bytes(b"txt")
+    assert feed.changed_dirs(1) == {"2022/08", "2022"}
+    assert feed.changed_dirs(0.05) == set()
+
+
+def test_renamed_into_place(feed, uploads):
+    staged = uploads / "2022" / "08" / ".staged_f1.txt"
+    staged.write_bytes(b"png")
+    assert feed.changed_dirs(0.05) == set()
+    os.rename(staged, uploads / "2022" / "08" / "f1.png")
+    assert feed.changed_dirs(1) == {"2022/08"}
+
+
+def test_new_directories_watched(feed, uploads):
+    # Possibly written before the watch on it is added, so listed anyway.
+    (uploads / "2022" / "09" / "a").mkdir(parents=True)
+    (uploads / "2022" / "09" / "a" / "f1.png").write_bytes(b"png")
+    assert feed.changed_dirs(1) >= {"2022/09", "2022/09/a"}
+    (uploads / "2022" / "09" / "a" / "f2.png").write_bytes(b"png")
+    assert feed.changed_dirs(1) == {"2022/09/a"}
+
+
+def test_overflow(feed):
+    feed.handle(EVENT_HEADER.pack(-1, IN_Q_OVERFLOW, 0, 0))
+    assert feed.changed_dirs(0) is None
+    assert feed.changed_dirs(0.05) == set()
+
+
+def test_unwatchable_directory(feed, capsys):
+    def watch_tree(subfolder):
+        raise ChangeFeedException("Can't watch \"{}\"".format(subfolder))
+
+    feed.watch_tree = watch_tree
+    name = b"09\0\0"
+    wd = next(iter(feed.watched))
+    feed.handle(EVENT_HEADER.pack(
+        wd, IN_CREATE | IN_ISDIR, 0, len(name)) + name)
+    assert feed.changed_dirs(0) is None
+    assert "Can't watch" in capsys.readouterr().out
+
+
+def test_handle_unknown_watch(feed):
+    name = b"f1.png\0\0"
+    feed.handle(EVENT_HEADER.pack(999, IN_CLOSE_WRITE, 0, len(name)) + name)
+    assert feed.changed == set()
+
+
+def test_from_config(uploads):
+    assert InotifyFeed.from_config(str(uploads), is_png, None) is None
+    feed = InotifyFeed.from_config(str(uploads), is_png, {"settle_secs": 2})
+    assert (feed.settle_secs, feed.reconcile_secs) == (2, 3600)
@@ -2,25 +2,97 @@ from unittest.mock import patch, sentinel, Mock, mock_open, call
 
 import pytest
 
-from common_funcs import run_shell_cmd, get_file_size, get_img_wxh, \
+import asyncio
+import grp
+import os
+import pwd
+import time
+
+from PIL import Image
+
+from common_funcs import run_shell_cmd, run_shell_cmd_async, get_file_size, get_img_wxh, \
     get_name_decor, split_fstring_not_args, php_unserialize_to_dict, \
-    php_serialize_from_dict
+    php_serialize_from_dict, get_file_owner, get_file_group, \
+    read_img_header_wxh, SHELL_CMDS
 
 
 def test_run_shell_cmd():
+    stats_before = SHELL_CMDS["stat"]
     result_text = run_shell_cmd(['stat', '-c' '%s %n', "white_100x100.png"])
     assert result_text.strip() == '694 white_100x100.png'
+    assert SHELL_CMDS["stat"] == stats_before + 1
+
+
+def test_run_shell_cmd_async():
+    stats_before = SHELL_CMDS["stat"]
+    result_text = asyncio.run(run_shell_cmd_async(
+        ['stat', '-c' '%s %n', "white_100x100.png"]))
+    assert result_text.strip() == '694 white_100x100.png'
+    assert SHELL_CMDS["stat"] == stats_before + 1
+    assert asyncio.run(run_shell_cmd_async(['false'])) is None
+
+
+def test_run_shell_cmd_async_cancelled():
+    async def cancel_sleep():
+        task = asyncio.ensure_future(run_shell_cmd_async(['sleep', '30']))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    asyncio.run(cancel_sleep())
+    assert time.monotonic() - start < 10
 
 
 def test_get_file_size():
     assert get_file_size("white_100x100.png") == 694
 
 
+def test_get_file_owner_and_group():
+    st = os.stat("white_100x100.png")
+    assert get_file_owner("white_100x100.png") == pwd.getpwuid(st.st_uid).pw_name
+    assert get_file_group("white_100x100.png") == grp.getgrgid(st.st_gid).gr_name
+
+
 def test_get_img_wxh():
     wxh = get_img_wxh("white_100x100.png")
     assert wxh == [100, 100]
 
 
+@pytest.mark.parametrize("file_name,expected_wxh", [
+    ("white_100x100.png", [100, 100]),
+    ("filestats.png", [580, 296]),
+    ("grue_en_vol.jpg", [951, 512]),
+    ("pierre-lemos-hippo-q90.webp", [1920, 674]),
+])
+def test_read_img_header_wxh(file_name, expected_wxh):
+    forks_before = sum(SHELL_CMDS.values())
+    assert read_img_header_wxh(file_name) == expected_wxh
+    assert sum(SHELL_CMDS.values()) == forks_before
+
+
+@pytest.mark.parametrize("file_name,save_params", [
+    ("lossy.webp", {}),
+    ("lossless.webp", {"lossless": True}),
+    ("progressive.jpg", {"progressive": True}),
+])
+def test_read_img_header_wxh_variants(tmp_path, file_name, save_params):
+    path = str(tmp_path / file_name)
+    Image.new("RGB", (321, 54)).save(path, **save_params)
+    assert read_img_header_wxh(path) == [321, 54]
+
+
+@patch("common_funcs.run_shell_cmd", autospec=True, return_value='"12x34"')
+def test_get_img_wxh_falls_back_to_identify(mock_run_shell, tmp_path):
+    path = str(tmp_path / "img.gif")
+    Image.new("RGB", (12, 34)).save(path)
+    assert read_img_header_wxh(path) is None
+    assert get_img_wxh(path) == [12, 34]
+    mock_run_shell.assert_called_once_with(
+        ['identify', '-ping', '-format', '"%wx%h"', path])
+
+
 def test_get_name_decor():
     decor = get_name_decor(640, 480, "xzmp")
     assert decor == "-640x480.xzmp"
@@ -105,3 +177,11 @@ def test_php_serialize_from_dict():
     pydict_vers = php_serialize_from_dict(PY_IMG_META)
     assert pydict_vers == PHP_IMG_META
 
+
+
+def test_php_unserialize_object():
+    serialized = 'a:1:{s:10:"image_meta";a:1:{s:3:"gps";O:8:"stdClass":1:' \
+                 '{s:3:"lat";d:51.5;}}}'
+    pydict_vers = php_unserialize_to_dict(serialized)
+    assert pydict_vers["image_meta"]["gps"].properties == {"lat": 51.5}
+    assert php_serialize_from_dict(pydict_vers) == serialized
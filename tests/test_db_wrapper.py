@@ -3,6 +3,8 @@ from unittest.mock import patch, sentinel, Mock, mock_open, call
 import pytest
 
 import mysql.connector
+
+import php_meta
 from db_wrapper import DBHandle
 
 MOCK_CONFIG = {
@@ -18,21 +20,135 @@ def test_db_handle_init():
     assert dbh.config == MOCK_CONFIG
 
 
-@patch("db_wrapper.mysql.connector.connect", autospec=True)
-def test_db_handle_connect(mock_connect):
+@patch("db_wrapper.mysql.connector.pooling.MySQLConnectionPool",
+       autospec=True)
+def test_db_handle_connect(mock_pool):
     dbh = DBHandle(MOCK_CONFIG)
     dbh.connect()
-    mock_connect.assert_called_once_with(
+    mock_pool.assert_called_once_with(
+        pool_size=1,
         host=MOCK_CONFIG["host"],
         user=MOCK_CONFIG["user"],
         password=MOCK_CONFIG["password"],
         database=MOCK_CONFIG["database"],
     )
-    mock_connect.return_value.cursor.assert_called_once_with()
+    cnxn = mock_pool.return_value.get_connection.return_value
+    assert dbh.cnxn is cnxn
+    cnxn.cursor.assert_called_once_with()
+
+
+def test_db_handle_connect_shared_pool():
+    pool = Mock()
+    dbh = DBHandle(dict(MOCK_CONFIG, pool_size=4), pool)
+    dbh.connect()
+    assert dbh.cnxn is pool.get_connection.return_value
+
+
+def lost_connection():
+    return mysql.connector.errors.OperationalError(
+        "MySQL server has gone away", errno=2006)
+
+
+@patch("db_wrapper.time.sleep", autospec=True)
+def test_retrying_reconnects(mock_sleep):
+    dbh = DBHandle(MOCK_CONFIG, Mock())
+    dbh.pool.get_connection.side_effect = lambda: Mock()
+    dbh.connect()
+    broken = dbh.cnxn
+    operation = Mock(side_effect=[lost_connection(), lost_connection(), 5])
+    assert dbh.retrying(operation) == 5
+    assert operation.call_count == 3
+    assert mock_sleep.call_args_list == [call(1), call(2)]
+    broken.close.assert_called_once_with()
+    assert dbh.pool.get_connection.call_count == 3
+
+
+@patch("db_wrapper.time.sleep", autospec=True)
+def test_retrying_gives_up(mock_sleep):
+    dbh = DBHandle(dict(MOCK_CONFIG, retries=1), Mock())
+    dbh.connect()
+    operation = Mock(side_effect=[lost_connection(), lost_connection()])
+    with pytest.raises(mysql.connector.errors.OperationalError):
+        dbh.retrying(operation)
+    assert operation.call_count == 2
+
+
+@pytest.mark.parametrize("refused", [
+    mysql.connector.errors.InterfaceError(
+        "Can't connect to MySQL server", errno=2003),
+    mysql.connector.errors.DatabaseError(
+        "Can't connect to MySQL server", errno=2003),
+    mysql.connector.errors.PoolError("Failed getting connection")])
+@patch("db_wrapper.time.sleep", autospec=True)
+def test_retrying_while_server_restarts(mock_sleep, refused):
+    dbh = DBHandle(MOCK_CONFIG, Mock())
+    dbh.pool.get_connection.side_effect = [Mock(), refused, refused, Mock()]
+    dbh.connect()
+    operation = Mock(side_effect=[lost_connection(), 5])
+    assert dbh.retrying(operation) == 5
+    assert operation.call_count == 2
+    assert mock_sleep.call_args_list == [call(1), call(2), call(4)]
+
+
+@patch("db_wrapper.time.sleep", autospec=True)
+def test_retrying_after_giving_up(mock_sleep):
+    dbh = DBHandle(dict(MOCK_CONFIG, retries=1), Mock())
+    refused = mysql.connector.errors.InterfaceError(
+        "Can't connect to MySQL server", errno=2003)
+    dbh.pool.get_connection.side_effect = [Mock(), refused, Mock()]
+    dbh.connect()
+    with pytest.raises(mysql.connector.errors.InterfaceError):
+        dbh.retrying(Mock(side_effect=lost_connection()))
+    assert dbh.cnxn is None
+    # The next call, once the server is back, connects before anything else.
+    assert dbh.retrying(lambda: 5) == 5
+    assert dbh.pool.get_connection.call_count == 3
+    mock_sleep.assert_called_once_with(1)
+
+
+def test_retrying_not_other_errors():
+    dbh = DBHandle(MOCK_CONFIG, Mock())
+    dbh.connect()
+    operation = Mock(side_effect=mysql.connector.errors.ProgrammingError())
+    with pytest.raises(mysql.connector.errors.ProgrammingError):
+        dbh.retrying(operation)
+    operation.assert_called_once_with()
+
+
+@patch("db_wrapper.time.monotonic", side_effect=[0, 0, 100, 100, 100])
+def test_retrying_checks_idle_connection(mock_monotonic):
+    dbh = DBHandle(MOCK_CONFIG, Mock())
+    dbh.connect()
+    dbh.cnxn.is_connected.return_value = False
+    assert dbh.retrying(lambda: 5) == 5
+    assert dbh.pool.get_connection.call_count == 2
+
+
+def test_disconnect_returns_connection_despite_cursor():
+    dbh = DBHandle(MOCK_CONFIG, Mock())
+    dbh.connect()
+    dbh.cursor.close.side_effect = mysql.connector.errors.InternalError(
+        "Unread result found")
+    with pytest.raises(mysql.connector.errors.InternalError):
+        dbh.disconnect()
+    dbh.cnxn.close.assert_called_once_with()
+
+
+def test_reconnect_despite_cursor():
+    dbh = DBHandle(MOCK_CONFIG, Mock())
+    dbh.pool.get_connection.side_effect = lambda: Mock()
+    dbh.connect()
+    unread = dbh.cnxn
+    unread.cursor.return_value.close.side_effect = \
+        mysql.connector.errors.InternalError("Unread result found")
+    dbh.reconnect()
+    unread.close.assert_called_once_with()
+    assert dbh.cnxn is not unread
 
 
 def test_query_all_media():
     dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
     dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
     dbh.cursor.fetchall = Mock(autospec=True, return_value=[
         ("2022/08/mock.png", 11),
@@ -55,6 +171,7 @@ def test_query_all_media():
        side_effect=[sentinel.unsrlzd_1, sentinel.unsrlzd_2])
 def test_query_media_metadata(mock_unserialize):
     dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
     dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
     dbh.cursor.fetchall = Mock(autospec=True, return_value=[
         (16, sentinel.serialized1),
@@ -75,16 +192,96 @@ def test_query_media_metadata(mock_unserialize):
     ]
 
 
+@patch("db_wrapper.cmn.php_unserialize_to_dict", autospec=True,
+       side_effect=[sentinel.unsrlzd_1, sentinel.unsrlzd_2, sentinel.unsrlzd_3])
+def test_query_media_metadata_for(mock_unserialize):
+    dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
+    dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
+    dbh.cursor.fetchall = Mock(autospec=True, side_effect=[
+        [(16, sentinel.serialized1), (18, sentinel.serialized2)],
+        [(21, sentinel.serialized3)],
+    ])
+    rel_paths = ["2022/08/a.png", "2022/08/a-150x150.png", "2022/08/b.jpg",
+                 "2022/09/c.webp"]
+    metadata = dbh.query_media_metadata_for(rel_paths, batch_size=3)
+    query = "SELECT md.meta_id, md.meta_value FROM wp_postmeta af " \
+            "JOIN wp_postmeta md ON md.post_id = af.post_id " \
+            "AND md.meta_key = '_wp_attachment_metadata' " \
+            "WHERE af.meta_key = '_wp_attached_file' AND af.meta_value IN ({})"
+    dbh.cursor.execute.assert_has_calls([
+        call(query.format("%s, %s, %s"), rel_paths[:3]),
+        call(query.format("%s"), rel_paths[3:]),
+    ])
+    assert metadata == [
+        (16, sentinel.unsrlzd_1),
+        (18, sentinel.unsrlzd_2),
+        (21, sentinel.unsrlzd_3),
+    ]
+
+
+def test_fetch_media_metadata_for():
+    dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
+    dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
+    dbh.cursor.fetchall = Mock(autospec=True, return_value=[
+        (16, sentinel.serialized1)])
+    assert dbh.fetch_media_metadata_for(["2022/08/a.png"]) == [
+        (16, sentinel.serialized1)]
+    dbh.cursor.execute.assert_called_once()
+
+
+def test_query_media_metadata_for_nothing():
+    dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
+    dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
+    assert dbh.query_media_metadata_for([]) == []
+    dbh.cursor.execute.assert_not_called()
+
+
 @patch("db_wrapper.cmn.php_serialize_from_dict", autospec=True,
        return_value='"sentinel.srlzd";s:8:"filesize";i:7345;')
 def test_update_metadata(mock_serialize):
     dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
     dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
     sentidict = {
         "sentinel": "but dict"
     }
     metadata = dbh.update_metadata(42, sentidict)
     dbh.cursor.execute.assert_called_once_with(
-        "UPDATE wp_postmeta SET meta_value = '{}' WHERE meta_id = {}".format(
-                mock_serialize.return_value, 42))
+        "UPDATE wp_postmeta SET meta_value = %s WHERE meta_id = %s",
+        (mock_serialize.return_value, 42))
+
+
+@patch("db_wrapper.cmn.php_serialize_from_dict", autospec=True,
+       side_effect=lambda d: "srlzd{}".format(d["n"]))
+def test_update_metadata_batch(mock_serialize):
+    dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
+    dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
+    updates = [(40 + n, {"n": n}) for n in range(5)]
+    dbh.update_metadata_batch(updates, commit_every=2)
+    update = "UPDATE wp_postmeta SET meta_value = %s WHERE meta_id = %s"
+    dbh.cursor.executemany.assert_has_calls([
+        call(update, [("srlzd0", 40), ("srlzd1", 41)]),
+        call(update, [("srlzd2", 42), ("srlzd3", 43)]),
+        call(update, [("srlzd4", 44)]),
+    ])
+    assert dbh.cnxn.commit.call_count == 3
+
+
+def test_update_filesizes_batch():
+    dbh = DBHandle(MOCK_CONFIG)
+    dbh.cnxn = Mock()
+    dbh.cursor = Mock(mysql.connector.connection_cext.CMySQLCursor)
+    metadata = php_meta.loads('a:3:{s:4:"file";s:5:"a.png";'
+                              's:8:"filesize";i:2048;s:5:"sizes";a:0:{}}')
+    metadata["filesize"] = 1024
+    dbh.update_filesizes_batch([(40, metadata)])
+    dbh.cursor.executemany.assert_called_once_with(
+        "UPDATE wp_postmeta SET meta_value = %s WHERE meta_id = %s",
+        [('a:3:{s:4:"file";s:5:"a.png";s:8:"filesize";i:1024;'
+          's:5:"sizes";a:0:{}}', 40)])
+    dbh.cnxn.commit.assert_called_once_with()
 
@@ -0,0 +1,109 @@
+from unittest.mock import Mock
+
+import pytest
+
+from encode_cache import EncodeCache
+
+
+@pytest.fixture
+def imgs(tmp_path):
+    src = tmp_path / "f1.png"
+    src.write_bytes(b"original")
+    dest = tmp_path / "f1-150x150.png"
+    dest.write_bytes(b"thumbnail")
+    return str(src), str(dest)
+
+
+def test_key_ignores_file_names(imgs):
+    src, dest = imgs
+    cache = EncodeCache("magick", Mock())
+    f_str_vars = {"q": 32, "w": 150, "h": 150, "src_img": src,
+                  "dest_img": dest}
+    key = cache.key("cmd", f_str_vars, src, dest)
+    assert key == cache.key("cmd", dict(f_str_vars, dest_img="tmp"), src, dest)
+    assert key != cache.key("cmd", dict(f_str_vars, q=33), src, dest)
+    assert key != cache.key("other cmd", f_str_vars, src, dest)
+    assert key != EncodeCache("pillow", Mock()).key(
+        "cmd", f_str_vars, src, dest)
+
+
+def test_key_follows_content(imgs):
+    src, dest = imgs
+    cache = EncodeCache("magick", Mock())
+    f_str_vars = {"q": 32, "src_img": src, "dest_img": dest}
+    key = cache.key("cmd", f_str_vars, src, dest)
+    with open(dest, "wb") as f:
+        f.write(b"smaller")
+    # Until told that it was replaced, the hash is remembered.
+    assert cache.key("cmd", f_str_vars, src, dest) == key
+    cache.replaced(dest)
+    assert cache.key("cmd", f_str_vars, src, dest) != key
+
+
+def test_lookup(imgs):
+    src, dest = imgs
+    size_of = Mock(return_value=42)
+    cache = EncodeCache("magick", size_of)
+    f_str_vars = {"q": 32, "src_img": src, "dest_img": dest}
+    assert cache.lookup("cmd", f_str_vars) == 42
+    size_of.assert_called_once_with(cache.key("cmd", f_str_vars, src, dest))
+
+
+def test_settle_keys_on_files_as_left(imgs):
+    src, dest = imgs
+    cache = EncodeCache("magick", Mock())
+    thumb_vars = {"q": 32, "src_img": src, "dest_img": dest}
+    full_vars = {"q": 32, "src_img": src, "dest_img": src}
+    thumb, full = {}, {}
+    cache.note(thumb, "thumb cmd", thumb_vars, dest, 90)
+    with open(src, "wb") as f:
+        f.write(b"re-encoded")
+    cache.replaced(src)
+    cache.note(full, "full cmd", full_vars, src, 7)
+    cache.settle()
+    assert thumb["cache"] == (cache.key("thumb cmd", thumb_vars, src, dest), 90)
+    assert full["cache"] == (cache.key("full cmd", full_vars, src, src), 7)
+    assert cache.pending == []
+
+
+def test_variant_keyed_on_sibling(imgs):
+    src, sibling = imgs
+    variant = sibling + ".webp"
+    cache = EncodeCache("magick", Mock())
+    variant_vars = {"q": 60, "src_img": src, "dest_img": variant}
+    rejected = {}
+    cache.note(rejected, "webp cmd", variant_vars, variant, 120, sibling)
+    cache.settle()
+    # Keyed on its own absence, having lost to its sibling.
+    key = cache.key("webp cmd", variant_vars, src, variant, sibling)
+    assert rejected["cache"] == (key, 120)
+    assert key != cache.key("webp cmd", variant_vars, src, variant)
+    with open(sibling, "wb") as f:
+        f.write(b"re-encoded")
+    cache.replaced(sibling)
+    assert cache.key("webp cmd", variant_vars, src, variant, sibling) != key
+
+
+def test_search_keyed_on_original_as_left(imgs):
+    src, _ = imgs
+    size_of = Mock(return_value=None)
+    cache = EncodeCache("pillow", size_of)
+    settings = {"ssim": 0.95, "min_q": 30, "max_trials": 5, "tolerance": 2}
+    f_str_vars = {"q": 70, "src_img": src, "dest_img": None}
+    assert cache.lookup_q(settings, "cmd", f_str_vars) is None
+    report = {}
+    cache.note_q(report, settings, "cmd", f_str_vars, 41)
+    before = cache.search_key(settings, "cmd", 70, src)
+    with open(src, "wb") as f:
+        f.write(b"re-encoded at 41")
+    cache.replaced(src)
+    cache.settle()
+    # So that our own re-encode isn't searched again.
+    after = cache.search_key(settings, "cmd", 70, src)
+    assert report["cache"] == (after, 41)
+    assert after != before
+    assert cache.searches == []
+    assert after != cache.search_key(settings, "cmd", 60, src)
+    assert after != cache.search_key(
+        dict(settings, ssim=0.9), "cmd", 70, src)
+    assert after != cache.key("cmd", f_str_vars, src, src)
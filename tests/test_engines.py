@@ -0,0 +1,178 @@
+import asyncio
+from unittest.mock import patch, sentinel, Mock, mock_open, call
+
+import pytest
+from PIL import Image
+
+from engines import _operators_of, MagickEngine, PillowEngine, get_engine, \
+    EngineException
+
+JPG_CMD = "convert -strip -resize {w}x{h} -quality {q}% -interlace Plane" \
+          " -gaussian-blur 0.05 {src_img} {dest_img}"
+PNG_CMD = "convert -strip -resize {w}x{h} -colors {q} {src_img} {dest_img}"
+PNG_THUMB_CMD = "convert -strip -resize {w1}x{h1} -colors {q} -gravity center" \
+                " -extent {w}x{h} {src_img} {dest_img}"
+WEBP_NORESIZE_CMD = "convert -strip -define webp:method=6 -quality {q}" \
+                    " {src_img} {dest_img}"
+
+
+def test_operators_of():
+    assert _operators_of(PNG_THUMB_CMD) == \
+           "-strip -resize {w1}x{h1} -colors {q} -gravity center" \
+           " -extent {w}x{h}"
+    assert _operators_of(WEBP_NORESIZE_CMD) == \
+           "-strip -define webp:method=6 -quality {q}"
+
+
+def test_get_engine():
+    assert isinstance(get_engine("magick"), MagickEngine)
+    assert isinstance(get_engine("pillow"), PillowEngine)
+    with pytest.raises(EngineException):
+        get_engine("gimp")
+
+
+@patch("engines.cmn.run_shell_cmd", autospec=True)
+def test_magick_render(mock_run_shell):
+    MagickEngine().render(
+        {"w": 30, "h": 20, "q": 16, "src_img": "/a/b.png",
+         "dest_img": "/tmp/c.png"}, PNG_CMD)
+    mock_run_shell.assert_called_once_with([
+        "convert", "-strip", "-resize", "30x20", "-colors", "16",
+        "/a/b.png", "/tmp/c.png"])
+
+
+@patch("engines.cmn.run_shell_cmd", autospec=True)
+def test_magick_render_limited(mock_run_shell):
+    engine = get_engine("magick", {"memory": "256MiB", "thread": "2"})
+    engine.render(
+        {"w": 30, "h": 20, "q": 16, "src_img": "/a/b.png",
+         "dest_img": "/tmp/c.png"}, PNG_CMD)
+    mock_run_shell.assert_called_once_with([
+        "convert", "-limit", "memory", "256MiB", "-limit", "thread", "2",
+        "-strip", "-resize", "30x20", "-colors", "16",
+        "/a/b.png", "/tmp/c.png"])
+    assert engine.many_cmd("/a/b.png", [])[:4] == \
+           ["convert", "-limit", "memory", "256MiB"]
+
+
+@patch("engines.cmn.run_shell_cmd", autospec=True)
+def test_magick_render_many(mock_run_shell):
+    MagickEngine().render_many("/up/22/f1.png", [
+        ({"q": 32, "w": 273, "h": 300, "dest_img": "/tmp/a.png"}, PNG_CMD),
+        ({"q": 32, "w": 150, "h": 150, "w1": 150, "h1": 165,
+          "dest_img": "/tmp/b.png"}, PNG_THUMB_CMD),
+    ])
+    mock_run_shell.assert_called_once_with([
+        "convert", "/up/22/f1.png", "-respect-parentheses",
+        "(", "+clone", "-strip", "-resize", "273x300", "-colors", "32",
+        "-write", "/tmp/a.png", "+delete", ")",
+        "(", "+clone", "-strip", "-resize", "150x165", "-colors", "32",
+        "-gravity", "center", "-extent", "150x150",
+        "-write", "/tmp/b.png", "+delete", ")",
+        "null:"])
+
+
+@patch("engines.cmn.run_shell_cmd", autospec=True, return_value=None)
+def test_magick_render_failed(mock_run_shell):
+    engine = MagickEngine()
+    with pytest.raises(EngineException):
+        engine.render({"w": 30, "h": 20, "q": 16, "src_img": "/a/b.png",
+                       "dest_img": "/tmp/c.png"}, PNG_CMD)
+    with pytest.raises(EngineException):
+        engine.render_many("/a/b.png", [({"q": 32, "w": 273, "h": 300,
+                                          "dest_img": "/tmp/a.png"}, PNG_CMD)])
+
+
+@patch("engines.cmn.run_shell_cmd_async", autospec=True, return_value=None)
+def test_magick_render_async_failed(mock_run_shell):
+    f_str_vars = {"w": 30, "h": 20, "q": 16, "src_img": "/a/b.png",
+                  "dest_img": "/tmp/c.png"}
+    with pytest.raises(EngineException):
+        asyncio.run(MagickEngine().render_async(f_str_vars, PNG_CMD))
+    with pytest.raises(EngineException):
+        asyncio.run(MagickEngine().render_many_async(
+            "/a/b.png", [(f_str_vars, PNG_CMD)]))
+
+
+@patch("engines.cmn.run_shell_cmd_async", autospec=True)
+def test_magick_render_many_async(mock_run_shell):
+    outputs = [
+        ({"q": 32, "w": 273, "h": 300, "dest_img": "/tmp/a.png"}, PNG_CMD)]
+    asyncio.run(MagickEngine().render_many_async("/up/22/f1.png", outputs))
+    mock_run_shell.assert_awaited_once_with(
+        MagickEngine().many_cmd("/up/22/f1.png", outputs))
+
+
+@pytest.fixture
+def gradient_png(tmp_path):
+    img = Image.linear_gradient("L").resize((530, 583)).convert("RGBA")
+    path = str(tmp_path / "src.png")
+    img.save(path)
+    return path
+
+
+def test_pillow_render_resize_and_quantize(gradient_png, tmp_path):
+    dest = str(tmp_path / "out.png")
+    PillowEngine().render(
+        {"w": 273, "h": 300, "q": 16, "src_img": gradient_png,
+         "dest_img": dest}, PNG_CMD)
+    with Image.open(dest) as out:
+        assert out.size == (273, 300)
+        assert out.mode == "P"
+        assert len(out.getcolors()) <= 16
+
+
+def test_pillow_render_async(gradient_png, tmp_path):
+    dest = str(tmp_path / "out.png")
+    asyncio.run(PillowEngine().render_async(
+        {"w": 273, "h": 300, "q": 16, "src_img": gradient_png,
+         "dest_img": dest}, PNG_CMD))
+    with Image.open(dest) as out:
+        assert out.size == (273, 300)
+
+
+def test_pillow_render_thumbnail_crop(gradient_png, tmp_path):
+    dest = str(tmp_path / "out.png")
+    PillowEngine().render(
+        {"w": 150, "h": 150, "w1": 150, "h1": 165, "q": 32,
+         "src_img": gradient_png, "dest_img": dest}, PNG_THUMB_CMD)
+    with Image.open(dest) as out:
+        assert out.size == (150, 150)
+
+
+def test_pillow_render_jpg_strips(tmp_path):
+    src = str(tmp_path / "src.jpg")
+    exif = Image.Exif()
+    exif[0x010e] = "a description"
+    Image.new("RGB", (400, 300), "teal").save(src, exif=exif)
+    dest = str(tmp_path / "out.jpg")
+    PillowEngine().render(
+        {"w": 300, "h": 225, "q": 60, "src_img": src, "dest_img": dest},
+        JPG_CMD)
+    with Image.open(dest) as out:
+        assert out.size == (300, 225)
+        assert "exif" not in out.info
+        assert out.info.get("progressive")
+
+
+def test_pillow_render_many(gradient_png, tmp_path):
+    src = str(tmp_path / "src.webp")
+    Image.open(gradient_png).save(src, quality=95)
+    outputs = [
+        ({"w": 273, "h": 300, "q": 32, "dest_img": str(tmp_path / "a.png")},
+         PNG_CMD),
+        ({"q": 50, "dest_img": str(tmp_path / "b.webp")}, WEBP_NORESIZE_CMD),
+    ]
+    PillowEngine().render_many(src, outputs)
+    with Image.open(outputs[0][0]["dest_img"]) as out:
+        assert out.size == (273, 300)
+    with Image.open(outputs[1][0]["dest_img"]) as out:
+        assert out.size == (530, 583)
+        assert out.format == "WEBP"
+
+
+def test_pillow_unsupported_operator(gradient_png, tmp_path):
+    with pytest.raises(EngineException):
+        PillowEngine().render(
+            {"src_img": gradient_png, "dest_img": str(tmp_path / "a.png")},
+            "convert -sepia-tone 80% {src_img} {dest_img}")
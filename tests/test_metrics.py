@@ -0,0 +1,126 @@
+import json
+
+from metrics import Metrics, PHASES, PROM_PREFIX
+
+
+def test_timer_accumulates():
+    metrics = Metrics()
+    with metrics.timer("scan"):
+        pass
+    with metrics.timer("scan"):
+        pass
+    assert list(metrics.phase_secs) == ["scan"]
+    assert metrics.phase_secs["scan"] > 0
+
+
+def test_timed_iter_yields_everything():
+    metrics = Metrics()
+    assert list(metrics.timed_iter("imaging", iter([1, None, 3]))) == \
+           [1, None, 3]
+    assert "imaging" in metrics.phase_secs
+
+
+def test_from_config():
+    metrics = Metrics.from_config(
+        {"jsonl": "m.jsonl", "prometheus": "m.prom", "per_encode": True})
+    assert (metrics.jsonl_path, metrics.prom_path, metrics.per_encode) == \
+           ("m.jsonl", "m.prom", True)
+    metrics = Metrics.from_config(None)
+    assert (metrics.jsonl_path, metrics.prom_path, metrics.per_encode) == \
+           (None, None, False)
+
+
+def test_record_encodes():
+    metrics = Metrics()
+    metrics.record_encodes([
+        {"engine_secs": 1.5, "bytes_in": 100, "bytes_out": 70,
+         "accepted": True},
+        {"engine_secs": 0.5, "bytes_in": 50, "bytes_out": 60,
+         "accepted": False},
+    ])
+    assert metrics.counters == {
+        "encodes": 2, "encodes_accepted": 1, "encodes_rejected": 1,
+        "engine_secs": 2.0, "bytes_in": 150, "bytes_out": 130,
+        "bytes_saved": 30}
+    assert metrics.encodes == []
+
+
+def test_record_q_searches():
+    metrics = Metrics()
+    metrics.record_encodes([
+        {"file": "f1.jpg", "engine": "magick", "q_search": 4,
+         "engine_secs": 2.5, "q": 41, "max_q": 70},
+        {"engine_secs": 0.5, "bytes_in": 50, "bytes_out": 40,
+         "accepted": True},
+    ])
+    metrics.record_encodes([
+        {"file": "f1.jpg", "engine": "magick", "q_search": 0, "cached": True,
+         "q": 41, "max_q": 70}])
+    assert metrics.counters["q_searches"] == 1
+    assert metrics.counters["q_searches_cached"] == 1
+    assert metrics.counters["q_search_trials"] == 4
+    assert metrics.counters["q_search_secs"] == 2.5
+    assert metrics.counters["encodes"] == 1
+    assert metrics.counters["engine_secs"] == 0.5
+
+
+def test_record_variants():
+    metrics = Metrics()
+    metrics.record_encodes([
+        {"engine_secs": 1.0, "bytes_in": 100, "bytes_out": 60,
+         "accepted": True, "variant": True},
+        {"engine_secs": 0.5, "bytes_in": 100, "bytes_out": 120,
+         "accepted": False, "variant": True},
+    ])
+    assert metrics.counters == {
+        "variants": 2, "variants_kept": 1, "variant_bytes_saved": 40,
+        "engine_secs": 1.5}
+
+
+def test_precheck_rates():
+    metrics = Metrics()
+    assert metrics.rates() == {}
+    metrics.record_encodes(
+        [{"skipped": "bpp"}] * 3 +
+        [{"engine_secs": 1, "bytes_in": 100, "bytes_out": 70,
+          "accepted": True, "audited": "bpp"}] +
+        [{"engine_secs": 1, "bytes_in": 100, "bytes_out": 170,
+          "accepted": False, "audited": "bpp"}] +
+        [{"engine_secs": 1, "bytes_in": 100, "bytes_out": 70,
+          "accepted": True}] * 4)
+    assert metrics.counters["precheck_skipped"] == 3
+    assert metrics.counters["precheck_audited"] == 2
+    assert metrics.counters["precheck_false_skips"] == 1
+    assert metrics.rates() == {"precheck_skip_rate": 3 / 9,
+                               "precheck_false_skip_rate": 0.5}
+
+
+def test_emit_nowhere_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Metrics().emit()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_emit(tmp_path):
+    jsonl_path = tmp_path / "metrics.jsonl"
+    prom_path = tmp_path / "ss_img_shrinker.prom"
+    metrics = Metrics(str(jsonl_path), str(prom_path), per_encode=True)
+    metrics.record_encodes([{"file": "f1.png", "engine_secs": 1.5,
+                             "bytes_in": 100, "bytes_out": 70,
+                             "accepted": True}])
+    with metrics.timer("scan"):
+        pass
+    metrics.emit()
+    metrics.emit()
+    lines = [json.loads(line) for line in
+             jsonl_path.read_text().splitlines()]
+    assert [line["event"] for line in lines] == \
+           ["encode", "run", "encode", "run"]
+    assert lines[0]["file"] == "f1.png"
+    assert list(lines[1]["phase_secs"]) == PHASES
+    assert lines[1]["counters"]["bytes_saved"] == 30
+    prom = prom_path.read_text()
+    assert '{}_phase_seconds{{phase="scan"}}'.format(PROM_PREFIX) in prom
+    assert "{}_bytes_saved 30.0\n".format(PROM_PREFIX) in prom
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+           ["metrics.jsonl", "ss_img_shrinker.prom"]
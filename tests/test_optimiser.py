@@ -1,9 +1,25 @@
+import asyncio
+import errno
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 from unittest.mock import patch, sentinel, Mock, mock_open, call
 
 import pytest
 
 from optimiser import process_args, _magick_on_img, ChangeManager,\
-    _get_recorded_mtimes, _save_recorded_mtimes, NV_RECORD_PATH, _get_disk_sizes
+    _get_disk_sizes, _magick_on_imgs, DIR_SETTLE_SECS, _staging_name, \
+    _escalate_once, DirsInProgress, _magick_on_img_async, \
+    _magick_on_imgs_async, _is_variant, _is_upload, CompressorException
+import optimiser
+from common_funcs import php_serialize_from_dict
+from encode_cache import EncodeCache
+from engines import EngineException
+from metrics import Metrics
+from state_store import FileState, DirState, StateStore, ResidentStateStore
 
 
 def test_parse_args_for_monitoring_help():
@@ -15,34 +31,103 @@ def test_parse_args_for_monitoring_help():
 def test_parse_args(mock_change_mngr):
     MOCK_ARGS_LIST = ["-c", "top_secret_conf.json"]
     process_args(MOCK_ARGS_LIST)
-    mock_change_mngr.assert_called_once_with(MOCK_ARGS_LIST[1])
+    mock_change_mngr.assert_called_once_with(
+        MOCK_ARGS_LIST[1], workers=None, async_converts=None, daemon=False)
     # Maybe why colleagues dislike context managers is that they don't
     # test logically.
     mock_change_mngr.return_value.__enter__.return_value.check_all_uploads.assert_called_once_with()
     mock_change_mngr.return_value.__enter__.assert_called_once_with()
 
 
-@patch("optimiser.cmn.split_fstring_not_args", autospec=True)
-@patch("optimiser.cmn.run_shell_cmd", autospec=True)
-@patch("optimiser.cmn.get_file_size", autospec=True, side_effect=[50, 50])
-def test_magick_on_img_no_change(mock_get_file_size, mock_run_shell, mock_split_not_args):
-    final_destination = "/blah/prefix/blah/dest_img_value.decoration"
+@patch("optimiser._escalate_once", autospec=True)
+@patch("optimiser.ChangeManager", autospec=True)
+def test_parse_args_sudo(mock_change_mngr, mock_escalate):
+    process_args(["--sudo"])
+    mock_escalate.assert_called_once_with(["--sudo"])
+
+
+@patch("optimiser.os.execvp", autospec=True)
+@patch("optimiser.os.geteuid", autospec=True, side_effect=[1000, 0])
+def test_escalate_once(mock_geteuid, mock_execvp):
+    _escalate_once(["-c", "conf.json"])
+    mock_execvp.assert_called_once_with("sudo", [
+        "sudo", sys.executable, os.path.abspath(optimiser.__file__),
+        "-c", "conf.json"])
+    _escalate_once(["-c", "conf.json"])
+    mock_execvp.assert_called_once()
+
+
+@patch("optimiser.ChangeManager", autospec=True)
+def test_parse_args_workers(mock_change_mngr):
+    process_args(["-c", "top_secret_conf.json", "-w", "16"])
+    mock_change_mngr.assert_called_once_with(
+        "top_secret_conf.json", workers=16, async_converts=None,
+        daemon=False)
+
+
+@patch("optimiser.ChangeManager", autospec=True)
+def test_parse_args_daemon(mock_change_mngr):
+    process_args(["--daemon"])
+    mock_change_mngr.assert_called_once_with(
+        "config.json", workers=None, async_converts=None, daemon=True)
+    optimiser = mock_change_mngr.return_value.__enter__.return_value
+    optimiser.run_daemon.assert_called_once_with()
+    optimiser.check_all_uploads.assert_not_called()
+
+
+@patch("optimiser.ChangeManager", autospec=True)
+def test_parse_args_async_converts(mock_change_mngr):
+    process_args(["-a", "8"])
+    mock_change_mngr.assert_called_once_with(
+        "config.json", workers=None, async_converts=8, daemon=False)
+
+
+def writing_engine(n_bytes: int):
+    """An engine which "renders" n_bytes to every dest_img."""
+    def write(f_str_vars, command):
+        with open(f_str_vars["dest_img"], "wb") as f:
+            f.write(b"m" * n_bytes)
+    def write_many(src_img, outputs):
+        for f_str_vars, command in outputs:
+            write(f_str_vars, command)
+
+    async def write_async(f_str_vars, command):
+        write(f_str_vars, command)
+
+    async def write_many_async(src_img, outputs):
+        write_many(src_img, outputs)
+
+    engine = Mock()
+    engine.render.side_effect = write
+    engine.render_many.side_effect = write_many
+    engine.render_async.side_effect = write_async
+    engine.render_many_async.side_effect = write_many_async
+    return engine
+
+
+@pytest.fixture
+def existing_img(tmp_path):
+    final_destination = tmp_path / "dest_img_value.png"
+    final_destination.write_bytes(b"e" * 100)
+    os.chmod(final_destination, 0o644)
+    return str(final_destination)
+
+
+def test_magick_on_img_no_change(existing_img):
     f_str_vars = {
-        "dest_img": final_destination
+        "dest_img": existing_img
     }
     mock_cmd = "sub me a {6inchsub} for a {footlong}"
-    assert not _magick_on_img(f_str_vars, mock_cmd)
-    tmp_name = "/tmp/staged_dest_img_value.decoration"
-    assert f_str_vars["dest_img"] == tmp_name
-    mock_split_not_args.assert_called_once_with(f_str_vars, mock_cmd)
-    mock_get_file_size.assert_has_calls([
-        call(final_destination),
-        call(tmp_name)
-    ])
-    mock_run_shell.assert_has_calls([
-        call(mock_split_not_args.return_value),
-        call(["rm", tmp_name])
-    ])
+    engine = writing_engine(100)
+    assert _magick_on_img(f_str_vars, mock_cmd, engine) is None
+    tmp_name = f_str_vars["dest_img"]
+    assert os.path.dirname(tmp_name) == os.path.dirname(existing_img)
+    assert os.path.basename(tmp_name).startswith(".staged_")
+    assert tmp_name.endswith("_dest_img_value.png")
+    engine.render.assert_called_once_with(f_str_vars, mock_cmd)
+    assert not os.path.exists(tmp_name)
+    with open(existing_img, "rb") as f:
+        assert f.read() == b"e" * 100
 
 
 @patch("optimiser.DBHandle", autospec=True)
@@ -59,15 +144,72 @@ def test_change_manager(mock_validate, mock_db_handle):
                "wp_uploads": sentinel.uploads_dir
            }
     assert optimiser.root_dir == sentinel.uploads_dir
+    assert optimiser.workers == 1
+    assert optimiser.commit_every == 100
+    assert optimiser.engine.name == "magick"
     assert optimiser.db == mock_db_handle.return_value
     assert sorted(optimiser.scaling_cmds.keys()) == \
-           sorted(["png", "jpg", "jpeg", "webp"])
+           sorted(["png", "jpg", "jpeg", "webp", "avif"])
     assert sorted(optimiser.noresize_cmds.keys()) == \
-           sorted(["png", "jpg", "jpeg", "webp"])
+           sorted(["png", "jpg", "jpeg", "webp", "avif"])
     assert sorted(optimiser.thumbnail_cmds.keys()) == \
-           sorted(["png", "jpg", "jpeg", "webp"])
+           sorted(["png", "jpg", "jpeg", "webp", "avif"])
     mock_db_handle.assert_called_once_with(sentinel.sql)
     mock_validate.assert_called_once_with(sentinel.conf_location)
+    assert type(optimiser.state) is StateStore
+    assert optimiser.poll_secs == 300
+    assert type(ChangeManager(sentinel.conf_location, daemon=True).state) \
+        is ResidentStateStore
+
+
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": sentinel.uploads_dir,
+               "workers": 3
+           },
+           "sql": sentinel.sql,
+       })
+def test_change_manager_workers(mock_validate, mock_db_handle):
+    assert ChangeManager(sentinel.conf_location).workers == 3
+    assert ChangeManager(sentinel.conf_location, workers=5).workers == 5
+
+
+@patch("scheduler.os.cpu_count", return_value=4)
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": sentinel.uploads_dir,
+               "workers": 2,
+               "schedule": {"memory_mb": 1024}
+           },
+           "sql": sentinel.sql,
+       })
+def test_change_manager_schedule(mock_validate, mock_db_handle, mock_cpus):
+    assert ChangeManager(sentinel.conf_location).engine.limits == {
+        "memory": "512MiB", "map": "1024MiB", "thread": "2"}
+    mock_validate.return_value["wp_server"]["schedule"]["magick_limits"] = \
+        {"thread": "1"}
+    assert ChangeManager(sentinel.conf_location).engine.limits == \
+           {"thread": "1"}
+
+
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "sentinel.uploads_dir"
+           },
+           "sql": sentinel.sql,
+       })
+def test_change_manager_getstate_drops_db(mock_validate, mock_db_handle):
+    optimiser = ChangeManager(sentinel.conf_location)
+    state = optimiser.__getstate__()
+    assert state["db"] is None
+    assert state["root_dir"] == "sentinel.uploads_dir"
+    assert optimiser.db == mock_db_handle.return_value
 
 
 @patch("optimiser.json.load", autospec=True, return_value={
@@ -125,28 +267,101 @@ def test_get_q_png():
         assert ChangeManager.get_q(fake_instance, "png", i/10) == 50
 
 
-@patch("optimiser.os.stat", autospec=True)
-@patch("optimiser.os.walk", autospec=True, return_value=[
-    ("sentinel/root/folder1", None, ["f1.png", "f2.webp", "f3.txt"]),
-    ("sentinel/root/folder2", None, []),
-    ("sentinel/root/folder3", None, ["f4.png", "f5.webp", "f6.txt"]),
-])
-def test_stat_all_imgs(mock_walk, mock_stat):
-    mock_stat.return_value.st_mtime = sentinel.mtime
+@pytest.fixture
+def uploads_tree(tmp_path):
+    """A root, with an old settled month folder and a freshly changed one."""
+    for sub, files in [("2021/01", ["f1.png", "f2.webp", "f3.txt"]),
+                       ("2022/08", ["f4.png", "f5.jpg", "f6.txt",
+                                    "f5.jpg.webp"]),
+                       ("empty", [])]:
+        (tmp_path / sub).mkdir(parents=True)
+        for f in files:
+            (tmp_path / sub / f).write_bytes(b"x")
+    old = time.time() - DIR_SETTLE_SECS - 60
+    for sub in ["", "2021", "2021/01", "2022", "empty"]:
+        os.utime(tmp_path / sub, (old, old))
     fake_instance = Mock()
-    fake_instance.root_dir = "sentinel/root/"
-    img_mtimes = ChangeManager.stat_all_imgs(fake_instance)
+    fake_instance.root_dir = str(tmp_path) + "/"
+    return fake_instance
+
+
+def stat_all_imgs(uploads_tree, recorded):
+    """:return: what scan_imgs yields, as maps of mtimes and settled dirs."""
+    img_mtimes = {}
+    settled = []
+    for subfolder, mtimes, dir_state in ChangeManager.scan_imgs(
+            uploads_tree, recorded):
+        if mtimes:
+            img_mtimes[subfolder] = mtimes
+        if dir_state is not None:
+            settled.append(dir_state)
+    return img_mtimes, settled
+
+
+def test_scan_imgs(uploads_tree):
+    img_mtimes, settled = stat_all_imgs(uploads_tree, {})
+    root = uploads_tree.root_dir
     assert img_mtimes == {
-        "folder1": {
-            "f1.png": sentinel.mtime,
-            "f2.webp": sentinel.mtime,
+        "2021/01": {
+            "f1.png": os.stat(root + "2021/01/f1.png").st_mtime,
+            "f2.webp": os.stat(root + "2021/01/f2.webp").st_mtime,
         },
-        "folder3": {
-            "f4.png": sentinel.mtime,
-            "f5.webp": sentinel.mtime,
+        "2022/08": {
+            "f4.png": os.stat(root + "2022/08/f4.png").st_mtime,
+            "f5.jpg": os.stat(root + "2022/08/f5.jpg").st_mtime,
         },
     }
-    mock_walk.assert_called_once_with(fake_instance.root_dir)
+    # 2022/08 was changed too recently to be trusted yet.
+    assert sorted(settled) == [
+        DirState("", os.stat(root).st_mtime, ["2021", "2022", "empty"]),
+        DirState("2021", os.stat(root + "2021").st_mtime, ["01"]),
+        DirState("2021/01", os.stat(root + "2021/01").st_mtime, []),
+        DirState("2022", os.stat(root + "2022").st_mtime, ["08"]),
+        DirState("empty", os.stat(root + "empty").st_mtime, []),
+    ]
+
+
+@patch("optimiser.os.scandir", autospec=True, wraps=os.scandir)
+def test_scan_imgs_skips_unchanged_dirs(mock_scandir, uploads_tree):
+    _, settled = stat_all_imgs(uploads_tree, {})
+    recorded = {d.rel_path: d for d in settled}
+    mock_scandir.reset_mock()
+    img_mtimes, settled_again = stat_all_imgs(
+        uploads_tree, recorded)
+    assert list(img_mtimes.keys()) == ["2022/08"]
+    assert settled_again == []
+    mock_scandir.assert_called_once_with(uploads_tree.root_dir + "2022/08")
+
+
+def test_scan_imgs_sees_changes_in_deep_dirs(uploads_tree):
+    _, settled = stat_all_imgs(uploads_tree, {})
+    recorded = {d.rel_path: d for d in settled}
+    # Changing 2021/01 alters neither the root's mtime nor that of 2021.
+    new_img = uploads_tree.root_dir + "2021/01/new.png"
+    with open(new_img, "wb") as f:
+        f.write(b"y")
+    img_mtimes, _ = stat_all_imgs(uploads_tree, recorded)
+    assert img_mtimes["2021/01"]["new.png"] == os.stat(new_img).st_mtime
+
+
+def test_scan_dirs(uploads_tree):
+    root = uploads_tree.root_dir
+    assert list(ChangeManager.scan_dirs(
+        uploads_tree, ["2021/01", "gone", "2022/08"])) == [
+        ("2021/01", {"f1.png": os.stat(root + "2021/01/f1.png").st_mtime,
+                     "f2.webp": os.stat(root + "2021/01/f2.webp").st_mtime},
+         DirState("2021/01", os.stat(root + "2021/01").st_mtime, [])),
+        ("2022/08", {"f4.png": os.stat(root + "2022/08/f4.png").st_mtime,
+                     "f5.jpg": os.stat(root + "2022/08/f5.jpg").st_mtime},
+         None),
+    ]
+
+
+def test_scan_imgs_vanished_dir(uploads_tree):
+    recorded = {"": DirState("", os.stat(uploads_tree.root_dir).st_mtime,
+                             ["2021", "2022", "gone"])}
+    img_mtimes, _ = stat_all_imgs(uploads_tree, recorded)
+    assert sorted(img_mtimes.keys()) == ["2021/01", "2022/08"]
 
 
 @pytest.fixture
@@ -189,9 +404,17 @@ def test_try_improve_downscales(mock_validate, mock_db_handle, mock_scaler, mock
         extension, sample_fstr_vars, sample_metadata, '2022/08')
 
     mock_magick.assert_has_calls([
-        call(sample_fstr_vars, optimiser.scaling_cmds[extension]),
-        call(sample_fstr_vars, optimiser.thumbnail_cmds[extension]),
+        call(dict(sample_fstr_vars, w=273, h=300,
+                  dest_img="sentinel.uploads_dir/2022/08/f1-273x300.png"),
+             optimiser.scaling_cmds[extension], optimiser.engine, None,
+             None, None),
+        call(dict(sample_fstr_vars, w=150, h=150, w1=150, h1=150,
+                  dest_img="sentinel.uploads_dir/2022/08/f1-150x150.png"),
+             optimiser.thumbnail_cmds[extension], optimiser.engine, None,
+             None, None),
     ])
+    assert sample_metadata["sizes"]["medium"]["filesize"] == 25775
+    assert sample_metadata["sizes"]["thumbnail"]["filesize"] == 9394
     mock_scaler.assert_called_once_with(530, 583)
     mock_scaler.return_value.get_uncropped_thumb.assert_called_once_with(
         150,150)
@@ -202,30 +425,468 @@ def test_try_improve_downscales(mock_validate, mock_db_handle, mock_scaler, mock
     assert res_mtime == sentinel.mtime
 
 
-@patch("optimiser.cmn.get_file_group", autospec=True, return_value="mock_group")
-@patch("optimiser.cmn.get_file_owner", autospec=True, return_value="mock_owner")
-@patch("optimiser.cmn.split_fstring_not_args", autospec=True)
-@patch("optimiser.cmn.run_shell_cmd", autospec=True)
-@patch("optimiser.cmn.get_file_size", autospec=True, side_effect=[150, 50])
-def test_magick_on_img_replacing(mock_get_file_size, mock_run_shell, mock_split_not_args, mock_get_owner, mock_get_group):
-    final_destination = "/blah/prefix/blah/dest_img_value.decoration"
+def test_magick_on_img_replacing(existing_img):
     f_str_vars = {
-        "dest_img": final_destination
+        "dest_img": existing_img
     }
     mock_cmd = "sub me a {6inchsub} for a {footlong}"
-    assert _magick_on_img(f_str_vars, mock_cmd)
-    tmp_name = "/tmp/staged_dest_img_value.decoration"
-    assert f_str_vars["dest_img"] == tmp_name
-    mock_split_not_args.assert_called_once_with(f_str_vars, mock_cmd)
-    mock_get_file_size.assert_has_calls([
-        call(final_destination),
-        call(tmp_name)
-    ])
-    mock_run_shell.assert_has_calls([
-        call(mock_split_not_args.return_value),
-        call(["sudo", "mv", tmp_name, final_destination]),
-        call(["sudo", "chown", "mock_owner:mock_group", final_destination]),
-    ])
+    engine = writing_engine(40)
+    st = os.stat(existing_img)
+    encodes = []
+    assert _magick_on_img(f_str_vars, mock_cmd, engine, encodes) == 40
+    assert encodes == [{
+        "file": "dest_img_value.png", "engine": engine.name,
+        "engine_secs": encodes[0]["engine_secs"], "bytes_in": 100,
+        "bytes_out": 40, "accepted": True}]
+    tmp_name = f_str_vars["dest_img"]
+    assert not os.path.exists(tmp_name)
+    with open(existing_img, "rb") as f:
+        assert f.read() == b"m" * 40
+    new_st = os.stat(existing_img)
+    assert (new_st.st_uid, new_st.st_gid, new_st.st_mode) == \
+           (st.st_uid, st.st_gid, st.st_mode)
+    assert os.listdir(os.path.dirname(existing_img)) == ["dest_img_value.png"]
+
+
+@patch("optimiser.os.chown", autospec=True)
+def test_magick_on_img_replacing_restores_owner(mock_chown, existing_img):
+    real_stat = os.stat
+    owned_by_other = Mock(st_size=100, st_uid=33, st_gid=34,
+                          st_mode=real_stat(existing_img).st_mode)
+    f_str_vars = {"dest_img": existing_img}
+    with patch("optimiser.os.stat", side_effect=lambda path: owned_by_other
+               if path == existing_img else real_stat(path)):
+        assert _magick_on_img(f_str_vars, "cmd", writing_engine(40)) == 40
+    mock_chown.assert_called_once_with(f_str_vars["dest_img"], 33, 34)
+
+
+@pytest.mark.parametrize("sudo_result, replaced", [("", True), (None, False)])
+@patch("optimiser.cmn.run_shell_cmd", autospec=True)
+@patch("optimiser.os.chown", autospec=True,
+       side_effect=PermissionError(errno.EPERM, "Operation not permitted"))
+def test_magick_on_img_replacing_with_sudo(
+        mock_chown, mock_run_shell, sudo_result, replaced, existing_img):
+    mock_run_shell.return_value = sudo_result
+    real_stat = os.stat
+    owned_by_other = Mock(st_size=100, st_uid=33, st_gid=34,
+                          st_mode=real_stat(existing_img).st_mode)
+    f_str_vars = {"dest_img": existing_img}
+    with patch("optimiser.os.stat", side_effect=lambda path: owned_by_other
+               if path == existing_img else real_stat(path)):
+        if replaced:
+            assert _magick_on_img(f_str_vars, "cmd", writing_engine(40)) == 40
+        else:
+            with pytest.raises(CompressorException):
+                _magick_on_img(f_str_vars, "cmd", writing_engine(40))
+    tmp_name = f_str_vars["dest_img"]
+    sudo_cmds = [call(["sudo", "mv", tmp_name, existing_img]),
+                 call(["sudo", "chown", "33:34", existing_img])]
+    mock_run_shell.assert_has_calls(sudo_cmds if replaced else sudo_cmds[:1])
+    assert os.listdir(os.path.dirname(existing_img)) == ["dest_img_value.png"]
+
+
+def test_magick_on_img_cached(existing_img):
+    cache = EncodeCache("magick", {}.get)
+    f_str_vars = {"q": 32, "src_img": existing_img, "dest_img": existing_img}
+    encodes = []
+    assert _magick_on_img(dict(f_str_vars), "cmd", writing_engine(120),
+                          encodes, cache) is None
+    cache.settle()
+    key, size = encodes[0]["cache"]
+    assert size == 120
+    # Next time the cache knows better than to encode.
+    cache = EncodeCache("magick", {key: size}.get)
+    engine = writing_engine(120)
+    encodes = []
+    assert _magick_on_img(dict(f_str_vars), "cmd", engine, encodes,
+                          cache) is None
+    engine.render.assert_not_called()
+    cache.settle()
+    assert encodes == [{"file": "dest_img_value.png", "engine": engine.name,
+                        "cached": True, "cache": (key, 120)}]
+
+
+def test_magick_on_img_cached_once_replaced(existing_img):
+    cache = EncodeCache("magick", {}.get)
+    f_str_vars = {"q": 32, "src_img": existing_img, "dest_img": existing_img}
+    encodes = []
+    assert _magick_on_img(dict(f_str_vars), "cmd", writing_engine(40),
+                          encodes, cache) == 40
+    cache.settle()
+    # Keyed on what we replaced it with.
+    assert encodes[0]["cache"] == (cache.key(
+        "cmd", f_str_vars, existing_img, existing_img), 40)
+    assert EncodeCache("magick", Mock()).key(
+        "cmd", f_str_vars, existing_img, existing_img) == \
+           encodes[0]["cache"][0]
+
+
+def test_magick_on_imgs_all_cached(tmp_path):
+    src = tmp_path / "f1.png"
+    src.write_bytes(b"e" * 10)
+    outputs = [({"q": 32, "src_img": str(src), "dest_img": str(src)},
+                "convert -strip -colors {q} {src_img} {dest_img}")]
+    cache = EncodeCache("magick", Mock(return_value=20))
+    engine = writing_engine(20)
+    encodes = []
+    assert _magick_on_imgs(str(src), outputs, engine, encodes, cache) == [None]
+    engine.render_many.assert_not_called()
+    assert encodes[0]["cached"]
+
+
+def test_magick_on_img_precheck_skips(existing_img):
+    precheck = Mock()
+    precheck.predict_no_saving.return_value = "png_palette"
+    precheck.audit.return_value = False
+    engine = writing_engine(40)
+    encodes = []
+    assert _magick_on_img({"q": 32, "dest_img": existing_img}, "cmd", engine,
+                          encodes, None, precheck) is None
+    engine.render.assert_not_called()
+    assert encodes == [{"file": "dest_img_value.png", "engine": engine.name,
+                        "skipped": "png_palette"}]
+
+
+def test_magick_on_img_precheck_audited(existing_img):
+    precheck = Mock()
+    precheck.predict_no_saving.return_value = "png_palette"
+    precheck.audit.return_value = True
+    encodes = []
+    assert _magick_on_img({"q": 32, "dest_img": existing_img}, "cmd",
+                          writing_engine(40), encodes, None, precheck) == 40
+    assert encodes[0]["audited"] == "png_palette"
+    assert encodes[0]["accepted"]
+
+
+def test_staging_names_are_unique(tmp_path):
+    a_dest = str(tmp_path / "a.png")
+    assert _staging_name(a_dest) != _staging_name(a_dest)
+
+
+def test_staging_name_in_unwritable_dir(tmp_path):
+    real_mkstemp = tempfile.mkstemp
+
+    def mkstemp(**kwargs):
+        if "dir" in kwargs:
+            raise PermissionError(errno.EACCES, "Permission denied")
+        return real_mkstemp(**kwargs)
+
+    with patch("optimiser.tempfile.mkstemp", side_effect=mkstemp):
+        tmp_name = _staging_name(str(tmp_path / "a.png"))
+    assert os.path.dirname(tmp_name) == tempfile.gettempdir()
+    assert os.path.basename(tmp_name).startswith(".staged_")
+    assert tmp_name.endswith("_a.png")
+    os.remove(tmp_name)
+
+
+def test_magick_on_imgs(tmp_path):
+    big = tmp_path / "f1-273x300.png"
+    big.write_bytes(b"e" * 100)
+    small = tmp_path / "f1.png"
+    small.write_bytes(b"e" * 10)
+    outputs = [
+        ({"q": 32, "w": 273, "h": 300, "dest_img": str(big)},
+         "convert -strip -resize {w}x{h} -colors {q} {src_img} {dest_img}"),
+        ({"q": 32, "dest_img": str(small)},
+         "convert -strip -colors {q} {src_img} {dest_img}"),
+    ]
+    engine = writing_engine(20)
+    encodes = []
+    assert _magick_on_imgs(str(small), outputs, engine, encodes) == [20, None]
+    assert [(e["file"], e["bytes_in"], e["bytes_out"], e["accepted"])
+            for e in encodes] == [("f1-273x300.png", 100, 20, True),
+                                  ("f1.png", 10, 20, False)]
+    engine.render_many.assert_called_once_with(str(small), outputs)
+    assert [os.path.dirname(o[0]["dest_img"]) for o in outputs] == \
+           [str(tmp_path)] * 2
+    assert sorted(os.listdir(tmp_path)) == ["f1-273x300.png", "f1.png"]
+    assert big.read_bytes() == b"m" * 20
+    assert small.read_bytes() == b"e" * 10
+
+
+def test_magick_on_imgs_empty_output(tmp_path):
+    # A failed encode may leave its staging file as mkstemp made it.
+    existing = tmp_path / "f1.png"
+    existing.write_bytes(b"e" * 100)
+    outputs = [({"q": 32, "dest_img": str(existing)},
+                "convert -strip -colors {q} {src_img} {dest_img}")]
+    encodes = []
+    assert _magick_on_imgs(str(existing), outputs, writing_engine(0),
+                           encodes) == [None]
+    assert not encodes[0]["accepted"]
+    assert os.listdir(tmp_path) == ["f1.png"]
+    assert existing.read_bytes() == b"e" * 100
+
+
+@pytest.mark.parametrize("many", [False, True])
+def test_magick_on_img_engine_fails(many, existing_img):
+    f_str_vars = {"dest_img": existing_img}
+    engine = Mock()
+    engine.render.side_effect = EngineException("convert failed")
+    engine.render_many.side_effect = EngineException("convert failed")
+    with pytest.raises(EngineException):
+        if many:
+            _magick_on_imgs(existing_img, [(f_str_vars, "cmd")], engine)
+        else:
+            _magick_on_img(f_str_vars, "cmd", engine)
+    assert os.listdir(os.path.dirname(existing_img)) == ["dest_img_value.png"]
+    with open(existing_img, "rb") as f:
+        assert f.read() == b"e" * 100
+
+
+def test_magick_on_imgs_async_engine_fails(existing_img):
+    f_str_vars = {"dest_img": existing_img}
+    engine = Mock()
+    engine.render_many_async.side_effect = EngineException("convert failed")
+    with pytest.raises(EngineException):
+        asyncio.run(_magick_on_imgs_async(
+            existing_img, [(f_str_vars, "cmd")], asyncio.Semaphore(1),
+            engine))
+    assert os.listdir(os.path.dirname(existing_img)) == ["dest_img_value.png"]
+
+
+def test_is_upload():
+    assert _is_upload("f1-150x150.png")
+    assert not _is_upload("f1-150x150.png.webp")
+    assert not _is_upload(".staged_f1.png")
+    assert not _is_upload("notes.txt")
+
+
+def test_is_variant():
+    assert _is_variant("f1-150x150.png.webp")
+    assert _is_variant("f1.JPG.avif")
+    assert not _is_variant("f1.webp")
+    assert not _is_variant("f1.webp.png")
+    assert not _is_variant("v1.2.webp")
+
+
+@pytest.mark.parametrize("n_bytes, kept", [(40, True), (100, False)])
+def test_magick_on_img_variant(existing_img, n_bytes, kept):
+    os.chmod(existing_img, 0o640)
+    variant = existing_img + ".webp"
+    f_str_vars = {"q": 60, "src_img": existing_img, "dest_img": variant}
+    encodes = []
+    engine = writing_engine(n_bytes)
+    assert _magick_on_img(f_str_vars, "convert {src_img} {dest_img}", engine,
+                          encodes, sibling=existing_img) == \
+           (n_bytes if kept else None)
+    assert [(e["file"], e["bytes_in"], e["bytes_out"], e["accepted"],
+             e["variant"]) for e in encodes] == [
+        ("dest_img_value.png.webp", 100, n_bytes, kept, True)]
+    assert os.path.exists(variant) == kept
+    if kept:
+        assert os.stat(variant).st_mode & 0o777 == 0o640
+    with open(existing_img, "rb") as f:
+        assert f.read() == b"e" * 100
+    assert len(os.listdir(os.path.dirname(existing_img))) == 1 + kept
+
+
+def test_magick_on_img_variant_rejected_removes_old(existing_img):
+    variant = existing_img + ".webp"
+    with open(variant, "wb") as f:
+        f.write(b"v" * 70)
+    f_str_vars = {"q": 60, "src_img": existing_img, "dest_img": variant}
+    assert _magick_on_img(f_str_vars, "convert {src_img} {dest_img}",
+                          writing_engine(100), sibling=existing_img) is None
+    assert os.listdir(os.path.dirname(existing_img)) == ["dest_img_value.png"]
+
+
+def test_magick_on_img_variant_cached(existing_img):
+    variant = existing_img + ".webp"
+    cache = EncodeCache("magick", Mock(return_value=60))
+    f_str_vars = {"q": 60, "src_img": existing_img, "dest_img": variant}
+    engine = writing_engine(60)
+    encodes = []
+    assert _magick_on_img(f_str_vars, "cmd", engine, encodes, cache,
+                          sibling=existing_img) is None
+    engine.render.assert_not_called()
+    cache.settle()
+    assert encodes[0]["cached"]
+    assert encodes[0]["cache"] == (cache.key(
+        "cmd", f_str_vars, existing_img, variant, existing_img), 60)
+
+
+def sized_engine(sizes: Dict[str, int]):
+    """
+    As writing_engine, but writing sizes[name] bytes to every dest_img
+    named, once staged, for name.
+    """
+    engine = writing_engine(0)
+
+    def write(f_str_vars, command):
+        for name, n_bytes in sizes.items():
+            if f_str_vars["dest_img"].endswith("_" + name):
+                with open(f_str_vars["dest_img"], "wb") as f:
+                    f.write(b"m" * n_bytes)
+
+    async def write_many_async(src_img, outputs):
+        for f_str_vars, command in outputs:
+            write(f_str_vars, command)
+
+    async def write_async(f_str_vars, command):
+        write(f_str_vars, command)
+
+    engine.render.side_effect = write
+    engine.render_many.side_effect = lambda src_img, outputs: [
+        write(f_str_vars, command) for f_str_vars, command in outputs]
+    engine.render_async.side_effect = write_async
+    engine.render_many_async.side_effect = write_many_async
+    return engine
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+@patch("optimiser.DBHandle", autospec=True)
+def test_shrink_attachment_variants_after_sibling(
+        mock_db_handle, use_async, tmp_path):
+    folder = tmp_path / "2022" / "08"
+    folder.mkdir(parents=True)
+    (folder / "f1.png").write_bytes(b"e" * 100)
+    # Kept last time, when the original was still 100 bytes.
+    (folder / "f1.png.webp").write_bytes(b"v" * 60)
+    with patch("optimiser.ChangeManager.validate_config", return_value={
+            "wp_server": {"wp_uploads": str(tmp_path), "png_q": 32,
+                          "webp_mp_to_max_q": {"0": 70},
+                          "variants": ["webp"]},
+            "sql": sentinel.sql}):
+        optimiser = ChangeManager(sentinel.conf_location)
+    optimiser.engine = sized_engine({"f1.png": 30, "f1.png.webp": 50})
+    img_facts = {"metadata": {"width": 10, "height": 10,
+                              "file": "2022/08/f1.png", "sizes": {}},
+                 "megapix": 0.0001, "id": 7}
+    if use_async:
+        metadata, _, encodes = asyncio.run(optimiser.shrink_attachment_async(
+            "2022/08", "f1.png", img_facts, asyncio.Semaphore(2)))
+    else:
+        metadata, _, encodes = optimiser.shrink_attachment(
+            "2022/08", "f1.png", img_facts)
+    assert metadata["filesize"] == 30
+    # The variant, at 50 bytes, loses to its re-encoded sibling.
+    assert [(e["file"], e["bytes_in"], e["accepted"]) for e in encodes] == [
+        ("f1.png", 100, True), ("f1.png.webp", 30, False)]
+    assert os.listdir(folder) == ["f1.png"]
+
+
+def test_magick_on_img_async(existing_img):
+    f_str_vars = {"dest_img": existing_img}
+    mock_cmd = "sub me a {6inchsub} for a {footlong}"
+    engine = writing_engine(40)
+    encodes = []
+    assert asyncio.run(_magick_on_img_async(
+        f_str_vars, mock_cmd, asyncio.Semaphore(1), engine, encodes)) == 40
+    engine.render_async.assert_called_once_with(f_str_vars, mock_cmd)
+    engine.render.assert_not_called()
+    assert [(e["bytes_in"], e["bytes_out"], e["accepted"])
+            for e in encodes] == [(100, 40, True)]
+    with open(existing_img, "rb") as f:
+        assert f.read() == b"m" * 40
+
+
+def test_magick_on_img_async_cancelled(existing_img):
+    f_str_vars = {"dest_img": existing_img}
+
+    async def cancel_waiting():
+        slots = asyncio.Semaphore(1)
+        async with slots:
+            task = asyncio.ensure_future(_magick_on_img_async(
+                f_str_vars, "convert {src_img} {dest_img}", slots,
+                writing_engine(40)))
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    asyncio.run(cancel_waiting())
+    assert os.listdir(os.path.dirname(existing_img)) == ["dest_img_value.png"]
+    with open(existing_img, "rb") as f:
+        assert f.read() == b"e" * 100
+
+
+@patch("optimiser.os.chown", autospec=True)
+def test_magick_on_imgs_async(mock_chown, tmp_path):
+    big = tmp_path / "f1-273x300.png"
+    big.write_bytes(b"e" * 100)
+    small = tmp_path / "f1.png"
+    small.write_bytes(b"e" * 10)
+    outputs = [
+        ({"q": 32, "w": 273, "h": 300, "dest_img": str(big)},
+         "convert -strip -resize {w}x{h} -colors {q} {src_img} {dest_img}"),
+        ({"q": 32, "dest_img": str(small)},
+         "convert -strip -colors {q} {src_img} {dest_img}"),
+    ]
+    engine = writing_engine(20)
+    assert asyncio.run(_magick_on_imgs_async(
+        str(small), outputs, asyncio.Semaphore(1), engine)) == [20, None]
+    engine.render_many_async.assert_called_once_with(str(small), outputs)
+    assert sorted(os.listdir(tmp_path)) == ["f1-273x300.png", "f1.png"]
+
+
+@patch("optimiser._magick_on_imgs", autospec=True,
+       side_effect=lambda src, outputs, engine, encodes, cache, precheck,
+       siblings: [None, 9394, 31000])
+@patch("optimiser.os.stat", autospec=True)
+@patch("optimiser.ImgScaler", autospec=True)
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "sentinel.uploads_dir",
+               "png_q": 32,
+               "single_decode": True
+           },
+           "sql": sentinel.sql,
+       })
+def test_shrink_attachment_single_decode(mock_validate, mock_db_handle, mock_scaler, mock_stat, mock_magicks, sample_metadata):
+    optimiser = ChangeManager(sentinel.conf_location)
+    mock_scaler.return_value.get_uncropped_thumb = Mock(return_value=(150,150))
+    mock_stat.return_value.st_mtime = 1234.5
+    img_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 7}
+    metadata, latest_mtime, encodes = optimiser.shrink_attachment(
+        "2022/08", "f1.png", img_facts)
+    assert latest_mtime == 1234.5
+    assert metadata["filesize"] == 31000
+    assert metadata["sizes"]["medium"]["filesize"] == 30432
+    assert metadata["sizes"]["thumbnail"]["filesize"] == 9394
+    src_img = "sentinel.uploads_dir/2022/08/f1.png"
+    mock_magicks.assert_called_once_with(src_img, [
+        ({"q": 32, "src_img": src_img, "w": 273, "h": 300,
+          "dest_img": "sentinel.uploads_dir/2022/08/f1-273x300.png"},
+         optimiser.scaling_cmds["png"]),
+        ({"q": 32, "src_img": src_img, "w": 150, "h": 150, "w1": 150, "h1": 150,
+          "dest_img": "sentinel.uploads_dir/2022/08/f1-150x150.png"},
+         optimiser.thumbnail_cmds["png"]),
+        ({"q": 32, "src_img": src_img, "dest_img": src_img},
+         optimiser.noresize_cmds["png"]),
+    ], optimiser.engine, encodes, None, None, [None] * 3)
+    mock_stat.assert_has_calls([
+        call("sentinel.uploads_dir/2022/08/f1-150x150.png"),
+        call(src_img)])
+
+
+@patch("optimiser._keep_if_smaller", autospec=True,
+       side_effect=[None, 9394, 31000])
+@patch("optimiser.ImgScaler", autospec=True)
+@patch("optimiser.DBHandle", autospec=True)
+def test_shrink_from_one_decode_stats_final_names(
+        mock_db_handle, mock_scaler, mock_keep, tmp_path, sample_metadata):
+    folder = tmp_path / "2022" / "08"
+    folder.mkdir(parents=True)
+    for mtime, fl_nm in enumerate(["f1.png", "f1-273x300.png", "f1-150x150.png"]):
+        (folder / fl_nm).write_bytes(b"png")
+        os.utime(folder / fl_nm, (100 + mtime, 100 + mtime))
+    with patch("optimiser.ChangeManager.validate_config", return_value={
+            "wp_server": {"wp_uploads": str(tmp_path), "png_q": 32,
+                          "single_decode": True},
+            "sql": sentinel.sql}):
+        optimiser = ChangeManager(sentinel.conf_location)
+    optimiser.engine = Mock()
+    mock_scaler.return_value.get_uncropped_thumb = Mock(return_value=(150,150))
+    img_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 7}
+    metadata, latest_mtime, _ = optimiser.shrink_attachment(
+        "2022/08", "f1.png", img_facts)
+    # Of the thumbnail, as replaced, rather than its staging file.
+    assert latest_mtime == 102
+    assert metadata["filesize"] == 31000
+    assert metadata["sizes"]["thumbnail"]["filesize"] == 9394
 
 
 def test_get_disk_sizes(sample_metadata):
@@ -233,27 +894,788 @@ def test_get_disk_sizes(sample_metadata):
     assert sum(disk_sizes.values()) == 38543 + 30432 + 10172
 
 
-@patch("optimiser.os.path.exists", autospec=True, return_value=True)
-def test_get_recorded_mtimes(mock_exists):
-    with patch("builtins.open", mock_open(read_data="path1,384.31\nroot1/path1/file1,41.949\n")) as mocked_open:
-        inode_last_mstats = _get_recorded_mtimes()
-    mock_exists.assert_called_once_with(NV_RECORD_PATH)
-    mocked_open.assert_called_once_with(NV_RECORD_PATH, "r", newline='')
-    assert inode_last_mstats["path1"] == 384.31
-    assert inode_last_mstats["root1/path1/file1"] == 41.949
-
-
-@patch("optimiser.csv.writer", autospec=True)
-def test_record_mstats(mock_csv_out):
-    mocked_mstats = {
-        "path1": 384.31,
-        "root1/path1/file1": 41.949,
-    }
-    with patch("builtins.open", mock_open()) as mocked_open:
-        _save_recorded_mtimes(mocked_mstats)
-    mocked_open.assert_called_once_with(NV_RECORD_PATH, "w", newline='')
-    mock_csv_out.assert_called_once_with(mocked_open.return_value)
-    mock_csv_out.return_value.writerow.assert_has_calls([call([x, y]) for x,y in mocked_mstats.items()])
+@patch("optimiser._magick_on_img", side_effect=[25775, 9394, 31000])
+@patch("optimiser.os.stat", autospec=True)
+@patch("optimiser.ImgScaler", autospec=True)
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "sentinel.uploads_dir",
+               "png_q": 32
+           },
+           "sql": sentinel.sql,
+       })
+def test_shrink_attachment(mock_validate, mock_db_handle, mock_scaler, mock_stat, mock_magick, sample_metadata):
+    optimiser = ChangeManager(sentinel.conf_location)
+    mock_scaler.return_value.get_uncropped_thumb = Mock(return_value=(150,150))
+    mock_stat.return_value.st_mtime = 1234.5
+    img_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 7}
+    metadata, latest_mtime, encodes = optimiser.shrink_attachment(
+        "2022/08", "f1.png", img_facts)
+    assert latest_mtime == 1234.5
+    assert metadata["filesize"] == 31000
+    assert metadata["sizes"]["medium"]["filesize"] == 25775
+    assert metadata["sizes"]["thumbnail"]["filesize"] == 9394
+    # The facts of the coordinator are untouched.
+    assert sample_metadata["filesize"] == 38543
+    assert mock_magick.call_args_list[-1] == call(
+        {"q": 32, "src_img": "sentinel.uploads_dir/2022/08/f1.png",
+         "dest_img": "sentinel.uploads_dir/2022/08/f1.png"},
+        optimiser.noresize_cmds["png"], optimiser.engine, encodes, None,
+        None)
+
+
+@patch("optimiser._magick_on_img_async", autospec=True,
+       side_effect=[25775, 9394, 31000])
+@patch("optimiser.os.stat", autospec=True)
+@patch("optimiser.ImgScaler", autospec=True)
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "sentinel.uploads_dir",
+               "png_q": 32,
+               "async_converts": 4
+           },
+           "sql": sentinel.sql,
+       })
+def test_shrink_attachment_async(mock_validate, mock_db_handle, mock_scaler, mock_stat, mock_magick, sample_metadata):
+    optimiser = ChangeManager(sentinel.conf_location)
+    assert optimiser.async_converts == 4
+    mock_scaler.return_value.get_uncropped_thumb = Mock(return_value=(150,150))
+    mock_stat.return_value.st_mtime = 1234.5
+    img_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 7}
+    metadata, latest_mtime, encodes = asyncio.run(
+        optimiser.shrink_attachment_async(
+            "2022/08", "f1.png", img_facts, sentinel.slots))
+    assert latest_mtime == 1234.5
+    assert metadata["filesize"] == 31000
+    assert metadata["sizes"]["medium"]["filesize"] == 25775
+    assert metadata["sizes"]["thumbnail"]["filesize"] == 9394
+    assert sample_metadata["filesize"] == 38543
+    # The original is re-encoded last.
+    assert mock_magick.call_args_list[-1] == call(
+        {"q": 32, "src_img": "sentinel.uploads_dir/2022/08/f1.png",
+         "dest_img": "sentinel.uploads_dir/2022/08/f1.png"},
+        optimiser.noresize_cmds["png"], sentinel.slots, optimiser.engine,
+        encodes, None, None)
+
+
+@patch("optimiser.ImgScaler", autospec=True)
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "up/",
+               "png_q": 32,
+               "webp_mp_to_max_q": {"0": 70, "0.2": 60},
+               "variants": ["webp"]
+           },
+           "sql": sentinel.sql,
+       })
+def test_plan_variants(mock_validate, mock_db_handle, mock_scaler, sample_metadata):
+    optimiser = ChangeManager(sentinel.conf_location)
+    mock_scaler.return_value.get_uncropped_thumb = Mock(return_value=(150,165))
+    f_str_vars = {"q": 32, "src_img": "up/2022/08/f1.png", "dest_img": None}
+    plans = optimiser.plan_all("png", f_str_vars, sample_metadata, "2022/08")
+    variants = optimiser.plan_variants(plans, sample_metadata)
+    assert [(v["dest_img"], v["q"], cmd, sibling)
+            for v, cmd, sibling in variants] == [
+        ("up/2022/08/f1-273x300.png.webp", 60,
+         optimiser.scaling_cmds["webp"], "up/2022/08/f1-273x300.png"),
+        ("up/2022/08/f1-150x150.png.webp", 60,
+         optimiser.thumbnail_cmds["webp"], "up/2022/08/f1-150x150.png"),
+        ("up/2022/08/f1.png.webp", 60,
+         optimiser.noresize_cmds["webp"], "up/2022/08/f1.png"),
+    ]
+    assert variants[1][0]["w1"] == 150
+    # The plans themselves are untouched, and webp isn't a source.
+    assert plans[0][1]["q"] == 32
+    f_str_vars["src_img"] = "up/2022/08/f1.webp"
+    assert optimiser.plan_variants(optimiser.plan_all(
+        "webp", f_str_vars, sample_metadata, "2022/08"),
+        sample_metadata) == []
+    mock_validate.return_value["wp_server"]["variants"] = ["jxl"]
+    with pytest.raises(CompressorException):
+        ChangeManager(sentinel.conf_location)
+
+
+@patch("optimiser.QualitySearch.timed_search", autospec=True,
+       return_value=(41, {"q_search": 3}))
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "sentinel.uploads_dir",
+               "quality_search": {"ssim": 0.9}
+           },
+           "sql": sentinel.sql,
+       })
+def test_search_q(mock_validate, mock_db_handle, mock_search):
+    optimiser = ChangeManager(sentinel.conf_location)
+    assert optimiser.quality_search.target == 0.9
+    f_str_vars = {"q": 70, "src_img": "up/f1.jpg", "dest_img": None}
+    encodes = []
+    optimiser.search_q("jpg", f_str_vars, encodes)
+    assert f_str_vars["q"] == 41
+    assert encodes == [{"q_search": 3}]
+    mock_search.assert_called_once_with(
+        optimiser.quality_search, "up/f1.jpg", optimiser.noresize_cmds["jpg"],
+        optimiser.engine, 70)
+    f_str_vars = {"q": 32, "src_img": "up/f1.png", "dest_img": None}
+    optimiser.search_q("png", f_str_vars, encodes)
+    assert f_str_vars["q"] == 32
+    assert len(encodes) == 1
+
+
+@patch("optimiser.QualitySearch.timed_search", autospec=True,
+       return_value=(41, {"q_search": 3}))
+@patch("optimiser.DBHandle", autospec=True)
+@patch("optimiser.ChangeManager.validate_config",
+       return_value={
+           "wp_server": {
+               "wp_uploads": "sentinel.uploads_dir",
+               "quality_search": {"ssim": 0.9}
+           },
+           "sql": sentinel.sql,
+       })
+def test_search_q_cached(mock_validate, mock_db_handle, mock_search, tmp_path):
+    optimiser = ChangeManager(sentinel.conf_location)
+    src = tmp_path / "f1.jpg"
+    src.write_bytes(b"original")
+    found = {}
+    cache = EncodeCache("magick", found.get)
+    encodes = []
+    optimiser.search_q("jpg", {"q": 70, "src_img": str(src)}, encodes, cache)
+    src.write_bytes(b"re-encoded at 41")
+    cache.replaced(str(src))
+    cache.settle()
+    found.update([encodes[0]["cache"]])
+    # Revisiting what we re-encoded, the search isn't repeated against it.
+    f_str_vars = {"q": 70, "src_img": str(src)}
+    encodes = []
+    optimiser.search_q("jpg", f_str_vars, encodes,
+                       EncodeCache("magick", found.get))
+    assert f_str_vars["q"] == 41
+    assert encodes == [{"file": "f1.jpg", "engine": "magick", "q_search": 0,
+                        "cached": True, "q": 41, "max_q": 70}]
+    mock_search.assert_called_once()
+    # Nor is it reused for another quality bucket.
+    optimiser.search_q("jpg", {"q": 60, "src_img": str(src)}, encodes,
+                       EncodeCache("magick", found.get))
+    assert mock_search.call_count == 2
+
+
+@patch("optimiser.ProcessPoolExecutor", ThreadPoolExecutor)
+@patch("optimiser.ChangeManager.examine_attachment", autospec=True,
+       side_effect=lambda self, sub, nm, facts: (facts, len(nm)))
+def test_run_jobs_pooled(mock_shrink):
+    fake_instance = Mock()
+    fake_instance.workers = 4
+    fake_instance.async_converts = 0
+    fake_instance.metrics = Metrics()
+    fake_instance.examine_attachment = lambda *job: mock_shrink(fake_instance, *job)
+    fake_instance.schedule = {}
+    fake_instance.scheduler = lambda jobs, slots: ChangeManager.scheduler(
+        fake_instance, jobs, slots)
+    fake_instance.completed = lambda futures: ChangeManager.completed(
+        fake_instance, futures)
+    jobs = [("2022/08", "f{}.png".format("1" * i), {"id": i, "megapix": 0.3}) for i in range(20)]
+    taken = []
+
+    def lazy_jobs():
+        for job in jobs:
+            taken.append(job)
+            yield job
+
+    results = ChangeManager.run_jobs(fake_instance, lazy_jobs())
+    first = next(results)
+    # Jobs are only read ahead so far.
+    assert len(taken) == 4 * optimiser.IN_FLIGHT_PER_WORKER
+    results = [first] + list(results)
+    assert sorted(results, key=lambda r: r[0][2]["id"]) == [
+        (job, (job[2], len(job[1]))) for job in jobs]
+    assert mock_shrink.call_count == 20
+
+
+def test_run_jobs_inline():
+    fake_instance = Mock()
+    fake_instance.workers = 1
+    fake_instance.async_converts = 0
+    fake_instance.metrics = Metrics()
+    fake_instance.examine_attachment = Mock(side_effect=[sentinel.r1, sentinel.r2])
+    jobs = [("a", "f1.png", sentinel.f1), ("b", "f2.png", sentinel.f2)]
+    assert list(ChangeManager.run_jobs(fake_instance, iter(jobs))) == [
+        (jobs[0], sentinel.r1), (jobs[1], sentinel.r2)]
+    fake_instance.examine_attachment.assert_has_calls([
+        call(*jobs[0]), call(*jobs[1])])
+    assert "imaging" in fake_instance.metrics.phase_secs
+
+
+def test_run_jobs_async():
+    fake_instance = Mock()
+    fake_instance.async_converts = 2
+    fake_instance.metrics = Metrics()
+    running = []
+    most_running = []
+
+    async def shrink(subfolder, file_nm, img_facts, slots):
+        async with slots:
+            running.append(file_nm)
+            most_running.append(len(running))
+            await asyncio.sleep(0.01 * (img_facts["id"] % 3))
+            running.remove(file_nm)
+        return img_facts, len(file_nm)
+
+    fake_instance.examine_attachment_async = shrink
+    fake_instance.schedule = {}
+    fake_instance.scheduler = lambda jobs, slots: ChangeManager.scheduler(
+        fake_instance, jobs, slots)
+    fake_instance.completed_tasks = lambda loop, tasks: \
+        ChangeManager.completed_tasks(fake_instance, loop, tasks)
+    jobs = [("2022/08", "f{}.png".format("1" * i), {"id": i, "megapix": 0.3}) for i in range(9)]
+    taken = []
+
+    def lazy_jobs():
+        for job in jobs:
+            taken.append(job)
+            yield job
+
+    results = ChangeManager.run_jobs_async(fake_instance, lazy_jobs())
+    first = next(results)
+    assert len(taken) == 2 * optimiser.IN_FLIGHT_PER_WORKER
+    results = [first] + list(results)
+    assert sorted(results, key=lambda r: r[0][2]["id"]) == [
+        (job, (job[2], len(job[1]))) for job in jobs]
+    assert max(most_running) == 2
+    assert "imaging" in fake_instance.metrics.phase_secs
+
+
+def test_run_jobs_async_cancels_when_closed():
+    fake_instance = Mock()
+    fake_instance.async_converts = 1
+    fake_instance.metrics = Metrics()
+    cancelled = []
+
+    async def shrink(subfolder, file_nm, img_facts, slots):
+        try:
+            await asyncio.sleep(0 if img_facts["id"] == 0 else 30)
+        except asyncio.CancelledError:
+            cancelled.append(file_nm)
+            raise
+        return img_facts, 0
+
+    fake_instance.examine_attachment_async = shrink
+    fake_instance.schedule = {}
+    fake_instance.scheduler = lambda jobs, slots: ChangeManager.scheduler(
+        fake_instance, jobs, slots)
+    fake_instance.completed_tasks = lambda loop, tasks: \
+        ChangeManager.completed_tasks(fake_instance, loop, tasks)
+    jobs = [("a", "f{}.png".format(i), {"id": i, "megapix": 0.3}) for i in range(3)]
+    results = ChangeManager.run_jobs_async(fake_instance, iter(jobs))
+    assert next(results)[0] == jobs[0]
+    results.close()
+    assert cancelled == ["f1.png"]
+
+
+@patch("optimiser.ProcessPoolExecutor", ThreadPoolExecutor)
+@pytest.mark.parametrize("workers,async_converts", [(1, 0), (2, 0), (1, 2)])
+def test_run_jobs_past_failure(workers, async_converts, capsys):
+    fake_instance = Mock()
+    fake_instance.workers = workers
+    fake_instance.async_converts = async_converts
+    fake_instance.metrics = Metrics()
+    fake_instance.schedule = {}
+    fake_instance.scheduler = lambda jobs, slots: ChangeManager.scheduler(
+        fake_instance, jobs, slots)
+    fake_instance.completed = lambda futures: ChangeManager.completed(
+        fake_instance, futures)
+    fake_instance.completed_tasks = lambda loop, tasks: \
+        ChangeManager.completed_tasks(fake_instance, loop, tasks)
+    fake_instance.run_jobs_async = lambda jobs: ChangeManager.run_jobs_async(
+        fake_instance, jobs)
+
+    def shrink(subfolder, file_nm, img_facts):
+        if img_facts["id"] == 0:
+            raise EngineException("convert failed")
+        return img_facts["id"]
+
+    async def shrink_async(subfolder, file_nm, img_facts, slots):
+        return shrink(subfolder, file_nm, img_facts)
+
+    fake_instance.examine_attachment = shrink
+    fake_instance.examine_attachment_async = shrink_async
+    jobs = [("2022/08", "f{}.png".format(i), {"id": i, "megapix": 0.3})
+            for i in range(3)]
+    results = ChangeManager.run_jobs(fake_instance, iter(jobs))
+    assert sorted(results, key=lambda r: r[0][2]["id"]) == [
+        (jobs[0], None), (jobs[1], 1), (jobs[2], 2)]
+    printed = capsys.readouterr()
+    assert "Failed to shrink 2022/08/f0.png" in printed.out
+    assert "EngineException: convert failed" in printed.err
+
 
+def test_dirs_in_progress():
+    dirs = DirsInProgress()
+    a, b = DirState("a", 1.0, []), DirState("b", 1.0, [])
+    dirs.listed("a", a, 2)
+    dirs.listed("b", b, 0)
+    dirs.listed("c", None, 1)
+    assert dirs.take_settled() == [b]
+    dirs.done("a")
+    dirs.done("c")
+    assert dirs.take_settled() == []
+    dirs.done("a")
+    assert dirs.take_settled() == [a]
+    assert dirs.outstanding == {}
 
 
+def test_match_jobs(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.state.get_mtimes_for.side_effect = [
+        {"2022/08/f1.png": 10.0, "2022/08/old.png": 99.0}, {}]
+    img_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 7}
+    opt_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 9}
+    fake_instance.sequester_data_by_rel_file_paths.return_value = {
+        "2022/08/f1.png": img_facts,
+        "2022/08/opt.png": opt_facts}
+    dir_state = DirState("2022/08", 5.0, [])
+    just_now = time.time()
+    listings = [
+        ("2022/08", {"f1.png": 20.0, "f1-150x150.png": 20.0, "old.png": 50.0,
+                     "opt.png": 20.0, "new.png": just_now}, dir_state),
+        ("empty", {}, None)]
+    dirs = DirsInProgress()
+    jobs = ChangeManager.match_jobs(fake_instance, iter(listings), dirs)
+    assert next(jobs) == ("2022/08", "f1.png", img_facts)
+    assert dirs.outstanding == {"2022/08": [dir_state, 2]}
+    assert list(jobs) == [("2022/08", "opt.png", opt_facts)]
+    fake_instance.state.get_mtimes_for.assert_has_calls([
+        call(["2022/08/f1.png", "2022/08/f1-150x150.png", "2022/08/old.png",
+              "2022/08/opt.png", "2022/08/new.png"]),
+        call([])])
+    # Only those changed are looked up, and nothing for an empty folder.
+    fake_instance.sequester_data_by_rel_file_paths.assert_called_once_with(
+        ["2022/08/f1.png", "2022/08/f1-150x150.png", "2022/08/opt.png",
+         "2022/08/new.png"])
+    assert fake_instance.metrics.counters == {
+        "files_seen": 5, "files_changed": 4, "attachments": 2}
+    # Not an attachment, so not looked up again, unless it is too new to
+    # be sure WordPress won't yet make it one.
+    assert dirs.take_unattached() == [
+        FileState("2022/08/f1-150x150.png", 20.0, outcome="unattached")]
+
+
+def fake_match_jobs(jobs_by_dir):
+    """Stands in for match_jobs, telling dirs of each directory's jobs."""
+    def match_jobs(listings, dirs):
+        for dir_state, jobs in jobs_by_dir:
+            dirs.listed(dir_state.rel_path, dir_state, len(jobs))
+            yield from jobs
+    return match_jobs
+
+
+def test_check_all_uploads(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.commit_every = 100
+    fake_instance.checkpoint_secs = 60
+    img_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 7}
+    opt_facts = {"metadata": sample_metadata, "megapix": 0.3, "id": 9}
+    dir_state = DirState("2022/08", 5.0, [])
+    fake_instance.match_jobs.side_effect = fake_match_jobs([(dir_state, [
+        ("2022/08", "f1.png", img_facts), ("2022/08", "opt.png", opt_facts)])])
+    shrunk = dict(sample_metadata, filesize=1024)
+    fake_instance.run_jobs.side_effect = lambda jobs: zip(jobs, [
+        (shrunk, 30.0, [
+            {"engine_secs": 0.5, "bytes_in": 100, "bytes_out": 60,
+             "accepted": True}], [sentinel.state1, sentinel.size1]),
+        (sample_metadata, 0, [
+            {"engine_secs": 0.25, "bytes_in": 100, "bytes_out": 120,
+             "accepted": False, "cache": ("k1", 120)},
+            {"cached": True, "cache": ("k2", 90)}], [sentinel.state2])])
+    ChangeManager.check_all_uploads(fake_instance)
+    fake_instance.scan_imgs.assert_called_once_with(
+        fake_instance.state.get_dirs.return_value)
+    # Examined in the workers, only recorded here.
+    fake_instance.state_of.assert_not_called()
+    fake_instance.write_back.assert_called_once_with(
+        [sentinel.state1, sentinel.size1, sentinel.state2], [(7, shrunk)],
+        [("k1", 120), ("k2", 90)], [dir_state])
+    assert fake_instance.metrics.counters == {
+        "attachments_shrunk": 1, "encodes": 2, "encodes_cached": 1,
+        "encodes_accepted": 1, "encodes_rejected": 1, "engine_secs": 0.75,
+        "bytes_in": 200, "bytes_out": 180, "bytes_saved": 40}
+
+
+def test_check_all_uploads_past_failure(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.commit_every = 100
+    fake_instance.checkpoint_secs = 60
+    fake_instance.workers = 1
+    fake_instance.async_converts = 0
+    dir_states = [DirState("2015/01", 5.0, []), DirState("2015/02", 5.0, [])]
+    bad = ("2015/01", "upload0.jpg", {"metadata": sample_metadata, "id": 1})
+    good = ("2015/02", "upload1.png", {"metadata": sample_metadata, "id": 2})
+    fake_instance.match_jobs.side_effect = fake_match_jobs([
+        (dir_states[0], [bad]), (dir_states[1], [good])])
+    shrunk = dict(sample_metadata, filesize=1024)
+    fake_instance.examine_attachment.side_effect = [
+        EngineException("convert failed"),
+        (shrunk, 30.0, [], [("2015/02/upload1.png", "shrunk")])]
+    fake_instance.run_jobs = lambda jobs: ChangeManager.run_jobs(
+        fake_instance, jobs)
+    fake_instance.failed_states = lambda rel_path: \
+        ChangeManager.failed_states(fake_instance, rel_path)
+    fake_instance.state_of.side_effect = \
+        lambda rel_path, mtime, outcome: (rel_path, outcome)
+    ChangeManager.check_all_uploads(fake_instance)
+    # The bad one is skipped until it changes, and doesn't hold up the rest.
+    fake_instance.write_back.assert_called_once_with(
+        [("2015/01/upload0.jpg", "failed"), ("2015/02/upload1.png", "shrunk")],
+        [(2, shrunk)], [], dir_states)
+    assert fake_instance.metrics.counters == {
+        "attachments_failed": 1, "attachments_shrunk": 1}
+
+
+def test_size_states(tmp_path, sample_metadata):
+    (tmp_path / "2022" / "08").mkdir(parents=True)
+    thumb = tmp_path / "2022" / "08" / "f1-150x150.png"
+    thumb.write_bytes(b"t" * 9000)
+    fake_instance = Mock()
+    fake_instance.root_dir = str(tmp_path)
+    st = os.stat(thumb)
+    # Missing sizes are left out.
+    assert ChangeManager.size_states(
+        fake_instance, "2022/08", sample_metadata) == [
+        FileState("2022/08/f1-150x150.png", st.st_mtime, 9000, st.st_ino,
+                  outcome="size")]
+
+
+def test_failed_states(tmp_path):
+    (tmp_path / "f1.jpg").write_bytes(b"not really a jpg")
+    fake_instance = Mock()
+    fake_instance.root_dir = str(tmp_path)
+    fake_instance.state_of = lambda *args: ChangeManager.state_of(
+        fake_instance, *args)
+    assert [state.outcome for state in ChangeManager.failed_states(
+        fake_instance, "f1.jpg")] == ["failed"]
+    assert ChangeManager.failed_states(fake_instance, "gone.jpg") == []
+
+
+def test_check_all_uploads_of_listings():
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.match_jobs.side_effect = fake_match_jobs([])
+    fake_instance.run_jobs.side_effect = lambda jobs: list(jobs)
+    listings = [("2022/08", {}, None)]
+    ChangeManager.check_all_uploads(fake_instance, listings)
+    fake_instance.scan_imgs.assert_not_called()
+    assert list(fake_instance.match_jobs.call_args[0][0]) == listings
+
+
+def test_states_of(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.size_states.return_value = [sentinel.size1]
+    fake_instance.state_of.side_effect = lambda rel_path, *_: rel_path
+    encodes = [
+        {"file": "f1.png.webp", "engine_secs": 0.5, "bytes_in": 100,
+         "bytes_out": 60, "accepted": True, "variant": True},
+        {"file": "f1-150x150.png.webp", "engine_secs": 0.5,
+         "bytes_in": 100, "bytes_out": 160, "accepted": False,
+         "variant": True},
+        {"file": "f1.png", "engine_secs": 0.5, "bytes_in": 100,
+         "bytes_out": 60, "accepted": True}]
+    assert ChangeManager.states_of(
+        fake_instance, "2022/08", "f1.png", sample_metadata, 0, encodes) == [
+        "2022/08/f1.png", "2022/08/f1.png.webp", sentinel.size1]
+    fake_instance.state_of.assert_has_calls([
+        call("2022/08/f1.png", 0, "kept"),
+        call("2022/08/f1.png.webp", 0, "variant")])
+    fake_instance.size_states.assert_called_once_with(
+        "2022/08", sample_metadata)
+    ChangeManager.states_of(
+        fake_instance, "2022/08", "f1.png", sample_metadata, 30.0, [])
+    fake_instance.state_of.assert_called_with("2022/08/f1.png", 30.0, "shrunk")
+
+
+@pytest.mark.parametrize("async_converts", [0, 2])
+def test_examine_attachment(async_converts, tmp_path, sample_metadata):
+    (tmp_path / "2022" / "08").mkdir(parents=True)
+    (tmp_path / "2022" / "08" / "f1.png").write_bytes(b"not really a png")
+    fake_instance = Mock()
+    fake_instance.root_dir = str(tmp_path)
+    fake_instance.states_of = lambda *args: ChangeManager.states_of(
+        fake_instance, *args)
+    fake_instance.state_of = lambda *args: ChangeManager.state_of(
+        fake_instance, *args)
+    fake_instance.size_states.return_value = []
+    shrunk = dict(sample_metadata, filesize=16)
+    fake_instance.shrink_attachment.return_value = (shrunk, 0, [])
+
+    async def shrink_async(subfolder, file_nm, img_facts, slots):
+        return shrunk, 0, []
+
+    fake_instance.shrink_attachment_async = shrink_async
+    job = ("2022/08", "f1.png", {"metadata": sample_metadata})
+    if async_converts:
+        result = asyncio.run(ChangeManager.examine_attachment_async(
+            fake_instance, *job, asyncio.Semaphore(async_converts)))
+    else:
+        result = ChangeManager.examine_attachment(fake_instance, *job)
+    # Hashed by the worker, for the coordinating process to record.
+    metadata, latest_mtime, encodes, states = result
+    assert (metadata, latest_mtime, encodes) == (shrunk, 0, [])
+    assert [(state.rel_path, state.content_hash, state.outcome) for state in states] \
+        == [("2022/08/f1.png", "df71de0d1040e5b6a22cbdbc86a7922d39d4cf9b",
+             "kept")]
+
+
+def test_check_all_uploads_writes_back_in_chunks(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.commit_every = 2
+    fake_instance.checkpoint_secs = 60
+    dirs = [DirState("2022/0{}".format(m), 5.0, []) for m in (7, 8)]
+    jobs = [[(d.rel_path, "f{}.png".format(n), {
+        "metadata": sample_metadata, "id": n}) for n in range(3)]
+        for d in dirs]
+    fake_instance.match_jobs.side_effect = fake_match_jobs(zip(dirs, jobs))
+    shrunk = dict(sample_metadata, filesize=1024)
+    sizes = []
+
+    def run_jobs(jobs):
+        for job in jobs:
+            states = ["/".join(job[:2])] + sizes
+            yield job, (shrunk, 30.0, [], states) if job[2]["id"] % 2 else \
+                (sample_metadata, 0, [], states)
+
+    fake_instance.run_jobs.side_effect = run_jobs
+    ChangeManager.check_all_uploads(fake_instance)
+    # Each directory is recorded alongside the last of its files.
+    assert fake_instance.write_back.call_args_list == [
+        call(["2022/07/f0.png", "2022/07/f1.png"], [(1, shrunk)], [], []),
+        call(["2022/07/f2.png", "2022/08/f0.png"], [], [], [dirs[0]]),
+        call(["2022/08/f1.png", "2022/08/f2.png"], [(1, shrunk)], [],
+             [dirs[1]]),
+        call([], [], [], []),
+    ]
+    # Sizes don't count towards "commit_every", which is of attachments.
+    fake_instance.write_back.reset_mock()
+    fake_instance.match_jobs.side_effect = fake_match_jobs(zip(dirs, jobs))
+    sizes += ["size"] * 3
+    ChangeManager.check_all_uploads(fake_instance)
+    assert fake_instance.write_back.call_count == 4
+
+
+@patch("optimiser.time.monotonic", side_effect=[0, 10, 70, 80, 90])
+def test_check_all_uploads_checkpoints_in_time(mock_monotonic, sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.commit_every = 100
+    fake_instance.checkpoint_secs = 60
+    dir_state = DirState("2022/08", 5.0, [])
+    jobs = [("2022/08", "f{}.png".format(n), {
+        "metadata": sample_metadata, "id": n}) for n in range(3)]
+    fake_instance.match_jobs.side_effect = fake_match_jobs([(dir_state, jobs)])
+    fake_instance.run_jobs.side_effect = lambda jobs: [
+        (job, (sample_metadata, 0, [], ["/".join(job[:2])])) for job in jobs]
+    ChangeManager.check_all_uploads(fake_instance)
+    assert fake_instance.write_back.call_args_list == [
+        call(["2022/08/f0.png", "2022/08/f1.png"], [], [], []),
+        call(["2022/08/f2.png"], [], [], [dir_state]),
+    ]
+
+
+def test_check_all_uploads_interrupted(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.commit_every = 100
+    fake_instance.checkpoint_secs = 60
+    dir_state = DirState("2022/08", 5.0, [])
+    jobs = [("2022/08", "f{}.png".format(n), {
+        "metadata": sample_metadata, "id": n}) for n in range(3)]
+    fake_instance.match_jobs.side_effect = fake_match_jobs([(dir_state, jobs)])
+    shrunk = dict(sample_metadata, filesize=1024)
+
+    def run_jobs(jobs):
+        yield next(jobs), (shrunk, 30.0, [], ["2022/08/f0.png"])
+        raise KeyboardInterrupt()
+
+    fake_instance.run_jobs.side_effect = run_jobs
+    with pytest.raises(KeyboardInterrupt):
+        ChangeManager.check_all_uploads(fake_instance)
+    # What finished is kept, but not the directory, which isn't done.
+    fake_instance.write_back.assert_called_once_with(
+        ["2022/08/f0.png"], [(0, shrunk)], [], [])
+
+
+def test_reconcile_filesizes(tmp_path, sample_metadata):
+    (tmp_path / "2022" / "08").mkdir(parents=True)
+    (tmp_path / "2022" / "08" / "f1.png").write_bytes(b"o" * 38543)
+    (tmp_path / "2022" / "08" / "f1-150x150.png").write_bytes(b"t" * 9000)
+    del sample_metadata["sizes"]["medium"]["filesize"]
+    fake_instance = Mock()
+    fake_instance.root_dir = str(tmp_path)
+    ChangeManager.reconcile_filesizes(fake_instance, sample_metadata, "2022/08")
+    assert sample_metadata["filesize"] == 38543
+    assert sample_metadata["sizes"]["thumbnail"]["filesize"] == 9000
+    assert "filesize" not in sample_metadata["sizes"]["medium"]
+
+
+def test_write_back():
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.commit_every = 2
+    ChangeManager.write_back(fake_instance, [sentinel.state], [sentinel.update],
+                             [sentinel.cached], [sentinel.dir_state])
+    fake_instance.db.update_filesizes_batch.assert_called_once_with(
+        [sentinel.update], 2)
+    fake_instance.state.upsert.assert_called_once_with(
+        [sentinel.state], [sentinel.dir_state], [sentinel.cached])
+    assert "write_back" in fake_instance.metrics.phase_secs
+
+
+def test_write_back_nothing():
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    ChangeManager.write_back(fake_instance, [], [], [], [])
+    fake_instance.db.update_filesizes_batch.assert_not_called()
+    fake_instance.state.upsert.assert_not_called()
+
+
+def test_sequester_data_by_rel_file_paths(sample_metadata):
+    fake_instance = Mock()
+    fake_instance.metrics = Metrics()
+    fake_instance.db.fetch_media_metadata_for.return_value = [
+        (7, php_serialize_from_dict(sample_metadata))]
+    rel_paths = ["2022/08/f1.png", "2022/08/f1-150x150.png"]
+    img_facts = ChangeManager.sequester_data_by_rel_file_paths(
+        fake_instance, rel_paths)
+    fake_instance.db.fetch_media_metadata_for.assert_called_once_with(rel_paths)
+    assert set(fake_instance.metrics.phase_secs) == {"db_query", "unserialize"}
+    assert img_facts == {"2022/08/f1.png": {
+        "metadata": sample_metadata, "megapix": 530 * 583 / 1_000_000,
+        "id": 7}}
+
+
+def test_state_of(tmp_path):
+    (tmp_path / "2022").mkdir()
+    img_path = tmp_path / "2022" / "f1.png"
+    img_path.write_bytes(b"not really a png")
+    st = os.stat(img_path)
+    fake_instance = Mock()
+    fake_instance.root_dir = str(tmp_path)
+    state = ChangeManager.state_of(fake_instance, "2022/f1.png", 0, "kept")
+    assert state == FileState(
+        "2022/f1.png", st.st_mtime, 16, st.st_ino,
+        "df71de0d1040e5b6a22cbdbc86a7922d39d4cf9b", "kept")
+    later = ChangeManager.state_of(
+        fake_instance, "2022/f1.png", st.st_mtime + 5, "shrunk")
+    assert later.mtime == st.st_mtime + 5
+
+
+@patch("optimiser.time.sleep", autospec=True,
+       side_effect=[None, SystemExit(143)])
+@patch("optimiser.time.monotonic", side_effect=[0, 40, 300, 370])
+def test_run_daemon(mock_monotonic, mock_sleep):
+    fake_instance = Mock()
+    fake_instance.config = {}
+    fake_instance.poll_secs = 60
+    metrics = []
+    fake_instance.check_all_uploads.side_effect = \
+        lambda: metrics.append(fake_instance.metrics)
+    with pytest.raises(SystemExit):
+        ChangeManager.run_daemon(fake_instance)
+    assert fake_instance.check_all_uploads.call_count == 2
+    # The next poll is due poll_secs after the last began, or at once.
+    assert mock_sleep.call_args_list == [call(20), call(0)]
+    assert metrics[0] is not metrics[1]
+
+
+@patch("optimiser.time.sleep", autospec=True,
+       side_effect=[None, SystemExit(143)])
+@patch("optimiser.time.monotonic", side_effect=[0, 40, 300, 370])
+@patch("optimiser.traceback.print_exc", autospec=True)
+def test_run_daemon_survives_failure(mock_print_exc, mock_monotonic,
+                                     mock_sleep):
+    fake_instance = Mock()
+    fake_instance.config = {}
+    fake_instance.poll_secs = 60
+    fake_instance.check_all_uploads.side_effect = [
+        FileNotFoundError("2022/08/f1.png"), None]
+    with pytest.raises(SystemExit):
+        ChangeManager.run_daemon(fake_instance)
+    assert fake_instance.check_all_uploads.call_count == 2
+    assert mock_sleep.call_args_list == [call(20), call(0)]
+    mock_print_exc.assert_called_once_with()
+
+
+@patch("optimiser.time.monotonic", side_effect=[
+    0, 0, 0, 1, 2, 3, 3, 3, 4, 5, 5, 6])
+def test_follow_feed(mock_monotonic):
+    fake_instance = Mock()
+    fake_instance.config = {}
+    feed = Mock(reconcile_secs=3600)
+    # Lost track, so everything again, then changes, until stopped.
+    feed.changed_dirs.side_effect = [
+        set(), None, {"2022/08", "2022"}, KeyboardInterrupt()]
+    with pytest.raises(KeyboardInterrupt):
+        ChangeManager.follow_feed(fake_instance, feed)
+    assert feed.changed_dirs.call_args_list == [
+        call(3599), call(3597), call(3599), call(3598)]
+    fake_instance.scan_dirs.assert_called_once_with(["2022", "2022/08"])
+    assert fake_instance.check_all_uploads.call_args_list == [
+        call(), call(), call(fake_instance.scan_dirs.return_value)]
+
+
+@patch("optimiser.time.monotonic", side_effect=[
+    0, 0, 0, 0, 10, 300, 300, 300, 400, 410, 410])
+@patch("optimiser.traceback.print_exc", autospec=True)
+def test_follow_feed_survives_failure(mock_print_exc, mock_monotonic):
+    fake_instance = Mock()
+    fake_instance.config = {}
+    fake_instance.poll_secs = 300
+    fake_instance.check_all_uploads.side_effect = [
+        OSError("db"), FileNotFoundError("a"), None, FileNotFoundError("b")]
+    feed = Mock(reconcile_secs=3600)
+    feed.changed_dirs.side_effect = [
+        {"2022"}, {"2022/08"}, KeyboardInterrupt()]
+    with pytest.raises(KeyboardInterrupt):
+        ChangeManager.follow_feed(fake_instance, feed)
+    # Everything is checked again poll_secs after any check fails.
+    assert feed.changed_dirs.call_args_list == [
+        call(300), call(3600), call(290)]
+    assert fake_instance.check_all_uploads.call_count == 4
+    assert mock_print_exc.call_count == 3
+
+
+@patch("optimiser.InotifyFeed", autospec=True)
+def test_run_daemon_follows_feed(mock_feed):
+    fake_instance = Mock()
+    fake_instance.config = {"inotify": {}}
+    fake_instance.follow_feed.side_effect = SystemExit(143)
+    with pytest.raises(SystemExit):
+        ChangeManager.run_daemon(fake_instance)
+    feed = mock_feed.from_config.return_value
+    mock_feed.from_config.assert_called_once_with(
+        fake_instance.root_dir, optimiser._is_upload, {})
+    fake_instance.follow_feed.assert_called_once_with(feed)
+    feed.__exit__.assert_called_once()
+
+
+def test_exit_on_sigterm():
+    with pytest.raises(SystemExit) as exc_info:
+        optimiser._exit_on_sigterm(15, None)
+    assert exc_info.value.code == 143
+
+
+@patch("optimiser.signal.signal", autospec=True)
+@patch("optimiser.ChangeManager", autospec=True)
+def test_parse_args_handles_sigterm(mock_change_mngr, mock_signal):
+    process_args([])
+    mock_signal.assert_called_once_with(
+        optimiser.signal.SIGTERM, optimiser._exit_on_sigterm)
@@ -0,0 +1,150 @@
+import copy
+import pickle
+
+import pytest
+
+from php_meta import loads, dumps, patch_filesizes, PhpMetadata, \
+    PhpObject
+
+IMAGE_META = \
+    'a:12:{s:8:"aperture";s:3:"1.8";s:6:"credit";s:0:"";s:6:"camera";' \
+    's:7:"Pixel 6";s:7:"caption";s:17:"Café ☕ à midi";' \
+    's:17:"created_timestamp";s:10:"1659000000";s:9:"copyright";s:0:"";' \
+    's:12:"focal_length";s:4:"6.81";s:3:"iso";s:2:"50";' \
+    's:13:"shutter_speed";s:4:"0.01";s:5:"title";s:0:"";' \
+    's:11:"orientation";s:1:"1";s:8:"keywords";a:2:{i:0;s:3:"cat";' \
+    'i:1;s:4:"mûr";}}'
+
+SERIALIZED = \
+    'a:6:{s:5:"width";i:1080;s:6:"height";i:424;s:4:"file";' \
+    's:17:"2022/08/café.png";s:8:"filesize";i:7345;s:5:"sizes";' \
+    'a:1:{s:6:"medium";a:5:{s:4:"file";s:17:"café-300x118.png";' \
+    's:5:"width";i:300;s:6:"height";i:118;s:9:"mime-type";' \
+    's:9:"image/png";s:8:"filesize";i:10938;}}s:10:"image_meta";' + \
+    IMAGE_META + '}'
+
+
+def test_loads_only_keys_used():
+    metadata = loads(SERIALIZED)
+    assert isinstance(metadata, PhpMetadata)
+    assert set(metadata) == {"width", "height", "file", "filesize", "sizes"}
+    assert metadata["file"] == "2022/08/café.png"
+    assert metadata["sizes"]["medium"]["filesize"] == 10938
+    assert metadata.raw["image_meta"] == IMAGE_META.encode()
+
+
+def test_loads_skipped_key_on_indexing():
+    metadata = loads(SERIALIZED)
+    assert metadata["image_meta"]["caption"] == "Café ☕ à midi"
+    assert metadata["image_meta"]["keywords"] == {0: "cat", 1: "mûr"}
+    with pytest.raises(KeyError):
+        metadata["not_there"]
+
+
+def test_loads_every_key():
+    metadata = loads(SERIALIZED, keys=None)
+    assert metadata.raw == {}
+    assert metadata["image_meta"]["camera"] == "Pixel 6"
+
+
+def test_loads_scalars():
+    metadata = loads(
+        'a:5:{s:1:"b";b:1;s:1:"n";N;s:1:"d";d:0.5;s:1:"e";d:-INF;'
+        's:1:"o";O:8:"stdClass":1:{s:1:"x";i:1;}}', keys=("b", "n", "d", "e"))
+    assert metadata == {"b": True, "n": None, "d": 0.5, "e": float("-inf")}
+    assert metadata.raw["o"] == b'O:8:"stdClass":1:{s:1:"x";i:1;}'
+
+
+OBJECT_META = \
+    'a:2:{s:7:"caption";s:0:"";s:8:"location";O:8:"stdClass":2:{' \
+    's:3:"lat";d:51.5;s:11:"\0*\0accuracy";i:10;}}'
+WITH_OBJECT = \
+    'a:3:{s:4:"file";s:10:"2022/f.jpg";s:5:"sizes";a:0:{}' \
+    's:10:"image_meta";' + OBJECT_META + '}'
+
+
+@pytest.mark.parametrize("keys", [("file", "sizes"), None])
+def test_loads_object(keys):
+    metadata = loads(WITH_OBJECT, keys)
+    assert metadata["image_meta"]["location"] == PhpObject(
+        "stdClass", {"lat": 51.5, "\0*\0accuracy": 10})
+    assert dumps(metadata) == WITH_OBJECT
+    metadata["image_meta"]["caption"] = "Café"
+    assert dumps(metadata) == WITH_OBJECT.replace(
+        's:7:"caption";s:0:""', 's:7:"caption";s:5:"Café"')
+
+
+def test_loads_not_an_array():
+    with pytest.raises(ValueError):
+        loads('s:3:"abc";')
+
+
+@pytest.mark.parametrize("keys", [("file",), None])
+def test_round_trip_byte_for_byte(keys):
+    assert dumps(loads(SERIALIZED, keys)) == SERIALIZED
+
+
+def test_dumps_changed_keys_only():
+    metadata = loads(SERIALIZED)
+    metadata["sizes"]["medium"]["filesize"] = 9000
+    metadata["filesize"] = 7000
+    assert dumps(metadata) == SERIALIZED.replace(
+        "i:10938;", "i:9000;").replace("i:7345;", "i:7000;")
+
+
+def test_dumps_added_and_removed_keys():
+    metadata = loads(SERIALIZED)
+    del metadata["sizes"]
+    metadata["original_image"] = "café-orig.png"
+    assert dumps(metadata) == \
+        'a:6:{s:5:"width";i:1080;s:6:"height";i:424;s:4:"file";' \
+        's:17:"2022/08/café.png";s:8:"filesize";i:7345;' \
+        's:10:"image_meta";' + IMAGE_META + \
+        's:14:"original_image";s:14:"café-orig.png";}'
+
+
+def test_dumps_plain_dict():
+    assert dumps({"a": [1.0, 2.5, False], 3: None}) == \
+        'a:2:{s:1:"a";a:3:{i:0;d:1;i:1;d:2.5;i:2;b:0;}i:3;N;}'
+
+
+def test_copies_keep_skipped_keys():
+    metadata = loads(SERIALIZED)
+    for copied in (copy.deepcopy(metadata),
+                   pickle.loads(pickle.dumps(metadata))):
+        assert copied == metadata
+        assert dumps(copied) == SERIALIZED
+
+
+def test_patch_filesizes():
+    metadata = loads(SERIALIZED)
+    metadata["sizes"]["medium"]["filesize"] = 9000
+    metadata["filesize"] = 123456
+    assert patch_filesizes(metadata) == SERIALIZED.replace(
+        "i:10938;", "i:9000;").replace("i:7345;", "i:123456;")
+
+
+def test_patch_filesizes_unchanged():
+    metadata = loads(SERIALIZED)
+    assert patch_filesizes(metadata) is metadata.source
+
+
+def test_patch_filesizes_added():
+    without = SERIALIZED.replace('s:8:"filesize";i:10938;', "").replace(
+        '"medium";a:5:', '"medium";a:4:')
+    metadata = loads(without)
+    metadata["sizes"]["medium"]["filesize"] = 9000
+    assert patch_filesizes(metadata) == SERIALIZED.replace(
+        "i:10938;", "i:9000;")
+
+
+def test_patch_filesizes_other_sizes():
+    metadata = loads(SERIALIZED)
+    metadata["sizes"]["large"] = dict(metadata["sizes"]["medium"])
+    assert patch_filesizes(metadata) == dumps(metadata)
+    assert 's:5:"large";' in patch_filesizes(metadata)
+
+
+def test_patch_filesizes_without_source():
+    metadata = {"file": "a.png", "filesize": 10, "sizes": {}}
+    assert patch_filesizes(metadata) == dumps(metadata)
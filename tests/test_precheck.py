@@ -0,0 +1,76 @@
+import os
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from precheck import jpeg_quality, png_palette_size, bits_per_pixel, \
+    Precheck
+
+
+@pytest.mark.parametrize("quality", [30, 50, 70, 82, 95])
+def test_jpeg_quality(tmp_path, quality):
+    jpg = str(tmp_path / "q.jpg")
+    Image.open("grue_en_vol.jpg").save(jpg, quality=quality)
+    assert jpeg_quality(jpg) == quality
+
+
+def test_jpeg_quality_not_jpeg():
+    assert jpeg_quality("filestats.png") is None
+
+
+def test_png_palette_size(tmp_path):
+    png = str(tmp_path / "p.png")
+    Image.open("filestats.png").quantize(16).save(png)
+    assert png_palette_size(png) <= 16
+    assert png_palette_size("filestats.png") is None
+
+
+def test_bits_per_pixel():
+    assert bits_per_pixel("white_100x100.png") == pytest.approx(
+        os.path.getsize("white_100x100.png") * 8 / 10000)
+
+
+def test_from_config():
+    assert Precheck.from_config(None) is None
+    precheck = Precheck.from_config({"max_bpp": {"webp": 0.5}})
+    assert precheck.audit_rate == 0.05
+    assert precheck.max_bpp == {"webp": 0.5}
+
+
+@pytest.fixture
+def imgs(tmp_path):
+    jpg = str(tmp_path / "f1.jpg")
+    Image.open("grue_en_vol.jpg").save(jpg, quality=60)
+    png = str(tmp_path / "f2.png")
+    Image.open("filestats.png").quantize(32).save(png)
+    return jpg, png
+
+
+def test_predict_no_saving(imgs):
+    jpg, png = imgs
+    precheck = Precheck()
+    assert precheck.predict_no_saving({"q": 70, "dest_img": jpg}) == \
+           "jpeg_quality"
+    assert precheck.predict_no_saving({"q": 50, "dest_img": jpg}) is None
+    assert precheck.predict_no_saving({"q": 32, "dest_img": png}) == \
+           "png_palette"
+    assert precheck.predict_no_saving({"q": 16, "dest_img": png}) is None
+    assert precheck.predict_no_saving(
+        {"q": 32, "dest_img": "filestats.png"}) is None
+
+
+def test_predict_no_saving_by_bpp(imgs):
+    jpg, _ = imgs
+    bpp = bits_per_pixel(jpg)
+    assert Precheck(max_bpp={"jpg": bpp + 0.1}).predict_no_saving(
+        {"q": 50, "dest_img": jpg}) == "bpp"
+    assert Precheck(max_bpp={"jpg": bpp - 0.1}).predict_no_saving(
+        {"q": 50, "dest_img": jpg}) is None
+
+
+@patch("precheck.random.random", side_effect=[0.01, 0.5])
+def test_audit(mock_random):
+    precheck = Precheck(audit_rate=0.05)
+    assert precheck.audit()
+    assert not precheck.audit()
@@ -0,0 +1,77 @@
+from unittest.mock import Mock
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from engines import PillowEngine
+from quality_search import ssim, QualitySearch, luminance
+
+JPG_NORESIZE_CMD = "convert -strip -quality {q}% -interlace Plane" \
+                   " -gaussian-blur 0.05 {src_img} {dest_img}"
+
+
+@pytest.fixture
+def photo_jpg(tmp_path):
+    rng = np.random.default_rng(7)
+    gradient = np.linspace(0, 255, 320)[None, :] * np.ones((240, 1))
+    pixels = np.clip(gradient + rng.normal(0, 12, (240, 320)), 0, 255)
+    path = str(tmp_path / "photo.jpg")
+    Image.fromarray(pixels.astype(np.uint8)).convert("RGB").save(
+        path, quality=95)
+    return path
+
+
+def test_ssim():
+    rng = np.random.default_rng(1)
+    a = rng.uniform(0, 255, (40, 50))
+    assert ssim(a, a) == pytest.approx(1.0)
+    slightly = ssim(a, a + rng.normal(0, 4, a.shape))
+    very = ssim(a, a + rng.normal(0, 40, a.shape))
+    assert 1.0 > slightly > very
+    # Windows no larger than the image.
+    assert ssim(a[:3, :3], a[:3, :3]) == pytest.approx(1.0)
+
+
+def test_from_config():
+    assert QualitySearch.from_config(None) is None
+    search = QualitySearch.from_config({"ssim": 0.9, "max_trials": 3})
+    assert (search.target, search.min_q, search.max_trials,
+            search.tolerance) == (0.9, 30, 3, 2)
+
+
+def test_search_bisects(photo_jpg):
+    engine = Mock(wraps=PillowEngine())
+    reference = luminance(photo_jpg)
+    search = QualitySearch(target=0.9, min_q=10, max_trials=8, tolerance=1)
+    q, trials = search.search(photo_jpg, JPG_NORESIZE_CMD, engine, 90)
+    assert 10 <= q < 90
+    assert trials == engine.render.call_count <= 7
+    tried = [c.args[0]["q"] for c in engine.render.call_args_list]
+    assert tried[0] == (9 + 90) // 2
+    # The quality found meets the target, and one less doesn't.
+    for trial_q, meets in ((q, True), (q - 1, False)):
+        dest = photo_jpg + ".{}.jpg".format(trial_q)
+        PillowEngine().render({"q": trial_q, "src_img": photo_jpg,
+                               "dest_img": dest}, JPG_NORESIZE_CMD)
+        assert (ssim(reference, luminance(dest)) >= 0.9) == meets
+
+
+def test_search_bounded(photo_jpg):
+    engine = Mock(wraps=PillowEngine())
+    search = QualitySearch(target=1.01, min_q=10, max_trials=2)
+    assert search.search(photo_jpg, JPG_NORESIZE_CMD, engine, 70) == (70, 2)
+    search = QualitySearch(target=0.0, min_q=10, tolerance=20)
+    q, trials = search.search(photo_jpg, JPG_NORESIZE_CMD, engine, 70)
+    assert trials == 2 and q == 24
+
+
+def test_timed_search(photo_jpg):
+    engine = Mock(wraps=PillowEngine())
+    engine.name = "pillow"
+    search = QualitySearch(target=0.0, min_q=10, max_trials=1)
+    q, report = search.timed_search(photo_jpg, JPG_NORESIZE_CMD, engine, 70)
+    assert q == 39
+    assert report == {"file": "photo.jpg", "engine": "pillow",
+                      "q_search": 1, "engine_secs": report["engine_secs"],
+                      "q": 39, "max_q": 70}
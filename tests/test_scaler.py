@@ -1,8 +1,9 @@
 from unittest.mock import patch, sentinel, Mock, mock_open, call
 
+import numpy as np
 import pytest
 
-from scaler import ResolutionsList, ImgScaler
+from scaler import ResolutionsList, ImgScaler, plan_batch, round_half_up
 
 
 def combined_widths_and_heights(w, h):
@@ -147,3 +148,50 @@ def test_get_uncropped_thumb(src_w,src_h,expected_interim_dims):
     assert interim_dims == expected_interim_dims
 
 
+
+
+@pytest.mark.parametrize("decimal", [
+    0.5, 1.5, 2.5, 520.5, 0.49999999999999994, 1.4999999999999998,
+    4503599627370495.5, 0.0, 3.0, -2.5, -0.4, 2.499, 2.501])
+def test_round_half_up(decimal):
+    assert round_half_up(np.array([decimal]))[0] == \
+           ResolutionsList.round(decimal)
+
+
+def scalar_plan(w, h):
+    scaler = ImgScaler(w, h)
+    sizes, thmb = scaler.get_widths_and_heights()
+    return sizes, thmb, thmb and scaler.get_uncropped_thumb(*thmb)
+
+
+def batch_plans(ws, hs):
+    sizes = plan_batch(ws, hs)
+    for i in range(len(ws)):
+        made = {label: (int(s.w[i]), int(s.h[i]))
+                for label, s in sizes.items() if s.valid[i]}
+        thmb = made.pop("thumbnail", None)
+        uncropped = made.pop("thumbnail_uncropped", None)
+        yield sorted(made.values()), thmb, uncropped
+
+
+def test_plan_batch_labels():
+    sizes = plan_batch([4000], [3000])
+    assert {label: (s.w[0], s.h[0]) for label, s in sizes.items()} == {
+        "medium_large": (768, 576), "medium": (300, 225),
+        "large": (1024, 768), "1536x1536": (1536, 1152),
+        "2048x2048": (2048, 1536), "thumbnail": (150, 150),
+        "thumbnail_uncropped": (200, 150)}
+
+
+def test_plan_batch_identical_to_scalar():
+    rng = np.random.default_rng(2022)
+    ws = np.concatenate([rng.integers(1, 9000, 3000),
+                         [1024, 1020, 900, 1219, 100, 150, 149, 768, 769]])
+    hs = np.concatenate([rng.integers(1, 9000, 3000),
+                         [694, 741, 1080, 396, 250, 150, 151, 100, 1]])
+    # Tall and wide extremes too.
+    ws[:100] = rng.integers(1, 200, 100)
+    hs[100:200] = rng.integers(1, 200, 100)
+    for (w, h), batch in zip(zip(ws.tolist(), hs.tolist()),
+                             batch_plans(ws, hs)):
+        assert batch == scalar_plan(w, h), (w, h)
@@ -0,0 +1,75 @@
+from unittest.mock import patch
+
+from scheduler import JobScheduler, job_cost_mb, magick_limits, \
+    MB_PER_MEGAPIXEL
+
+
+def jobs_of(*megapixels):
+    return [("2022/08", "f{}.png".format(i), {"id": i, "megapix": mp})
+            for i, mp in enumerate(megapixels)]
+
+
+def test_job_cost_mb():
+    assert job_cost_mb(jobs_of(2.5)[0]) == 2.5 * MB_PER_MEGAPIXEL
+
+
+def test_admit_in_order_read_without_lookahead():
+    jobs = jobs_of(0.1, 50, 2, 12)
+    scheduler = JobScheduler(jobs, max_in_flight=2)
+    assert list(scheduler.admit()) == jobs[:2]
+    assert list(scheduler.admit()) == []
+    scheduler.done(jobs[0])
+    assert list(scheduler.admit()) == [jobs[2]]
+
+
+def test_admit_largest_first_within_lookahead():
+    jobs = jobs_of(0.1, 50, 2, 12, 0.3)
+    taken = []
+
+    def lazy_jobs():
+        for job in jobs:
+            taken.append(job)
+            yield job
+
+    scheduler = JobScheduler(lazy_jobs(), max_in_flight=2, lookahead=2)
+    assert list(scheduler.admit()) == [jobs[1], jobs[3]]
+    assert len(taken) == 4
+    scheduler.done(jobs[1])
+    scheduler.done(jobs[3])
+    assert list(scheduler.admit()) == [jobs[2], jobs[4]]
+    scheduler.done(jobs[2])
+    assert list(scheduler.admit()) == [jobs[0]]
+    assert scheduler.pending == []
+
+
+def test_admit_within_memory_budget():
+    jobs = jobs_of(40, 30, 1, 1)
+    scheduler = JobScheduler(jobs, max_in_flight=8,
+                             memory_mb=50 * MB_PER_MEGAPIXEL, lookahead=8)
+    # A job over budget alongside others still starts once alone.
+    assert list(scheduler.admit()) == [jobs[0]]
+    scheduler.done(jobs[0])
+    assert list(scheduler.admit()) == [jobs[1], jobs[2], jobs[3]]
+    assert scheduler.in_flight_mb == 32 * MB_PER_MEGAPIXEL
+
+
+def test_admit_over_budget_alone():
+    jobs = jobs_of(80)
+    scheduler = JobScheduler(jobs, max_in_flight=2, memory_mb=100)
+    assert list(scheduler.admit()) == jobs
+
+
+def test_from_config():
+    scheduler = JobScheduler.from_config(
+        [], 4, {"memory_mb": 2048, "lookahead": 16})
+    assert (scheduler.max_in_flight, scheduler.memory_mb,
+            scheduler.lookahead) == (4, 2048, 16)
+    scheduler = JobScheduler.from_config([], 4, None)
+    assert (scheduler.memory_mb, scheduler.lookahead) == (0, 0)
+
+
+@patch("scheduler.os.cpu_count", return_value=8)
+def test_magick_limits(mock_cpu_count):
+    assert magick_limits(4096, 4) == {
+        "memory": "1024MiB", "map": "2048MiB", "thread": "2"}
+    assert magick_limits(100, 16)["thread"] == "1"
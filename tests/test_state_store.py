@@ -0,0 +1,166 @@
+import os
+import sqlite3
+from unittest.mock import patch, sentinel, Mock, mock_open, call
+
+import pytest
+
+from state_store import StateStore, ResidentStateStore, FileState, DirState, \
+    _read_csv_mtimes
+
+
+@pytest.fixture(params=[StateStore, ResidentStateStore])
+def store(tmp_path, request):
+    store = request.param(str(tmp_path / "state.sqlite3"),
+                          str(tmp_path / "latest_mods.csv"))
+    store.connect()
+    yield store
+    store.close()
+
+
+def test_read_csv_mtimes(tmp_path):
+    csv_path = tmp_path / "latest_mods.csv"
+    csv_path.write_text("path1,384.31\nroot1/path1/file1,41.949\n")
+    inode_last_mstats = _read_csv_mtimes(str(csv_path))
+    assert inode_last_mstats["path1"] == 384.31
+    assert inode_last_mstats["root1/path1/file1"] == 41.949
+
+
+def test_read_csv_mtimes_missing(tmp_path):
+    assert _read_csv_mtimes(str(tmp_path / "latest_mods.csv")) == {}
+
+
+def test_empty_store(store):
+    assert store.get_mtimes() == {}
+    assert store.get("2022/08/f1.png") is None
+
+
+def test_upsert(store):
+    store.upsert([
+        FileState("2022/08/f1.png", 10.5, 100, 7, "abc", "kept"),
+        FileState("2022/08/f2.png", 11.5),
+    ])
+    store.upsert([FileState("2022/08/f1.png", 20.5, 90, 8, "def", "shrunk")])
+    assert store.get_mtimes() == {
+        "2022/08/f1.png": 20.5, "2022/08/f2.png": 11.5}
+    assert store.get("2022/08/f1.png") == FileState(
+        "2022/08/f1.png", 20.5, 90, 8, "def", "shrunk")
+    assert store.get("2022/08/f2.png") == FileState("2022/08/f2.png", 11.5)
+
+
+def test_upsert_is_all_or_nothing(store):
+    store.upsert([FileState("2022/08/f1.png", 10.5)])
+    with pytest.raises(Exception):
+        store.upsert([FileState("2022/08/f1.png", 20.5),
+                      FileState("2022/08/f2.png", None)],
+                     [DirState("2022/08", 30.5, [])])
+    assert store.get_mtimes() == {"2022/08/f1.png": 10.5}
+    assert store.get_dirs() == {}
+
+
+def test_upsert_dirs(store):
+    store.upsert([], [DirState("", 1.5, ["2022"]),
+                      DirState("2022", 2.5, ["07", "08"])])
+    store.upsert([], [DirState("2022", 3.5, ["07", "08", "09"])])
+    assert store.get_dirs() == {
+        "": DirState("", 1.5, ["2022"]),
+        "2022": DirState("2022", 3.5, ["07", "08", "09"]),
+    }
+
+
+def test_persists_between_connections(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"),
+                       str(tmp_path / "latest_mods.csv"))
+    store.connect()
+    store.upsert([FileState("2022/08/f1.png", 10.5)])
+    store.close()
+    store.connect()
+    assert store.get_mtimes() == {"2022/08/f1.png": 10.5}
+    store.close()
+
+
+def test_migrates_csv(tmp_path):
+    csv_path = tmp_path / "latest_mods.csv"
+    csv_path.write_text("2022/08/f1.png,384.31\n2021/01/f2.webp,41.949\n")
+    # Found beside the store, wherever that is.
+    store = StateStore(str(tmp_path / "state.sqlite3"))
+    assert store.csv_path == str(csv_path)
+    store.connect()
+    assert store.get_mtimes() == {
+        "2022/08/f1.png": 384.31, "2021/01/f2.webp": 41.949}
+    assert not os.path.exists(csv_path)
+    assert os.path.exists(str(csv_path) + ".migrated")
+    store.close()
+    # Only migrated once.
+    store.connect()
+    assert len(store.get_mtimes()) == 2
+    store.close()
+
+
+def test_csv_path(tmp_path):
+    assert StateStore().csv_path == "latest_mods.csv"
+    assert StateStore(str(tmp_path / "state.sqlite3"), "old.csv").csv_path \
+        == "old.csv"
+
+
+def test_encodes_not_cached_by_default(store):
+    store.upsert([], [], [("k1", 100)])
+    assert store.get_encode_size("k1") is None
+
+
+@patch("state_store.time.time", side_effect=[1.0, 2.0, 3.0])
+def test_encodes_evicted_least_recently_used(mock_time, tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"),
+                       str(tmp_path / "latest_mods.csv"), max_encodes=2)
+    store.connect()
+    store.upsert([], [], [("k1", 100), ("k2", 200)])
+    # Refreshing k1 leaves k2 the least recently used.
+    store.upsert([], [], [("k1", 100)])
+    store.upsert([], [], [("k3", 300)])
+    assert [store.get_encode_size(k) for k in ["k1", "k2", "k3"]] == \
+           [100, None, 300]
+    store.close()
+
+
+def test_readonly_connection(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"),
+                       str(tmp_path / "latest_mods.csv"), max_encodes=10)
+    store.connect()
+    store.upsert([], [], [("k1", 100)])
+    reader = StateStore(store.path)
+    reader.connect(readonly=True)
+    assert reader.get_encode_size("k1") == 100
+    with pytest.raises(sqlite3.OperationalError):
+        reader.upsert([FileState("2022/08/f1.png", 10.5)])
+    reader.close()
+    store.close()
+
+
+def test_get_mtimes_for(store):
+    store.upsert([FileState("2022/08/f{}.png".format(n), n) for n in range(5)])
+    assert store.get_mtimes_for(
+        ["2022/08/f1.png", "2022/08/f3.png", "2022/08/new.png"],
+        batch_size=2) == {"2022/08/f1.png": 1, "2022/08/f3.png": 3}
+    assert store.get_mtimes_for([]) == {}
+
+
+def test_resident_reads_once(tmp_path):
+    store = ResidentStateStore(str(tmp_path / "state.sqlite3"),
+                               str(tmp_path / "latest_mods.csv"))
+    store.connect()
+    store.upsert([FileState("2022/08/f1.png", 1)])
+    with patch.object(StateStore, "get_mtimes", autospec=True,
+                      side_effect=StateStore.get_mtimes) as mock_get_mtimes:
+        assert store.get_mtimes_for(["2022/08/f1.png"]) == {
+            "2022/08/f1.png": 1}
+        store.upsert([FileState("2022/08/f2.png", 2)],
+                     [DirState("2022/08", 3, [])])
+        assert store.get_mtimes_for(["2022/08/f1.png", "2022/08/f2.png"]) \
+            == {"2022/08/f1.png": 1, "2022/08/f2.png": 2}
+        assert store.get_dirs() == {"2022/08": DirState("2022/08", 3, [])}
+    mock_get_mtimes.assert_called_once_with(store)
+    store.close()
+    # Written through, for the next to start from.
+    reopened = StateStore(store.path, store.csv_path)
+    reopened.connect()
+    assert reopened.get_mtimes() == {"2022/08/f1.png": 1, "2022/08/f2.png": 2}
+    reopened.close()